@@ -0,0 +1,194 @@
+# Offline benchmark of the chat engine.
+#
+# Starts a FakeOllamaServer with scripted, latency configurable responses and drives scripted
+# multi-turn conversations headlessly through ChatEngine: the model cache, prompt compiler,
+# history window, agent loop, ToolManager.tool_chain and the python_exec workers. N sessions
+# run concurrently on one event loop:
+#
+#   python benchmark_chat.py --sessions 8 --turns 8 --first-token-delay 0.2
+#
+# Reports p50/p95/p99 latency per stage (from the tracing spans, see helper_tracing), turns per
+# second and the Python heap per session, so regressions show up as numbers.
+
+import re
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+from config import Config
+from helper_ollama_fake import FakeOllamaServer, ScriptedResponder, tool_call
+from helper_tracing import tracer
+from llm_chat_engine import ChatEngine
+from llm_tools_manager import SettingsCache
+from my_tool_calls import my_tools_init, my_tools_exec_pool
+
+CONVERSATION = ["What is 1 + 1?",
+                "Multiply that by 101",
+                "draw me y=x*x",
+                "Now make it red",
+                "Thanks, that is all."]
+
+PLOT_CODE = """import numpy as np
+import matplotlib.pyplot as plt
+x = np.linspace(-10, 10, 200)
+fig, ax = plt.subplots()
+ax.plot(x, x * x, color='{color}')
+return_object = fig
+"""
+
+
+def bench_responder(continue_prompt):
+    """Scripted model answers to CONVERSATION, finishing each agent loop with converse."""
+    rules = [(r'what is (\d+) \+ (\d+)', lambda m: tool_call('add', first=int(m[1]), second=int(m[2]))),
+             (r'multiply that by (\d+)', lambda m: tool_call('multiply', first=2, second=int(m[1]))),
+             (r'draw', tool_call('python_exec', code=PLOT_CODE.format(color='blue'))),
+             (r'make it red', tool_call('python_exec', code=PLOT_CODE.format(color='red')))]
+    if continue_prompt:
+        rules.insert(0, (re.escape(continue_prompt), tool_call('converse', response="Done. Anything else?")))
+    return ScriptedResponder(rules)
+
+
+class SpanCollector:
+    """Tracing sink keeping the seconds of each span by stage, tools by 'tool:<name>'."""
+    def __init__(self):
+        self.seconds = {}
+
+    def emit(self, span):
+        name = span.name
+        if span.attributes.get('tool'):
+            name = f"tool:{span.attributes['tool']}"
+        self.seconds.setdefault(name, []).append(span.seconds)
+
+    def clear(self):
+        self.seconds = {}
+
+
+def percentile(values, q):
+    """The q-th percentile of values, interpolating between the closest ranks."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def bench_config(config_file, server_url, model_names, args):
+    """The app config, pointed at the fake server with nothing written outside a temp dir."""
+    config = Config(config_file)
+    for key, value in (('model_server_url', server_url), ('model_name_default', model_names[0]),
+                       ('model_server_check_interval', '1'), ('history_db', ''), ('tool_cache_db', ''),
+                       ('trace_file', ''), ('metrics_port', '0'), ('log_level', args.log_level),
+                       ('artifact_dir', tempfile.mkdtemp(prefix='bench_artifacts_')),
+                       ('agent_max_steps', str(args.max_steps)),
+                       ('response_cache', str(args.response_cache)),
+                       ('pre_router', str(not args.no_pre_router))):
+        config.set_value_by_key('chat', key, value)
+    config.set_value_by_key('my_tools', 'python_exec_workers', str(args.exec_workers))
+    return config
+
+
+async def run_sessions(engine, settings, model_names, session_prefix, sessions, turns):
+    """Run sessions concurrently, each a conversation of turns, returns the turn latencies."""
+    latencies = []
+
+    async def conversation(index):
+        model_name = model_names[index % len(model_names)]
+        for turn in range(turns):
+            start = time.perf_counter()
+            await engine.chat(f"{session_prefix}-{index}", CONVERSATION[turn % len(CONVERSATION)],
+                              model_name=model_name, streaming=True, settings=settings)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[conversation(index) for index in range(sessions)])
+    return latencies
+
+
+def report(collector, latencies, elapsed, args):
+    print(f"\n{'stage':<20} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    rows = [('turn (client)', latencies)] + sorted(collector.seconds.items())
+    for name, values in rows:
+        print(f"{name:<20} {len(values):>6} " +
+              " ".join(f"{percentile(values, q) * 1000:>9.1f}" for q in (50, 95, 99)))
+    print(f"\n{len(latencies)} turns from {args.sessions} sessions in {elapsed:.2f} s: "
+          f"{len(latencies) / elapsed:.1f} turns/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat engine against a stand-in Ollama server.")
+    parser.add_argument('--config', default='resources/cake_tool_bot/config.ini')
+    parser.add_argument('--sessions', type=int, default=4, help="Concurrent chat sessions.")
+    parser.add_argument('--turns', type=int, default=len(CONVERSATION), help="Turns per session.")
+    parser.add_argument('--models', default='bench-a:latest,bench-b:latest',
+                        help="Fake models, assigned to the sessions round robin.")
+    parser.add_argument('--first-token-delay', type=float, default=0.05)
+    parser.add_argument('--token-delay', type=float, default=0.002)
+    parser.add_argument('--prompt-token-delay', type=float, default=0.0001)
+    parser.add_argument('--load-delay', type=float, default=0.5)
+    parser.add_argument('--max-steps', type=int, default=4)
+    parser.add_argument('--exec-workers', type=int, default=2)
+    parser.add_argument('--response-cache', action='store_true', help="Answer repeated prompts from the response cache.")
+    parser.add_argument('--no-pre-router', action='store_true', help="Send arithmetic to the model too.")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the memory per session pass.")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    model_names = args.models.split(',')
+    server = FakeOllamaServer(models=model_names, respond=None, first_token_delay=args.first_token_delay,
+                              token_delay=args.token_delay, prompt_token_delay=args.prompt_token_delay,
+                              load_delay=args.load_delay).start()
+    engine = ChatEngine(bench_config(args.config, server.url, model_names, args), tools_init=my_tools_init)
+    server.respond = bench_responder(engine.agent_continue_prompt)
+    settings = SettingsCache()
+    settings.set({'allow_python_exec': True, 'allow_shell_exec': False, 'present_exec_dialog': False})
+    collector = SpanCollector()
+    tracer.add_sink(collector)
+
+    # Warm up: models loaded, exec workers started, chains built.
+    engine.model_cache.server_pool.wait_checked(timeout=10)
+    asyncio.run(run_sessions(engine, settings, model_names, 'warmup', len(model_names), len(CONVERSATION)))
+    collector.clear()
+
+    start = time.perf_counter()
+    latencies = asyncio.run(run_sessions(engine, settings, model_names, 'bench', args.sessions, args.turns))
+    report(collector, latencies, time.perf_counter() - start, args)
+
+    model_stats = engine.model_cache.get_stats()
+    print(f"Models: {model_stats['hits']} hits, {model_stats['misses']} misses, "
+          f"{model_stats['cold_loads']} cold loads")
+    tool_stats = engine.load_chain(model_names[0])[1].get_cache_stats()
+    print("Tool cache hits: " + ", ".join(f"{name} {counts['hit_rate']:.0%}"
+                                          for name, counts in tool_stats.items() if name != '_cache'))
+    if engine.pre_router is not None:
+        router_stats = engine.pre_router.get_stats()
+        print(f"Pre-router: {router_stats['routed']} routed, {router_stats['declined']} declined "
+              f"({router_stats['bypass_rate']:.0%} bypassed the model), ~{router_stats['seconds_saved']:.1f} s saved")
+    if engine.response_cache is not None:
+        response_stats = engine.response_cache.get_stats()
+        print(f"Response cache: {response_stats['exact_hits']} exact and {response_stats['near_hits']} near hits, "
+              f"{response_stats['misses']} misses, {response_stats['bypassed']} bypassed, "
+              f"{response_stats['seconds_saved']:.1f} s saved")
+    exec_pool = my_tools_exec_pool(engine.config)
+    if exec_pool is not None:
+        exec_stats = exec_pool.get_stats()
+        print(f"python_exec: {exec_stats['kernel_runs']} kernel runs, {exec_stats['worker_starts']} worker starts "
+              f"of {exec_stats['worker_start_mean_seconds']:.1f} s")
+
+    if not args.no_memory:
+        # Python heap of the engine per session: histories, windows, stats. Exec kernels are
+        # separate processes and not included.
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        asyncio.run(run_sessions(engine, settings, model_names, 'memory', args.sessions, args.turns))
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print(f"Memory: {used / args.sessions / 1024:.0f} KiB per session of {args.turns} turns")
+
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,59 +1,36 @@
 import streamlit as st
+import time
 import uuid
 
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.prompts import MessagesPlaceholder
-from langchain_community.chat_message_histories import StreamlitChatMessageHistory
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.output_parsers import JsonOutputParser
-from langchain.schema import AIMessage, HumanMessage, SystemMessage
-
-from llm_tools_manager import ToolReturn
+from llm_chat_engine import ChatEngine
 from llm_model_cache import ModelCache
-from my_tool_calls import my_tools_init, my_tools_get_option_keys
+from llm_process_cache import process_cached, config_mtime
+from llm_prompt_compiler import format_report
+from llm_tools_manager import SettingsCache, set_session_settings
+from my_tool_calls import my_tools_init, my_tools_get_tools, my_tools_get_option_keys
 from helper_st_background import st_helper_set_background_img
+from helper_artifact_store import is_artifact_ref
+from helper_st_chat_view import ChatView, render_chat_view
 from helper_st_tool_options import render_options, load_options
 from helper_st_tool_options import auto_prompt_isset, auto_prompt_set
+from helper_shell_exec import cancel_shell
 from config import Config
 
 
-prompt_about_environment = """Our runtime is using streamlit on python, so use streamlit for rendering. Mathplotlib is available. If software is missing, stop and ask me to install it using pip."""
-
-def chat_chain_load(model, tool_manager):
-    # We rely on global msgs for simplified debugging (needs cleanup imho)
-
-    parser =  JsonOutputParser(return_exceptions=True)
-    prompt = ChatPromptTemplate.from_messages(
-        [("system", tool_manager.get_format_instructions()),
-         ("system", parser.get_format_instructions()),
-         ("system", prompt_about_environment),
-         ("system", "{purpose_prompt}"),
-         MessagesPlaceholder(variable_name="history"),
-         ("user",   "{input}"),
-         ])
-    chain_front = prompt | model
-
-    # Docs: https://api.python.langchain.com/en/latest/runnables/langchain_core.runnables.history.RunnableWithMessageHistory.html
-    chain_with_history = RunnableWithMessageHistory(
-        chain_front,
-        lambda session_id: msgs,
-        input_messages_key="input",
-        history_messages_key="history",
-        ) | parser | tool_manager.tool_chain
-    return chain_with_history
-
-
 def render_session_id(st, st_selector):
 
     # Set up a Session ID
-    if 'session_list' not in st.session_state:
-        st.session_state.session_id = uuid.uuid4()
-        st.session_state.session_list = [st.session_state.session_id]
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = str(uuid.uuid4())
 
-    session_id = st_selector.selectbox("Session ID", [st.session_state.session_id] + ["(new)"] + st.session_state.session_list)
+    # Only the most recently used sessions are listed, the store may hold thousands.
+    session_list_size = int(config.get_value_by_key('chat_ui', 'session_list_size', 50))
+    session_list = [s for s in chat_engine.history_store.list_sessions(session_list_size)
+                    if s != st.session_state.session_id]
+
+    session_id = st_selector.selectbox("Session ID", [st.session_state.session_id] + ["(new)"] + session_list)
     if session_id == "(new)":
-        st.session_state.session_id = uuid.uuid4()
-        st.session_state.session_list.append(st.session_state.session_id)
+        st.session_state.session_id = str(uuid.uuid4())
         st.rerun()
 
     return session_id
@@ -64,26 +41,26 @@ def render_chat(st_chat_entry, st_chat, st_visuals):
     global config
 
     # Set up message history.
-    msgs = StreamlitChatMessageHistory(key=f"langchain_messages-{session_id}")
+    msgs = chat_engine.get_history(session_id)
     welcome_message = config.get_value_by_key('chat', 'initial_ai_welcome_prompt',
                                               "How can I help you?")
-    if len(msgs.messages) == 0:
-        if model_cache.settings_cache.get('auto_prompt_at_start', True):
+    if len(msgs) == 0:
+        if settings_cache.get('auto_prompt_at_start', True):
             auto_prompt_set(1, True)
         else:
             msgs.add_ai_message(welcome_message)
 
-    # Render the chat history.
+    # Render the newest part of the chat history, older messages are paged in on request.
     # We add our tool calls to history so the AI can see them, but we strip them for our chat here.
-    display_tools_calls = model_cache.settings_cache.get('display_tools_calls', False)
-    for msg in msgs.messages:
-        print(f"MSG: {msg}")
-        if msg.content.strip().startswith("Execution Attempt") and not display_tools_calls:
-            continue
-        # JSON Check if the message content begins with '{'
-        elif not msg.content.strip().startswith('{') or display_tools_calls:
-            render_chat_ai_new_container(st_chat, st_visuals, msg.type)
-            render_chat_msg(msg.type, msg.content, msg.additional_kwargs)
+    def render_message(msg):
+        render_chat_ai_new_container(st_chat, st_visuals, msg.type)
+        render_chat_msg(msg.type, msg.content, msg.additional_kwargs)
+
+    chat_views = st.session_state.setdefault('chat_views', {})
+    render_chat_view(st_chat, msgs, chat_views.setdefault(session_id, ChatView(hidden=[chat_engine.agent_continue_prompt])),
+                     settings_cache.get('display_tools_calls', False),
+                     int(config.get_value_by_key('chat_ui', 'render_page_size', 30)),
+                     f"chat_pages_{session_id}", render_message)
 
     # React to user input
     input = st_chat_entry.chat_input(config.get_value_by_key('chat', 'chat_input_label', "What is up?"))
@@ -94,33 +71,74 @@ def render_chat(st_chat_entry, st_chat, st_visuals):
             st_chat.chat_message("user").write(input)
         else:
             input=""
-        #msgs.add_user_message(input)
-
-        # Invoke chain to get reponse.
-        chain_config = {"configurable": {"session_id": session_id}}
 
         render_chat_ai_new_container(st_chat, st_visuals, "assistant")
-        
-        # We do a few re-tries and warn - if it triggers it is worth debugging why
-        response = None
-        for attempt in range(3):
-            try:
-                response = chain_with_history.invoke(
-                    {'input': input,
-                     'purpose_prompt': config.get_value_by_key('chat', 'purpose_prompt') },
-                    chain_config)
-
-                # Display AI assistant response and save to message history.
-                render_chat_ai_callback(response)
-
-                break
-            except Exception as e:
-                # Feed error back to user display, and into chat history so LLM see it.
-                error_str = f"Execution Attempt {attempt +1} failed, error: {e}"
-                render_chat_ai_callback(error_str)
-                if attempt == 2:  # If the last attempt fails, raise the exception
-                    st_chat.error("All attempts failed. Please try again later.")
-                    raise
+
+        # The engine does a few re-tries, feeding errors back to the display and into chat
+        # history so the LLM sees them. If it triggers it is worth debugging why.
+        status = st_chat.empty()
+
+        def on_tool(tool_name):
+            if tool_name != 'converse':
+                status.caption(f"Calling {tool_name}...")
+
+        # Follow up steps run within this invocation (see AgentLoop), each streamed into a new message.
+        stream_writer = [render_chat_ai_stream_writer(st_chat)]
+
+        def on_step(step, tool_names):
+            stream_writer[0] = render_chat_ai_stream_writer(st_chat)
+            status.caption(f"Step {step + 1}, after {', '.join(tool_names)}...")
+
+        # Shell output is shown live while the command runs.
+        settings_cache.set({'tool_output_callback': render_tool_output_writer(st_chat)})
+        try:
+            chat_engine.invoke(session_id, input, st.session_state.model_name,
+                               on_response=render_chat_ai_response,
+                               streaming=settings_cache.get('stream_responses', False),
+                               on_text=lambda text: stream_writer[0](text),
+                               on_tool=on_tool,
+                               settings=settings_cache,
+                               max_steps=None if settings_cache.get('auto_prompt', False) else 1,
+                               on_step=on_step)
+        except Exception:
+            st_chat.error("All attempts failed. Please try again later.")
+            raise
+        finally:
+            # With the exec dialog the command runs in its Allow callback on the next rerun, before
+            # the chat is rendered, so a fresh writer shows its output at the top of that page.
+            settings_cache.set({'tool_output_callback': render_tool_output_writer(st)})
+            status.empty()
+
+def render_chat_ai_stream_writer(st_chat):
+    """ Returns an on_text callback writing the streamed text into a single new chat message."""
+    placeholder = None
+
+    def on_text(text):
+        nonlocal placeholder
+        if placeholder is None:
+            placeholder = st_chat.chat_message("assistant").empty()
+        placeholder.write(text)
+
+    return on_text
+
+def render_tool_output_writer(st_chat, max_lines=20, interval=0.2):
+    """ Returns a tool_output_callback showing the last lines of a running command's output."""
+    placeholder = None
+    lines = []
+    last_update = 0.0
+
+    def on_line(stream_name, line):
+        nonlocal placeholder, last_update
+        lines.append(line.rstrip('\n'))
+        del lines[:-max_lines]
+        if time.perf_counter() - last_update < interval:
+            return
+        last_update = time.perf_counter()
+        if placeholder is None:
+            placeholder = st_chat.empty()
+        placeholder.code("\n".join(lines))
+
+    return on_line
 
 st_chat_ai_chat_container    = None
 st_chat_ai_visuals_container = None
@@ -151,52 +169,64 @@ def render_chat_msg(msg_type, content, additional_kwargs):
     if additional_kwargs != None:
         for key, value in additional_kwargs.items():
             #visuals_container.write(key)
-            visuals_container.write(value)
-
-def render_chat_ai_private_note(response_str, additional_kwargs):
-    """ Write the assistant a note about tools execution if it was (probably) successful but unknown to it."""
-    global msgs
+            render_artifact(visuals_container, value)
+
+def render_artifact(container, value):
+    """ Render a tool returned object, loading it from the artifact store if it is a reference."""
+    if not is_artifact_ref(value):
+        container.write(value)
+        return
+    try:
+        obj = chat_engine.artifact_store.load(value)
+    except OSError:
+        container.caption(f"Missing artifact: {value.get('summary', '')}")
+        return
+    if value['kind'] == 'png':
+        container.image(obj)
+    else:
+        container.write(obj)
 
-    response_str = str(response_str)
-    if response_str.strip() == "" and len(additional_kwargs) != 0:
-        msgs.add_message(AIMessage(content="{'private assistant note': tool executed successfully and return an object to user.'}"))
+def render_chat_ai_response(message, additional_kwargs, rendered=False):
+    """ Display an AI assistant response the engine has saved to message history."""
+    render_chat_msg("assistant", "" if rendered else message, additional_kwargs)
 
 def render_chat_ai_callback(response):
-    global msgs
-
-    additional_kwargs: dict = {}
-
-    # response is of type str, or a ToolReturn
-    if isinstance(response, ToolReturn):
-        message = response.message
-        if response.data != None:
-            additional_kwargs = response.data
-    else:
-        message = response
-
-    render_chat_ai_private_note(message, additional_kwargs)
-    render_chat_msg("assistant", message, additional_kwargs)
-    msgs.add_message(AIMessage(content=message, additional_kwargs=additional_kwargs))
+    """ Save and display a response produced outside the chain, e.g. after the exec dialog."""
+    message, additional_kwargs = chat_engine.add_response(session_id, response)
+    render_chat_ai_response(message, additional_kwargs)
 
 
 # Load config and set up state
-config = Config('resources/cake_tool_bot/config.ini')
-
-# Check if 'model_cache' is in the session state, and if not, initialize it.
-if 'model_cache' not in st.session_state:
-    st.session_state.model_cache = ModelCache(config)
-model_cache: ModelCache = st.session_state.model_cache
-model, tool_manager = model_cache.load_model(model_cache.current_model_name)
-
-load_options(model_cache, keys=my_tools_get_option_keys())
+rerun_start = time.perf_counter()
+config_file = 'resources/cake_tool_bot/config.ini'
+
+# The engine (config, models, tools and chains) is built once per process and shared by all
+# browser sessions. It is only rebuilt when the tool set or the config file changes.
+chat_engine: ChatEngine = process_cached(
+    ('chat_engine', config_file),
+    (tuple(tool.name for tool in my_tools_get_tools()), config_mtime(config_file)),
+    lambda: ChatEngine(Config(config_file), tools_init=my_tools_init))
+config = chat_engine.config
+model_cache: ModelCache = chat_engine.model_cache
+
+# Options and callbacks are per browser session.
+if 'settings_cache' not in st.session_state:
+    st.session_state.settings_cache = SettingsCache()
+settings_cache: SettingsCache = st.session_state.settings_cache
+set_session_settings(settings_cache)
+
+if 'model_name' not in st.session_state:
+    st.session_state.model_name = model_cache.current_model_name
+chat_engine.load_chain(st.session_state.model_name)
+
+load_options(settings_cache, config, keys=my_tools_get_option_keys())
 chat_options = [('chat_objects_inline', 'Render objects in chat'),
                 ('auto_prompt_at_start', 'Automatic prompt at start'),
                 ('auto_prompt', 'Automatic prompting for follow up'),
-                ('display_tools_calls', 'Display calls'),]
-load_options(model_cache, keys=chat_options)
-my_tools_init(tool_manager, model_cache)
-
-chain_with_history = chat_chain_load(model, tool_manager)
+                ('display_tools_calls', 'Display calls'),
+                ('stream_responses', 'Stream responses'),]
+load_options(settings_cache, config, keys=chat_options)
+rerun_setup_seconds = time.perf_counter() - rerun_start
 
 st.set_page_config(page_title = config.get_value_by_key('ui', 'page_title'),
                    page_icon  = config.get_value_by_key('ui', 'page_icon'),
@@ -209,12 +239,16 @@ st_helper_set_background_img(config.get_value_by_key('ui', 'page_background_imag
 st.title(config.get_value_by_key('chat_ui', 'window_name', "Chatbot with tools"))
 
 session_id = render_session_id(st, st.sidebar)
+# Rendered before the chat, so it can be clicked while a command runs: the click starts a rerun
+# (immediately, with runner.fastReruns) whose callback cancels the session's running command.
+st.sidebar.button("Stop command", on_click=cancel_shell, args=(session_id,),
+                  help="Stop the shell command running in this session.")
 
 # Global message store for chat
 msgs = {}
-model_cache.settings_cache.set({'chat_ai_callback': render_chat_ai_callback})
+settings_cache.set({'chat_ai_callback': render_chat_ai_callback})
 
-if model_cache.settings_cache.get('chat_objects_inline', False) == False:
+if settings_cache.get('chat_objects_inline', False) == False:
     st_chat, st_visuals = st.columns([2,1], vertical_alignment="bottom")
 else:
     st_chat    = st.container()
@@ -222,12 +256,39 @@ else:
 
 render_chat(st, st_chat, st_visuals)
 
-def on_model_change(key):
-    model_cache.current_model_name = st.session_state[key]
-
 # Sidebar for model selection
-model_cache.current_model_name = st.sidebar.selectbox("Choose a model", [model_cache.current_model_name] + model_cache.available_models, key='model_name', args='model_name')
-print(f"MODEL NAME is {model_cache.current_model_name}")
+st.sidebar.selectbox("Choose a model", [st.session_state.model_name] + model_cache.available_models, key='model_name')
+if session_id in chat_engine.stream_stats:
+    st.sidebar.caption(f"Time to first token: {chat_engine.stream_stats[session_id]['time_to_first_token'] * 1000:.0f} ms")
+if session_id in chat_engine.eval_stats:
+    st.sidebar.caption(f"Last turn: {chat_engine.eval_stats[session_id].summary()}")
+if session_id in chat_engine.agent_summaries:
+    st.sidebar.caption(f"Agent: {chat_engine.agent_summaries[session_id]}")
+if session_id in chat_engine.prompt_reports:
+    st.sidebar.caption(f"Prompt tokens: {format_report(chat_engine.prompt_reports[session_id])}")
+if chat_engine.model_cache.server_pool.hedge:
+    hedge_stats = chat_engine.model_cache.server_pool.get_hedge_stats()
+    st.sidebar.caption(f"Hedged: {hedge_stats['hedge_rate']:.0%} of requests, "
+                       f"hedge won {hedge_stats['hedge_win_rate']:.0%}, "
+                       f"delay {hedge_stats['hedge_delay'] * 1000:.0f} ms")
+model_stats = model_cache.get_stats()
+model_caption = f"Models: {model_stats['hits']} hits, {model_stats['misses']} misses, {model_stats['evictions']} evicted"
+if model_stats['last_cold_load']:
+    model_caption += f", cold load of {model_stats['last_cold_load'][0]} {model_stats['last_cold_load'][1]:.1f} s"
+st.sidebar.caption(model_caption)
+tool_stats = chat_engine.load_chain(st.session_state.model_name)[1].get_cache_stats()
+tool_hit_rates = [f"{name} {counts['hit_rate']:.0%}" for name, counts in tool_stats.items() if name != '_cache']
+if tool_hit_rates:
+    st.sidebar.caption(f"Tool cache hits: {', '.join(tool_hit_rates)}")
+if chat_engine.pre_router is not None:
+    router_stats = chat_engine.pre_router.get_stats()
+    st.sidebar.caption(f"Pre-router: {router_stats['bypass_rate']:.0%} of messages bypassed the model, "
+                       f"~{router_stats['seconds_saved']:.1f} s saved")
+if chat_engine.response_cache is not None:
+    response_stats = chat_engine.response_cache.get_stats()
+    st.sidebar.caption(f"Response cache: {response_stats['hit_rate']:.0%} hits "
+                       f"({response_stats['near_hits']} near), {response_stats['seconds_saved']:.1f} s saved")
+st.sidebar.caption(f"Rerun setup: {rerun_setup_seconds * 1000:.1f} ms")
 
 # Define the clear_cache function
 def clear_cache():
@@ -240,5 +301,5 @@ def clear_cache():
 if st.sidebar.button("Clear message cache"):
     clear_cache()
 st_options_extra = st.sidebar.expander("Extra Options", expanded=True)
-render_options(model_cache, st, st_options_extra, keys=my_tools_get_option_keys())
-render_options(model_cache, st, st_options_extra, keys=chat_options)
+render_options(settings_cache, config, st, st_options_extra, keys=my_tools_get_option_keys())
+render_options(settings_cache, config, st, st_options_extra, keys=chat_options)
@@ -0,0 +1,119 @@
+# Content addressed store for objects returned by tools.
+#
+# Figures, data frames and other objects are serialized once (figures to PNG, frames to
+# Parquet) into files named by the SHA-256 of their bytes, so identical artifacts are stored
+# once. Chat messages keep only a small reference dict, and objects are decoded lazily when
+# rendered, with the most recently used ones kept in memory.
+
+import io
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+ARTIFACT_KEY = 'artifact'
+
+
+def is_artifact_ref(value):
+    return isinstance(value, dict) and ARTIFACT_KEY in value and 'kind' in value
+
+
+class ArtifactStore:
+    def __init__(self, root_dir='artifacts', cache_items=32):
+        """
+        Args:
+        - root_dir (str): Directory the artifact files are written to.
+        - cache_items (int): Decoded artifacts kept in memory.
+        """
+        self.root_dir = root_dir
+        self.cache_items = cache_items
+        self.cache = OrderedDict()   # digest: decoded object
+        self.lock = threading.Lock()
+        self.stats = {'puts': 0, 'stored': 0, 'hits': 0, 'loads': 0}
+
+    def _path(self, digest, kind):
+        return os.path.join(self.root_dir, digest[:2], f"{digest}.{kind}")
+
+    def _serialize(self, obj):
+        """Returns the kind (file extension) and bytes of obj, and a short summary for display."""
+        type_name = f"{type(obj).__module__}.{type(obj).__name__}"
+        if type_name == 'matplotlib.figure.Figure':
+            buffer = io.BytesIO()
+            obj.savefig(buffer, format='png', bbox_inches='tight')
+            import matplotlib.pyplot as plt
+            plt.close(obj)
+            return 'png', buffer.getvalue(), "figure"
+        if type_name in ('pandas.core.frame.DataFrame', 'pandas.core.series.Series'):
+            frame = obj.to_frame() if type_name.endswith('Series') else obj
+            try:
+                buffer = io.BytesIO()
+                frame.to_parquet(buffer)
+                return 'parquet', buffer.getvalue(), f"data frame {frame.shape}"
+            except (ImportError, ValueError, TypeError):
+                return 'csv', frame.to_csv().encode(), f"data frame {frame.shape}"
+        if isinstance(obj, str):
+            return 'txt', obj.encode(), f"text ({len(obj)} characters)"
+        try:
+            return 'pickle', pickle.dumps(obj), type(obj).__name__
+        except Exception:
+            return 'txt', repr(obj).encode(), type(obj).__name__
+
+    def _deserialize(self, kind, data):
+        if kind == 'png':
+            return data
+        if kind == 'parquet':
+            import pandas as pd
+            return pd.read_parquet(io.BytesIO(data))
+        if kind == 'csv':
+            import pandas as pd
+            return pd.read_csv(io.BytesIO(data), index_col=0)
+        if kind == 'pickle':
+            return pickle.loads(data)
+        return data.decode()
+
+    def put(self, obj):
+        """
+        Store obj, returns its reference: a dict with the 'artifact' digest, its 'kind' and a
+        'summary'. Storing an identical artifact again only returns the reference.
+        """
+        kind, data, summary = self._serialize(obj)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest, kind)
+        with self.lock:
+            self.stats['puts'] += 1
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self.stats['stored'] += 1
+        return {ARTIFACT_KEY: digest, 'kind': kind, 'summary': summary}
+
+    def put_all(self, data):
+        """Replace the values of a ToolReturn data dict with artifact references."""
+        if not data:
+            return data
+        return {key: value if is_artifact_ref(value) else self.put(value) for key, value in data.items()}
+
+    def load(self, ref):
+        """The decoded object of a reference, PNG figures are returned as bytes."""
+        digest = ref[ARTIFACT_KEY]
+        with self.lock:
+            if digest in self.cache:
+                self.cache.move_to_end(digest)
+                self.stats['hits'] += 1
+                return self.cache[digest]
+        with open(self._path(digest, ref['kind']), 'rb') as f:
+            obj = self._deserialize(ref['kind'], f.read())
+        with self.lock:
+            self.stats['loads'] += 1
+            self.cache[digest] = obj
+            while len(self.cache) > self.cache_items:
+                self.cache.popitem(last=False)
+        return obj
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, cached=len(self.cache))
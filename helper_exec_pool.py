@@ -0,0 +1,390 @@
+# Pool of warm Python worker processes for running generated code.
+#
+# Each worker is a separate interpreter running this file. It imports the configured heavy
+# modules once at start, then runs code sent to it over its stdin/stdout pipes, so an exec
+# pays neither the import cost nor blocks (or crashes) the Streamlit server. Requests and
+# results are length prefixed pickles; the worker's own fd 1 is redirected to stderr so stray
+# output can't corrupt the channel. Timeouts use select() on the pipe, so this is POSIX only.
+#
+# A worker can also be dedicated to a session as its kernel, keeping its globals between runs
+# so follow up code only computes what changed.
+
+import logging
+import os
+import sys
+import time
+import json
+import queue
+import pickle
+import select
+import struct
+import threading
+import traceback
+import subprocess
+from collections import OrderedDict
+from io import StringIO
+from contextlib import redirect_stdout
+
+logger = logging.getLogger(__name__)
+
+RETURN_VARIABLES = ['return_object', 'csv_object']
+MAX_VARIABLES = 30
+
+
+def _send(stream, message):
+    blob = pickle.dumps(message)
+    stream.write(struct.pack('>I', len(blob)) + blob)
+    stream.flush()
+
+def _read_exact(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError("Worker channel closed")
+        data += chunk
+    return data
+
+def _recv(stream):
+    size, = struct.unpack('>I', _read_exact(stream, 4))
+    return pickle.loads(_read_exact(stream, size))
+
+
+class ExecWorker:
+    """One worker process, see ExecWorkerPool."""
+    def __init__(self, preload=(), memory_limit_mb=None):
+        self.start_time = time.perf_counter()
+        self.ready_time = None
+        self.runs = 0
+        self.last_used = time.time()
+        self.variables = []   # kernel globals, as of the last run
+        self.lock = threading.Lock()
+        options = {'preload': list(preload), 'memory_limit_mb': memory_limit_mb}
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), json.dumps(options)],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        env={**os.environ, 'MPLBACKEND': 'Agg'})
+
+    def _recv(self, timeout):
+        readable, _, _ = select.select([self.process.stdout], [], [], timeout)
+        if not readable:
+            raise TimeoutError(f"No result within {timeout} s")
+        return _recv(self.process.stdout)
+
+    def wait_ready(self, timeout=None):
+        """Wait for the preload to finish, returns the seconds the worker took to start."""
+        kind, preload_errors = self._recv(timeout)
+        for error in preload_errors:
+            logger.warning("Exec worker preload failed: %s", error)
+        self.ready_time = time.perf_counter()
+        return self.ready_time - self.start_time
+
+    def run(self, code, timeout=None, persistent=False):
+        """Returns kind ('ok' or 'error'), stdout and the returned variables (or traceback)."""
+        _send(self.process.stdin, ('exec', code, persistent))
+        self.runs += 1
+        self.last_used = time.time()
+        kind, stdout, payload, variables = self._recv(timeout)
+        self.variables = variables
+        return kind, stdout, payload
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class ExecWorkerPool:
+    """
+    A fixed number of warm worker processes. run() dispatches code to an idle worker with a
+    wall clock timeout (the worker is killed and replaced when it is exceeded) and a memory
+    limit (RLIMIT_AS in the worker). Workers are recycled after max_runs runs.
+
+    stats tracks warm runs (a worker was ready when the request came in) and cold runs (the
+    request waited for a worker to start), with their latencies, and the worker start times.
+
+    Runs with a session_id go to that session's kernel: a worker taken from the pool (and
+    replaced there) that keeps its globals until reset(), until it is idle for
+    kernel_idle_seconds, or until max_kernels newer sessions push it out.
+    """
+    def __init__(self, size=2, preload=(), timeout=60.0, memory_limit_mb=None, max_runs=20,
+                 kernel_idle_seconds=1800.0, max_kernels=8):
+        """
+        Args:
+        - size (int): Number of worker processes.
+        - preload (list): Modules each worker imports at start, e.g. numpy, matplotlib.pyplot.
+        - timeout (float): Wall clock seconds a run may take.
+        - memory_limit_mb (int): Address space limit of a worker, None for no limit.
+        - max_runs (int): Runs after which a worker is replaced by a fresh one.
+        - kernel_idle_seconds (float): Idle time after which a session kernel is shut down.
+        - max_kernels (int): Session kernels kept, least recently used ones are shut down.
+        """
+        self.size = size
+        self.preload = list(preload)
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.max_runs = max_runs
+        self.kernel_idle_seconds = kernel_idle_seconds
+        self.max_kernels = max_kernels
+        self.idle = queue.Queue()
+        self.kernels = OrderedDict()   # session id: ExecWorker
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.stats = {'warm_runs': 0, 'warm_seconds': 0.0, 'cold_runs': 0, 'cold_seconds': 0.0,
+                      'worker_starts': 0, 'worker_start_seconds': 0.0, 'timeouts': 0, 'recycled': 0,
+                      'kernel_runs': 0, 'kernels_expired': 0}
+        for _ in range(size):
+            self._start_worker()
+        threading.Thread(target=self._reap_loop, daemon=True).start()
+
+    def _start_worker(self):
+        """Start a worker in the background, it joins the idle queue once its preload is done."""
+        if self.closed.is_set():
+            return
+
+        def start():
+            worker = ExecWorker(self.preload, self.memory_limit_mb)
+            try:
+                seconds = worker.wait_ready(timeout=max(self.timeout, 60))
+            except Exception as err:
+                logger.warning("Exec worker failed to start: %s", err)
+                worker.kill()
+                if not self.closed.wait(1):
+                    self._start_worker()
+                return
+            with self.lock:
+                self.stats['worker_starts'] += 1
+                self.stats['worker_start_seconds'] += seconds
+            self._put_idle(worker)
+        threading.Thread(target=start, daemon=True).start()
+
+    def _put_idle(self, worker):
+        # Workers finishing after close() are killed, not kept.
+        if self.closed.is_set():
+            worker.kill()
+        else:
+            self.idle.put(worker)
+
+    def _take_idle(self):
+        """An idle worker, raising TimeoutError when none is ready within a worker start time."""
+        timeout = max(self.timeout, 60)
+        try:
+            return self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No python worker became ready within {timeout:.0f} s") from None
+
+    def _kernel(self, session_id):
+        """The session's kernel, dedicating an idle worker to it if it has none."""
+        with self.lock:
+            worker = self.kernels.get(session_id)
+            if worker is not None:
+                self.kernels.move_to_end(session_id)
+                return worker
+        worker = self._take_idle()
+        with self.lock:
+            # A concurrent first run of the session may have dedicated a worker meanwhile.
+            kernel = self.kernels.get(session_id)
+            if kernel is None:
+                self.kernels[session_id] = worker
+            evicted = []
+            while len(self.kernels) > self.max_kernels:
+                evicted.append(self.kernels.popitem(last=False)[1])
+        if kernel is not None:
+            self._put_idle(worker)
+            return kernel
+        self._start_worker()
+        for old_worker in evicted:
+            old_worker.kill()
+        return worker
+
+    def reset(self, session_id):
+        """Shut down the session's kernel, its next run starts from empty globals."""
+        with self.lock:
+            worker = self.kernels.pop(session_id, None)
+        if worker is not None:
+            worker.kill()
+
+    def variables(self, session_id):
+        """
+        Returns:
+        - list: Descriptions ("name: type ...") of the globals in the session's kernel.
+        """
+        with self.lock:
+            worker = self.kernels.get(session_id)
+        return list(worker.variables) if worker is not None else []
+
+    def _reap_loop(self):
+        while not self.closed.wait(min(60.0, max(1.0, self.kernel_idle_seconds / 2))):
+            self._reap_kernels()
+
+    def _reap_kernels(self):
+        now = time.time()
+        with self.lock:
+            expired = [session_id for session_id, worker in self.kernels.items()
+                       if now - worker.last_used > self.kernel_idle_seconds and not worker.lock.locked()]
+            workers = [self.kernels.pop(session_id) for session_id in expired]
+            self.stats['kernels_expired'] += len(workers)
+        for worker in workers:
+            worker.kill()
+
+    def _run_kernel(self, code, session_id):
+        worker = self._kernel(session_id)
+        with worker.lock:
+            try:
+                kind, stdout, payload = worker.run(code, self.timeout, persistent=True)
+            except Exception as err:
+                # The kernel's state is lost with it, the next run starts a fresh one.
+                with self.lock:
+                    if self.kernels.get(session_id) is worker:
+                        del self.kernels[session_id]
+                    if isinstance(err, TimeoutError):
+                        self.stats['timeouts'] += 1
+                worker.kill()
+                raise
+        with self.lock:
+            self.stats['kernel_runs'] += 1
+        if kind == 'error':
+            raise RuntimeError(payload)
+        return stdout, payload
+
+    def run(self, code, session_id=None):
+        """
+        Run code in a worker, or in the session's kernel if session_id is given.
+
+        Returns:
+        - tuple: stdout and a dict of the RETURN_VARIABLES the code set. Objects that can't be
+          pickled are returned as their repr().
+
+        Raises:
+        - TimeoutError: The run took longer than timeout, the worker was replaced, or no worker
+          became ready (e.g. workers keep failing to start).
+        - RuntimeError: The code raised, with the worker's traceback as message.
+        """
+        if session_id is not None:
+            return self._run_kernel(code, session_id)
+
+        start = time.perf_counter()
+        worker = self._take_idle()
+        warm = worker.ready_time <= start
+        try:
+            kind, stdout, payload = worker.run(code, self.timeout)
+        except TimeoutError:
+            with self.lock:
+                self.stats['timeouts'] += 1
+            worker.kill()
+            self._start_worker()
+            raise
+        except Exception:
+            worker.kill()
+            self._start_worker()
+            raise
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.stats['warm_runs' if warm else 'cold_runs'] += 1
+            self.stats['warm_seconds' if warm else 'cold_seconds'] += seconds
+
+        if worker.runs >= self.max_runs or not worker.alive():
+            with self.lock:
+                self.stats['recycled'] += 1
+            worker.kill()
+            self._start_worker()
+        else:
+            self._put_idle(worker)
+
+        if kind == 'error':
+            raise RuntimeError(payload)
+        return stdout, payload
+
+    def get_stats(self):
+        """
+        Returns:
+        - dict: The run counts with the mean warm, cold and worker start seconds.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats['kernels'] = len(self.kernels)
+        for kind, count in (('warm', 'warm_runs'), ('cold', 'cold_runs'), ('worker_start', 'worker_starts')):
+            stats[f'{kind}_mean_seconds'] = stats[f'{kind}_seconds'] / stats[count] if stats[count] else 0.0
+        return stats
+
+    def close(self):
+        """Kill the workers and kernels, and stop the reaper."""
+        self.closed.set()
+        with self.lock:
+            workers = list(self.kernels.values())
+            self.kernels.clear()
+        for worker in workers:
+            worker.kill()
+        while True:
+            try:
+                self.idle.get_nowait().kill()
+            except queue.Empty:
+                break
+
+
+def _portable(value):
+    try:
+        pickle.dumps(value)
+        return value
+    except Exception:
+        return repr(value)
+
+def _describe(name, value):
+    text = f"{name}: {type(value).__name__}"
+    shape = getattr(value, 'shape', None)
+    if isinstance(shape, tuple):
+        text += f" shape {shape}"
+    elif isinstance(value, (list, tuple, dict, set, str)):
+        text += f" len {len(value)}"
+    return text
+
+def _variables(namespace):
+    names = [name for name, value in namespace.items()
+             if not name.startswith('_') and type(value).__name__ != 'module']
+    return [_describe(name, namespace[name]) for name in names[:MAX_VARIABLES]]
+
+def _worker_main(options):
+    channel_in = sys.stdin.buffer
+    channel_out = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+
+    preload_errors = []
+    for module in options['preload']:
+        try:
+            __import__(module)
+        except Exception as err:
+            preload_errors.append(f"{module}: {err}")
+    if options.get('memory_limit_mb'):
+        try:
+            import resource
+            limit = int(options['memory_limit_mb']) * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError) as err:
+            preload_errors.append(f"memory limit: {err}")
+    _send(channel_out, ('ready', preload_errors))
+
+    kernel = {'__name__': '__main__'}
+    while True:
+        try:
+            kind, code, persistent = _recv(channel_in)
+        except EOFError:
+            return
+        stdout = StringIO()
+        namespace = kernel if persistent else {'__name__': '__main__'}
+        # Only objects returned by this run are sent back.
+        for name in RETURN_VARIABLES:
+            namespace.pop(name, None)
+        try:
+            with redirect_stdout(stdout):
+                exec(code, namespace)
+            returned = {name: _portable(namespace[name]) for name in RETURN_VARIABLES if name in namespace}
+            reply = ('ok', stdout.getvalue(), returned)
+        except BaseException:
+            reply = ('error', stdout.getvalue(), traceback.format_exc(limit=-3))
+        _send(channel_out, reply + (_variables(namespace) if persistent else [],))
+
+
+if __name__ == '__main__':
+    _worker_main(json.loads(sys.argv[1]))
@@ -0,0 +1,182 @@
+# Record and replay of Ollama traffic.
+#
+# CassetteTransport sits between CakeOllama and the OllamaServerPool (it has the same
+# stream_lines()/astream_lines()). In record mode it passes requests on and writes each
+# completed streamed response, with the arrival time of every line, to a cassette file. In
+# replay mode it serves the recorded lines without a server, at the original pace, scaled, or
+# instantly, so a whole conversation re-runs deterministically in milliseconds.
+#
+# Recordings are keyed by a hash of the request path and its normalized payload: model,
+# prompt or messages, format and options, without keep_alive and unset values. Identical
+# requests replay their recordings in order, repeating the last one.
+
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Payload keys that don't change the response.
+VOLATILE_KEYS = ('keep_alive', 'stream')
+
+
+class CassetteMiss(KeyError):
+    pass
+
+
+def _normalize(value):
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()
+                if item is not None and item != [] and key not in VOLATILE_KEYS}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    if isinstance(value, str):
+        return "\n".join(line.rstrip() for line in value.strip().splitlines())
+    return value
+
+def cassette_key(path, payload):
+    """Hash of a request, equal for requests that differ only in volatile keys or trailing whitespace."""
+    normalized = json.dumps([path, _normalize(payload)], sort_keys=True, default=str)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+class Cassette:
+    """A JSON lines file of recordings: key, path, model and the (seconds, line) of the response."""
+    def __init__(self, path):
+        self.path = path
+        self.recordings = {}   # key: list of recordings
+        self.replayed = {}     # key: recordings served so far
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        recording = json.loads(line)
+                        self.recordings.setdefault(recording['key'], []).append(recording)
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, key):
+        return key in self.recordings
+
+    def next(self, key):
+        """The next recording for key, the last one once all were served."""
+        with self.lock:
+            recordings = self.recordings.get(key)
+            if not recordings:
+                raise CassetteMiss(key)
+            index = self.replayed.get(key, 0)
+            self.replayed[key] = index + 1
+            return recordings[min(index, len(recordings) - 1)]
+
+    def add(self, recording):
+        with self.lock:
+            self.recordings.setdefault(recording['key'], []).append(recording)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(recording) + "\n")
+
+
+class CassetteTransport:
+    """
+    Modes:
+    - 'record': Pass requests to the inner transport, recording their responses.
+    - 'replay': Serve recorded responses only, raising CassetteMiss for an unknown request.
+    - 'auto': Replay known requests, record the others.
+    """
+    def __init__(self, inner, cassette, mode='auto', timing=1.0):
+        """
+        Args:
+        - inner: OllamaServerPool (or anything with stream_lines/astream_lines), None to replay only.
+        - cassette (Cassette): Where recordings are kept.
+        - mode (str): 'record', 'replay' or 'auto'.
+        - timing (float): Scale of the recorded delays when replaying, 1 for the original pace
+          and 0 to replay instantly.
+        """
+        if mode not in ('record', 'replay', 'auto'):
+            raise ValueError(f"Unknown cassette mode {mode}")
+        self.inner = inner
+        self.cassette = cassette
+        self.mode = mode
+        self.timing = timing
+        self.stats = {'recorded': 0, 'replayed': 0}
+
+    def _replaying(self, key):
+        return self.mode == 'replay' or (self.mode == 'auto' and key in self.cassette)
+
+    def _recording(self, key, path, payload):
+        return {'key': key, 'path': path, 'model': payload.get('model'), 'lines': []}
+
+    def _finish(self, recording):
+        self.cassette.add(recording)
+        self.stats['recorded'] += 1
+
+    def stream_lines(self, path, payload, headers=None, auth=None, check_status=None):
+        """Same as OllamaServerPool.stream_lines(), served from or recorded to the cassette."""
+        key = cassette_key(path, payload)
+        if self._replaying(key):
+            return self._replay(self.cassette.next(key))
+        if self.inner is None:
+            raise CassetteMiss(key)
+        return self._record(self.inner.stream_lines(path, payload, headers, auth, check_status),
+                            self._recording(key, path, payload))
+
+    def _replay(self, recording):
+        self.stats['replayed'] += 1
+        start = time.perf_counter()
+        for seconds, line in recording['lines']:
+            delay = seconds * self.timing - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            yield line
+
+    def _record(self, lines, recording):
+        start = time.perf_counter()
+        for line in lines:
+            recording['lines'].append((time.perf_counter() - start, line))
+            yield line
+        # Only responses read to the end are kept, not cancelled ones.
+        self._finish(recording)
+
+    async def astream_lines(self, path, payload, headers=None, auth=None, check_status=None):
+        """Async version of stream_lines()."""
+        key = cassette_key(path, payload)
+        if self._replaying(key):
+            recording = self.cassette.next(key)
+            self.stats['replayed'] += 1
+            start = time.perf_counter()
+            for seconds, line in recording['lines']:
+                delay = seconds * self.timing - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield line
+            return
+        if self.inner is None:
+            raise CassetteMiss(key)
+        recording = self._recording(key, path, payload)
+        start = time.perf_counter()
+        async for line in self.inner.astream_lines(path, payload, headers, auth, check_status):
+            recording['lines'].append((time.perf_counter() - start, line))
+            yield line
+        self._finish(recording)
+
+    def get_stats(self):
+        return dict(self.stats, recordings=sum(len(r) for r in self.cassette.recordings.values()))
+
+
+def cassette_transport(config, server_pool):
+    """
+    The transport for model requests: server_pool, or a CassetteTransport around it when
+    [chat] cassette_file is set (cassette_mode, cassette_timing).
+    """
+    cassette_file = config.get_value_by_key('chat', 'cassette_file', '')
+    if not cassette_file:
+        return server_pool
+    mode = config.get_value_by_key('chat', 'cassette_mode', 'auto')
+    logger.info("Ollama requests %s cassette %s", {'record': 'recorded to', 'replay': 'replayed from',
+                                                    'auto': 'replayed from or recorded to'}.get(mode, mode),
+                cassette_file)
+    return CassetteTransport(server_pool, Cassette(cassette_file), mode,
+                             timing=float(config.get_value_by_key('chat', 'cassette_timing', 1.0)))
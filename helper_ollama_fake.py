@@ -0,0 +1,232 @@
+# Local stand-in for an Ollama server.
+#
+# Serves /api/tags, /api/ps, /api/generate and /api/chat from a background thread with scripted,
+# latency configurable responses, so the HTTP client, server pool and chat chain can be exercised
+# offline without a model:
+#
+#   server = FakeOllamaServer(models=['mistral:instruct']).start()
+#   client = OllamaClient(server.url)
+
+import os
+import re
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def converse_response(body):
+    """Default script: answer every prompt with a converse tool call."""
+    return json.dumps({"tool": "converse", "args": {"response": "Meow. How can I help you?"}})
+
+
+def last_user_message(body):
+    """The last user message of a generate (prompt) or chat (messages) request."""
+    if body.get('messages'):
+        users = [m.get('content', '') for m in body['messages'] if m.get('role') == 'user']
+        return users[-1] if users else ""
+    prompt = body.get('prompt', '')
+    return prompt.rsplit('Human: ', 1)[-1] if 'Human: ' in prompt else prompt
+
+
+class ScriptedResponder:
+    r"""
+    A respond script matching the last user message against regular expressions, e.g.
+
+      ScriptedResponder([(r'What is (\d+) \+ (\d+)', lambda m: tool_call('add', first=int(m[1]), second=int(m[2])))])
+
+    Each rule is (pattern, response), the response being the text or a callable of the match
+    returning it. The first rule that matches answers, otherwise default does.
+    """
+    def __init__(self, rules, default=converse_response):
+        self.rules = [(re.compile(pattern, re.IGNORECASE), response) for pattern, response in rules]
+        self.default = default
+
+    def __call__(self, body):
+        message = last_user_message(body)
+        for pattern, response in self.rules:
+            match = pattern.search(message)
+            if match:
+                return response(match) if callable(response) else response
+        return self.default(body)
+
+
+def tool_call(tool, **args):
+    """The JSON text of a tool invocation, for scripted responses."""
+    return json.dumps({"tool": tool, "args": args})
+
+
+class FakeOllamaServer:
+    def __init__(self, models=('mistral:instruct',), loaded=(), respond=converse_response,
+                 first_token_delay=0.0, token_delay=0.0, chunk_size=4, fail_status=None,
+                 load_delay=0.0, sizes=None, prompt_token_delay=0.0, host='127.0.0.1', port=0):
+        """
+        Args:
+        - models (list): Model names listed by /api/tags.
+        - loaded (list): Model names listed by /api/ps, generating with a model loads it.
+        - respond (callable): respond(request_body) returns the full response text.
+        - first_token_delay (float): Seconds before the first chunk, e.g. prompt eval or a stall.
+        - token_delay (float): Seconds between chunks.
+        - chunk_size (int): Characters per streamed chunk.
+        - fail_status (int): If set, answer generate and chat requests with this HTTP status.
+        - load_delay (float): Seconds to load a model that isn't loaded yet.
+        - sizes (dict): Model name to size in bytes, reported by /api/tags and /api/ps.
+        - prompt_token_delay (float): Seconds of prompt evaluation per prompt token (4 characters),
+          added to first_token_delay. As with Ollama's cache, the prefix shared with the model's
+          previous prompt is free.
+        """
+        self.models = list(models)
+        self.loaded = set(loaded)
+        self.respond = respond
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.chunk_size = chunk_size
+        self.fail_status = fail_status
+        self.load_delay = load_delay
+        self.sizes = dict(sizes or {})
+        self.prompt_token_delay = prompt_token_delay
+        self.last_prompts = {}   # model: its previous prompt, for the prefix cache
+        self.requests = []
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _load(self, model):
+        with self.lock:
+            if model in self.loaded:
+                return 0.0
+        time.sleep(self.load_delay)
+        with self.lock:
+            self.loaded.add(model)
+        return self.load_delay
+
+    def _prompt_eval_tokens(self, model, prompt):
+        """Tokens of prompt to evaluate, those after the prefix shared with the model's previous prompt."""
+        with self.lock:
+            previous = self.last_prompts.get(model, "")
+            self.last_prompts[model] = prompt
+        shared = len(os.path.commonprefix([previous, prompt]))
+        return (len(prompt) - shared) // 4 + 1
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, obj, status=200):
+                body = json.dumps(obj).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/api/tags':
+                    self._send_json({"models": [{"name": name, "size": server.sizes.get(name, 0)}
+                                               for name in server.models]})
+                elif self.path == '/api/ps':
+                    with server.lock:
+                        loaded = sorted(server.loaded)
+                    self._send_json({"models": [{"name": name, "size": server.sizes.get(name, 0),
+                                                "size_vram": server.sizes.get(name, 0)}
+                                               for name in loaded]})
+                else:
+                    self._send_json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                with server.lock:
+                    server.requests.append((self.path, body))
+                if self.path not in ('/api/generate', '/api/chat'):
+                    self._send_json({"error": "not found"}, 404)
+                    return
+                if server.fail_status:
+                    self._send_json({"error": "scripted failure"}, server.fail_status)
+                    return
+                model = body.get('model')
+                if model not in server.models:
+                    self._send_json({"error": f"model '{model}' not found"}, 404)
+                    return
+
+                # No prompt or messages loads (or with keep_alive 0 unloads) the model.
+                if not body.get('prompt') and not body.get('messages'):
+                    load_duration = 0.0
+                    if body.get('keep_alive') in (0, '0', '0s'):
+                        with server.lock:
+                            server.loaded.discard(model)
+                    else:
+                        load_duration = server._load(model)
+                    self._send_json({"model": model, "response": "", "done": True,
+                                     "load_duration": int(load_duration * 1e9)})
+                    return
+
+                load_duration = server._load(model)
+                with server.lock:
+                    server.in_flight += 1
+                try:
+                    self._stream(body, model, load_duration)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+
+            def _stream(self, body, model, load_duration):
+                text = server.respond(body)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+
+                prompt = body.get('prompt') or json.dumps(body.get('messages'))
+                prompt_tokens = server._prompt_eval_tokens(model, prompt)
+                start = time.perf_counter()
+                time.sleep(server.first_token_delay + prompt_tokens * server.prompt_token_delay)
+                prompt_eval = time.perf_counter() - start
+                chunks = [text[i:i + server.chunk_size] for i in range(0, len(text), server.chunk_size)]
+                for chunk in chunks:
+                    self._write_line(self._chunk(body, model, chunk, False))
+                    time.sleep(server.token_delay)
+                final = self._chunk(body, model, "", True)
+                final.update({"prompt_eval_count": prompt_tokens,
+                              "prompt_eval_duration": int(prompt_eval * 1e9),
+                              "eval_count": len(chunks),
+                              "eval_duration": int((time.perf_counter() - start - prompt_eval) * 1e9),
+                              "total_duration": int((time.perf_counter() - start) * 1e9),
+                              "load_duration": int(load_duration * 1e9)})
+                self._write_line(final)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chunk(self, body, model, text, done):
+                if self.path == '/api/chat':
+                    return {"model": model, "message": {"role": "assistant", "content": text}, "done": done}
+                return {"model": model, "response": text, "done": done}
+
+            def _write_line(self, obj):
+                data = (json.dumps(obj) + "\n").encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
@@ -1,46 +1,239 @@
+import logging
+import time
+import socket
+import asyncio
+import threading
+import contextvars
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Streaming responses opened in a context, see track_streams().
+_tracked_streams = contextvars.ContextVar('tracked_streams', default=None)
+
+
+class OllamaClient:
+    """
+    Shared HTTP client for one Ollama server.
 
-def get_ollama_models(server_url):
+    Connections are pooled and kept alive, every request has connect and read timeouts, and
+    connection errors and 502/503/504 responses are retried with exponential backoff. Read
+    errors are not retried.
+    The model list (/api/tags) is cached for tags_ttl seconds and refreshed in the background
+    once stale, so callers are never blocked by a refresh after the first load.
+    """
+    def __init__(self, server_url, connect_timeout=3.0, read_timeout=300.0, retries=2,
+                 backoff=0.5, tags_ttl=60.0, pool_size=10):
+        self.server_url = server_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.tags_ttl = tags_ttl
+
+        # No read retries: a POST (e.g. /api/generate) that timed out reading may still be running
+        # on the server, resending it would start the generation again. Connection errors and
+        # 502/503/504 happen before the server handles the request, so those are retried.
+        retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                      backoff_factor=backoff, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'POST']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.tags_lock = threading.Lock()
+        self.tags = None
+        self.tags_time = 0.0
+        self.tags_etag = None
+        self.tags_refreshing = False
+
+    def close(self):
+        """Close the pooled connections."""
+        self.session.close()
+
+    def url(self, path):
+        return f"{self.server_url}{path}"
+
+    def get_json(self, path, timeout=None):
+        response = self.session.get(self.url(path), timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def post_json(self, path, payload, timeout=None):
+        response = self.session.post(self.url(path), json=payload, timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def post_stream(self, path, payload, headers=None, auth=None):
+        """
+        POST and return the streaming response. The caller checks status_code and iterates
+        response.iter_lines(decode_unicode=True), the read timeout applies between chunks.
+        """
+        response = self.session.post(self.url(path), json=payload, headers=headers, auth=auth,
+                                     stream=True, timeout=self.timeout)
+        response.encoding = "utf-8"
+        tracked = _tracked_streams.get()
+        if tracked is not None:
+            tracked.append(response)
+        return response
+
+    def _refresh_models(self):
+        headers = {'If-None-Match': self.tags_etag} if self.tags_etag else {}
+        try:
+            response = self.session.get(self.url('/api/tags'), headers=headers, timeout=self.timeout)
+            if response.status_code != 304:
+                response.raise_for_status()
+                models = response.json().get('models', [])
+                with self.tags_lock:
+                    self.tags = models
+                    self.tags_etag = response.headers.get('ETag')
+            with self.tags_lock:
+                self.tags_time = time.time()
+        except requests.exceptions.HTTPError as http_err:
+            logger.warning("HTTP error occurred: %s", http_err)
+        except Exception as err:
+            logger.warning("An error occurred: %s", err)
+        finally:
+            with self.tags_lock:
+                self.tags_refreshing = False
+
+    def refresh_models_background(self):
+        """Start a background refresh of the model list, unless one is already running."""
+        with self.tags_lock:
+            if self.tags_refreshing:
+                return
+            self.tags_refreshing = True
+        threading.Thread(target=self._refresh_models, daemon=True).start()
+
+    def get_models(self, wait=True):
+        """
+        Cached model list. A stale list is returned immediately while it refreshes in the
+        background. With nothing cached yet, wait for the first load, or with wait=False start it
+        and return None.
+        """
+        with self.tags_lock:
+            models = self.tags
+            stale = time.time() - self.tags_time > self.tags_ttl
+        if models is None:
+            if not wait:
+                self.refresh_models_background()
+                return None
+            with self.tags_lock:
+                self.tags_refreshing = True
+            self._refresh_models()
+            with self.tags_lock:
+                return self.tags
+        if stale:
+            self.refresh_models_background()
+        return models
+
+    async def aget_json(self, path, timeout=None):
+        return await asyncio.to_thread(self.get_json, path, timeout)
+
+    async def apost_json(self, path, payload, timeout=None):
+        return await asyncio.to_thread(self.post_json, path, payload, timeout)
+
+    async def aget_models(self):
+        return await asyncio.to_thread(self.get_models)
+
+    async def apost_stream(self, path, payload, headers=None, auth=None):
+        """Async version of post_stream(), iterate the response with aiter_lines()."""
+        return await asyncio.to_thread(self.post_stream, path, payload, headers, auth)
+
+    async def aiter_lines(self, response):
+        """
+        Async generator of the decoded lines of a streaming response. Blocking reads run in the
+        default executor, so the event loop is never held up by a slow server.
+        """
+        try:
+            lines = response.iter_lines(decode_unicode=True)
+            done = object()
+            while True:
+                line = await asyncio.to_thread(next, lines, done)
+                if line is done:
+                    break
+                yield line
+        finally:
+            response.close()
+
+
+def abort_stream(response):
+    """
+    Close a streaming response from any thread. The socket is shut down first, which wakes up a
+    thread blocked reading it and makes Ollama stop generating for the dropped request.
+    """
+    connection = getattr(response.raw, '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+def track_streams():
+    """
+    Collect the streaming responses post_stream() opens from now on in the current context, and
+    in threads running a copy of it, e.g. to abort_stream() them all when a step is given up.
+    Returns the list they are appended to.
+    """
+    tracked = []
+    _tracked_streams.set(tracked)
+    return tracked
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_ollama_client(server_url, **kwargs):
+    """
+    The shared OllamaClient for server_url. kwargs (see OllamaClient) only apply when the client
+    is first created, e.g. by ModelCache from config.ini.
+    """
+    server_url = server_url.rstrip('/')
+    with _clients_lock:
+        if server_url not in _clients:
+            _clients[server_url] = OllamaClient(server_url, **kwargs)
+        return _clients[server_url]
+
+
+def release_ollama_client(client):
+    """Close a client from get_ollama_client(), the next call for its server creates a new one."""
+    with _clients_lock:
+        if _clients.get(client.server_url) is client:
+            del _clients[client.server_url]
+    client.close()
+
+
+def get_ollama_models(server_url, wait=True):
     """
     Retrieve the list of models available in Ollama using its HTTP API.
 
     Args:
     - server_url (str): The URL of the Ollama server (e.g., http://localhost:11434)
+    - wait (bool): Wait for the first load of the list, otherwise return None until it is ready.
 
     Returns:
     - list: A list of dictionaries containing model details.
     - None: If an error occurs during the request.
     """
-    ollama_api_url = f"{server_url}/api/tags"
-    
-    try:
-        # Send a GET request to the API endpoint
-        response = requests.get(ollama_api_url)
-        # Raise an exception for HTTP errors
-        response.raise_for_status()
-        
-        # Parse the JSON response
-        data = response.json()
-        models = data.get('models', [])
-        return models
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-    except Exception as err:
-        print(f"An error occurred: {err}")
-    return None
+    return get_ollama_client(server_url).get_models(wait)
 
-def get_ollama_model_names(server_url):
+def get_ollama_model_names(server_url, wait=True):
     """
     Retrieve the list of model names available in Ollama using its HTTP API.
 
     Args:
     - server_url (str): The URL of the Ollama server (e.g., http://localhost:11434)
+    - wait (bool): Wait for the first load of the list, otherwise return None until it is ready.
 
     Returns:
     - list: A list of model names.
     - None: If an error occurs during the request.
     """
-    models = get_ollama_models(server_url)
+    models = get_ollama_models(server_url, wait)
     if models is not None:
         return [model['name'] for model in models]
     return None
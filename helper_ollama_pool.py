@@ -0,0 +1,489 @@
+import logging
+import time
+import queue
+import asyncio
+import weakref
+import threading
+import contextvars
+from collections import deque
+
+import requests
+
+from helper_ollama_http import get_ollama_client, release_ollama_client, abort_stream
+
+logger = logging.getLogger(__name__)
+
+
+class OllamaEndpoint:
+    """State of one Ollama server in an OllamaServerPool."""
+    def __init__(self, client):
+        self.client = client
+        self.url = client.server_url
+        self.healthy = True
+        self.in_flight = 0
+        self.models = set()   # from /api/tags
+        self.loaded = set()   # from /api/ps, models resident in memory
+        self.model_sizes = {}  # model name: bytes, loaded size if resident, else size on disk
+        self.failures = 0
+        self.last_check = 0.0
+
+    def __repr__(self):
+        return (f"OllamaEndpoint({self.url}, healthy={self.healthy}, in_flight={self.in_flight}, "
+                f"loaded={sorted(self.loaded)})")
+
+
+class HedgeLeg:
+    """One of the (possibly duplicated) requests of a hedged call."""
+    def __init__(self, endpoint, hedge):
+        self.endpoint = endpoint
+        self.hedge = hedge
+        self.response = None
+        self.lines = None
+        self.first_line = None
+        self.error = None
+        self.cancelled = False
+        self.finished = False
+        self.dropped = False
+        self.lock = threading.Lock()
+
+
+class OllamaServerPool:
+    """
+    Routes model requests over several Ollama servers.
+
+    A background thread polls /api/tags and /api/ps of every endpoint to track health, available
+    and loaded models. Each request goes to the least loaded healthy endpoint, preferring ones
+    that already have the model loaded, and fails over to the next candidate on connection
+    errors, timeouts and 5xx/404 responses (before any output was received).
+
+    With hedging enabled, a request whose first token hasn't arrived within the hedge delay (the
+    hedge_percentile of recent times to first token, at least hedge_min_delay) is duplicated on
+    the next endpoint, or on the same one when it is the only one. The first to produce a token
+    wins and the other is aborted, so Ollama stops generating for it.
+    """
+    def __init__(self, server_urls, check_interval=10.0, max_in_flight=4, hedge=False,
+                 hedge_percentile=95, hedge_min_delay=1.0, hedge_samples=200, **client_kwargs):
+        """
+        Args:
+        - server_urls (list): Ollama server URLs.
+        - check_interval (float): Seconds between health checks, 0 disables the background thread.
+        - max_in_flight (int): Requests an endpoint takes before a cold endpoint is preferred.
+        - hedge (bool): Duplicate requests that are slow to produce their first token.
+        - hedge_percentile (float): Percentile of the recent times to first token used as hedge delay.
+        - hedge_min_delay (float): Lower bound of the hedge delay in seconds, also used until
+          enough times have been recorded.
+        - hedge_samples (int): Number of recent times to first token kept.
+        - client_kwargs: Passed to the shared OllamaClient of each endpoint.
+        """
+        self.endpoints = [OllamaEndpoint(get_ollama_client(url, **client_kwargs)) for url in server_urls]
+        self.check_interval = check_interval
+        self.max_in_flight = max_in_flight
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.first_token_times = deque(maxlen=hedge_samples)
+        self.hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0,
+                            'hedge_win_seconds': 0.0, 'primary_win_seconds': 0.0}
+        self.lock = threading.Lock()
+        self.stream_responses = weakref.WeakKeyDictionary()   # stream_lines() generator: response
+        self.checker = None
+        self.checked = threading.Event()
+        self.closed = threading.Event()
+
+    def start(self):
+        """Run a health check now (in the background) and every check_interval seconds."""
+        if self.checker is not None:
+            return
+        self.checker = threading.Thread(target=self._check_loop, daemon=True)
+        self.checker.start()
+
+    def _check_loop(self):
+        while not self.closed.is_set():
+            self.check_all()
+            if not self.check_interval:
+                return
+            self.closed.wait(self.check_interval)
+
+    def close(self):
+        """Stop the health checks and close the endpoints' clients."""
+        self.closed.set()
+        for endpoint in self.endpoints:
+            release_ollama_client(endpoint.client)
+
+    def check(self, endpoint):
+        try:
+            tags = endpoint.client.get_json('/api/tags')
+            ps = endpoint.client.get_json('/api/ps')
+            with self.lock:
+                endpoint.models = {model['name'] for model in tags.get('models', [])}
+                endpoint.loaded = {model['name'] for model in ps.get('models', [])}
+                endpoint.model_sizes = {model['name']: model.get('size', 0)
+                                        for model in tags.get('models', []) + ps.get('models', [])}
+                endpoint.healthy = True
+                endpoint.failures = 0
+        except Exception as err:
+            logger.warning("Ollama endpoint %s unhealthy: %s", endpoint.url, err)
+            self._mark_failed(endpoint)
+        endpoint.last_check = time.time()
+
+    def check_all(self):
+        for endpoint in self.endpoints:
+            self.check(endpoint)
+        self.checked.set()
+
+    def wait_checked(self, timeout=None):
+        """Wait for the first health check of all endpoints, returns False on timeout."""
+        return self.checked.wait(timeout)
+
+    def _mark_failed(self, endpoint):
+        with self.lock:
+            endpoint.healthy = False
+            endpoint.failures += 1
+
+    def model_names(self):
+        """Names of the models available on any healthy endpoint."""
+        with self.lock:
+            names = set()
+            for endpoint in self.endpoints:
+                if endpoint.healthy:
+                    names |= endpoint.models
+        return sorted(names)
+
+    def is_loaded(self, model):
+        """True if model is resident on a healthy endpoint."""
+        with self.lock:
+            return any(endpoint.healthy and model in endpoint.loaded for endpoint in self.endpoints)
+
+    def model_size(self, model):
+        """Memory used by model in bytes, as reported by the endpoints, 0 if unknown."""
+        with self.lock:
+            return max([endpoint.model_sizes.get(model, 0) for endpoint in self.endpoints] + [0])
+
+    def load_model(self, model, keep_alive=None):
+        """
+        Load model on the best endpoint for it, without generating anything.
+
+        Returns:
+        - float: Seconds Ollama spent loading the model (0 if it was already loaded).
+        """
+        endpoint = self.candidates(model)[0]
+        payload = {'model': model}
+        if keep_alive is not None:
+            payload['keep_alive'] = keep_alive
+        response = endpoint.client.post_json('/api/generate', payload)
+        with self.lock:
+            endpoint.loaded.add(model)
+        return response.get('load_duration', 0) / 1e9
+
+    def unload_model(self, model):
+        """Unload model from every endpoint that has it loaded (keep_alive 0)."""
+        with self.lock:
+            endpoints = [endpoint for endpoint in self.endpoints if model in endpoint.loaded]
+        for endpoint in endpoints:
+            try:
+                endpoint.client.post_json('/api/generate', {'model': model, 'keep_alive': 0})
+            except Exception as err:
+                logger.warning("Unloading %s from %s failed: %s", model, endpoint.url, err)
+                continue
+            with self.lock:
+                endpoint.loaded.discard(model)
+
+    def candidates(self, model=None):
+        """
+        Endpoints in routing order for model: healthy ones first, then those not saturated
+        (max_in_flight), then those with the model loaded (warm), then those that have it at all,
+        then the fewest requests in flight. Unhealthy endpoints are kept at the end as a last resort.
+        """
+        def rank(endpoint):
+            return (not endpoint.healthy,
+                    endpoint.in_flight >= self.max_in_flight,
+                    model not in endpoint.loaded,
+                    bool(endpoint.models) and model not in endpoint.models,
+                    endpoint.in_flight)
+        with self.lock:
+            return sorted(self.endpoints, key=rank)
+
+    def _acquire(self, endpoint, model):
+        with self.lock:
+            endpoint.in_flight += 1
+
+    def _release(self, endpoint, model, ok):
+        with self.lock:
+            endpoint.in_flight -= 1
+            if ok and model:
+                endpoint.loaded.add(model)
+
+    def _no_endpoint_error(self, model):
+        return requests.exceptions.ConnectionError(f"No Ollama endpoint could serve {model}")
+
+    def _should_failover(self, response):
+        return response.status_code >= 500 or response.status_code == 404
+
+    def post_stream(self, path, payload, headers=None, auth=None, check_status=None):
+        """
+        Streaming POST on the best endpoint for payload['model'], with failover.
+        check_status(response) may raise for the final response, e.g. on an error status.
+
+        Returns:
+        - tuple: The endpoint and its response. Iterate the lines with iter_lines() so the
+          endpoint's in flight count is released when the stream ends.
+        """
+        model = payload.get('model')
+        candidates = self.candidates(model)
+        last_error = self._no_endpoint_error(model)
+        for i, endpoint in enumerate(candidates):
+            last = i == len(candidates) - 1
+            self._acquire(endpoint, model)
+            try:
+                response = endpoint.client.post_stream(path, payload, headers=headers, auth=auth)
+            except requests.exceptions.RequestException as err:
+                self._release(endpoint, model, False)
+                self._mark_failed(endpoint)
+                last_error = err
+                continue
+            if self._should_failover(response) and not last:
+                logger.warning("Ollama endpoint %s returned %s, failing over", endpoint.url, response.status_code)
+                if response.status_code >= 500:
+                    self._mark_failed(endpoint)
+                self._release(endpoint, model, False)
+                response.close()
+                continue
+            if check_status:
+                try:
+                    check_status(response)
+                except Exception:
+                    self._release(endpoint, model, False)
+                    response.close()
+                    raise
+            return endpoint, response
+        raise last_error
+
+    def hedge_delay(self):
+        """Seconds to wait for a first token before hedging a request."""
+        with self.lock:
+            times = sorted(self.first_token_times)
+        if len(times) < 20:
+            return self.hedge_min_delay
+        index = min(len(times) - 1, int(len(times) * self.hedge_percentile / 100))
+        return max(self.hedge_min_delay, times[index])
+
+    def get_hedge_stats(self):
+        """
+        Returns:
+        - dict: Request and hedge counts, hedge_rate (hedged / requests), hedge_win_rate
+          (hedge_wins / hedged), the mean time to first token of the hedge wins and of the
+          primary requests that won after being hedged, and the current hedge_delay.
+        """
+        with self.lock:
+            stats = dict(self.hedge_stats)
+        hedge_win_seconds = stats.pop('hedge_win_seconds')
+        primary_win_seconds = stats.pop('primary_win_seconds')
+        primary_wins = stats['hedged'] - stats['hedge_wins']
+        stats['hedge_rate'] = stats['hedged'] / stats['requests'] if stats['requests'] else 0.0
+        stats['hedge_win_rate'] = stats['hedge_wins'] / stats['hedged'] if stats['hedged'] else 0.0
+        stats['hedge_win_ttft'] = hedge_win_seconds / stats['hedge_wins'] if stats['hedge_wins'] else 0.0
+        stats['primary_win_ttft'] = primary_win_seconds / primary_wins if primary_wins else 0.0
+        stats['hedge_delay'] = self.hedge_delay()
+        return stats
+
+    def stream_lines(self, path, payload, headers=None, auth=None, check_status=None):
+        """
+        Streaming POST on the best endpoint for payload['model'], with failover and, if enabled,
+        hedging. check_status(response) may raise for the final response, e.g. on an error status.
+
+        Returns:
+        - iterator: The decoded lines of the response. The endpoint's in flight count is
+          released when the iteration ends.
+        """
+        model = payload.get('model')
+        start = time.perf_counter()
+        if self.hedge:
+            endpoint, response, lines, first_line = self._post_hedged(path, payload, headers, auth,
+                                                                      check_status, start)
+            lines = self._iter_lines(endpoint, response, lines, model, start, first_line)
+        else:
+            endpoint, response = self.post_stream(path, payload, headers, auth, check_status)
+            lines = self._iter_lines(endpoint, response, response.iter_lines(decode_unicode=True), model, start)
+        self.stream_responses[lines] = response
+        return lines
+
+    def _abandon_request(self, request):
+        # The request of a cancelled astream_lines() returned after all: abort it, and start its
+        # generator so it fails at once and releases the endpoint.
+        if request.cancelled() or request.exception() is not None:
+            return
+        lines = request.result()
+        self.abort_lines(lines)
+        threading.Thread(target=lambda: next(lines, None), daemon=True).start()
+
+    def abort_lines(self, lines):
+        """
+        Abort the response of a stream_lines() iteration from any thread: a read blocked on it
+        fails at once, so the iteration ends and releases its endpoint.
+        """
+        response = self.stream_responses.get(lines)
+        if response is not None:
+            abort_stream(response)
+
+    def _iter_lines(self, endpoint, response, lines, model, start, first_line=None):
+        ok = False
+        try:
+            if first_line is not None:
+                yield first_line
+            else:
+                for line in lines:
+                    self._record_first_token(start)
+                    yield line
+                    break
+            for line in lines:
+                yield line
+            ok = response.status_code == 200
+        finally:
+            response.close()
+            self._release(endpoint, model, ok)
+
+    def _record_first_token(self, start, leg=None):
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.first_token_times.append(seconds)
+            self.hedge_stats['requests'] += 1
+            if leg is not None and leg.hedge:
+                self.hedge_stats['hedge_wins'] += 1
+                self.hedge_stats['hedge_win_seconds'] += seconds
+            elif leg is not None:
+                self.hedge_stats['primary_win_seconds'] += seconds
+
+    def _run_leg(self, leg, path, payload, headers, auth, results):
+        try:
+            response = leg.endpoint.client.post_stream(path, payload, headers=headers, auth=auth)
+            with leg.lock:
+                leg.response = response
+                cancelled = leg.cancelled
+            if response.status_code == 200 and not cancelled:
+                leg.lines = leg.response.iter_lines(decode_unicode=True)
+                leg.first_line = next(leg.lines, None)
+        except Exception as err:
+            leg.error = err
+        with leg.lock:
+            leg.finished = True
+            cancelled = leg.cancelled
+        if cancelled:
+            self._drop_leg(leg, payload.get('model'))
+        else:
+            results.put(leg)
+
+    def _cancel_leg(self, leg, model):
+        with leg.lock:
+            leg.cancelled = True
+            finished = leg.finished
+            if leg.response is not None:
+                abort_stream(leg.response)
+        # Unfinished legs drop themselves when their request returns.
+        if finished:
+            self._drop_leg(leg, model)
+
+    def _drop_leg(self, leg, model):
+        with leg.lock:
+            if leg.dropped:
+                return
+            leg.dropped = True
+        if leg.response is not None:
+            leg.response.close()
+        self._release(leg.endpoint, model, False)
+
+    def _post_hedged(self, path, payload, headers, auth, check_status, start):
+        model = payload.get('model')
+        candidates = self.candidates(model)
+        if not candidates:
+            raise self._no_endpoint_error(model)
+        # A single endpoint hedges onto itself, relying on Ollama serving requests in parallel.
+        targets = candidates if len(candidates) > 1 else candidates * 2
+        results = queue.Queue()
+        legs = []
+
+        def start_leg(hedge):
+            endpoint = targets[len(legs)]
+            self._acquire(endpoint, model)
+            leg = HedgeLeg(endpoint, hedge)
+            legs.append(leg)
+            # In a copy of the context, so a caller's track_streams() sees the legs' responses.
+            threading.Thread(target=contextvars.copy_context().run,
+                             args=(self._run_leg, leg, path, payload, headers, auth, results),
+                             daemon=True).start()
+
+        start_leg(False)
+        running = 1
+        hedged = False
+        deadline = start + self.hedge_delay()
+        last_error = self._no_endpoint_error(model)
+        while True:
+            can_hedge = not hedged and len(legs) < len(targets)
+            try:
+                timeout = max(0.0, deadline - time.perf_counter()) if can_hedge else None
+                leg = results.get(timeout=timeout)
+            except queue.Empty:
+                logger.info("Hedging request for %s on %s", model, targets[len(legs)].url)
+                start_leg(True)
+                running += 1
+                hedged = True
+                with self.lock:
+                    self.hedge_stats['hedged'] += 1
+                continue
+            running -= 1
+
+            failed = leg.error is not None
+            if not failed and leg.response.status_code != 200:
+                failed = self._should_failover(leg.response) and (running or len(legs) < len(targets))
+            if failed:
+                if leg.error is not None or leg.response.status_code >= 500:
+                    self._mark_failed(leg.endpoint)
+                last_error = leg.error or last_error
+                self._drop_leg(leg, model)
+                if not running:
+                    if len(legs) == len(targets):
+                        raise last_error
+                    start_leg(hedged)
+                    running += 1
+                continue
+
+            for other in legs:
+                if other is not leg:
+                    self._cancel_leg(other, model)
+            if check_status:
+                try:
+                    check_status(leg.response)
+                except Exception:
+                    self._drop_leg(leg, model)
+                    raise
+            if leg.first_line is not None:
+                self._record_first_token(start, leg if hedged else None)
+            return leg.endpoint, leg.response, leg.lines or iter(()), leg.first_line
+
+    async def astream_lines(self, path, payload, headers=None, auth=None, check_status=None):
+        """
+        Async version of stream_lines(). The blocking request and reads run in the default
+        executor, so the event loop is never held up by a slow server. When the iteration is
+        cancelled (e.g. by a step timeout) the response is aborted, ending the request or read
+        still running in its thread.
+        """
+        loop = asyncio.get_running_loop()
+        request = loop.run_in_executor(None, self.stream_lines, path, payload, headers, auth, check_status)
+        try:
+            lines = await asyncio.shield(request)
+        except asyncio.CancelledError:
+            request.add_done_callback(self._abandon_request)
+            raise
+        done = object()
+        try:
+            while True:
+                line = await loop.run_in_executor(None, next, lines, done)
+                if line is done:
+                    break
+                yield line
+        finally:
+            self.abort_lines(lines)
+            try:
+                lines.close()
+            except ValueError:
+                # Still executing a read, it ends with the aborted response.
+                pass
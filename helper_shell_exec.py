@@ -0,0 +1,169 @@
+# Streaming shell command execution with limits.
+#
+# The command's stdout and stderr lines are handed to on_line as they arrive, the run is
+# killed (with its whole process group) after timeout seconds or when cancelled, and only the
+# head and tail of the output are kept once it exceeds max_bytes.
+
+import os
+import time
+import queue
+import signal
+import threading
+import subprocess
+from collections import deque
+from typing import NamedTuple
+
+from llm_history_window import estimate_tokens
+
+
+class ShellResult(NamedTuple):
+    returncode: int
+    output: str
+    truncated: bool
+    timed_out: bool
+    cancelled: bool
+    seconds: float
+
+
+class HeadTailBuffer:
+    """Keeps the first and last max_bytes / 2 of the text written to it."""
+    def __init__(self, max_bytes):
+        self.head_bytes = max_bytes // 2
+        self.tail_bytes = max_bytes - self.head_bytes
+        self.head = []
+        self.head_size = 0
+        self.tail = deque()
+        self.tail_size = 0
+        self.dropped = 0
+
+    def write(self, text):
+        if self.head_size < self.head_bytes:
+            room = self.head_bytes - self.head_size
+            self.head.append(text[:room])
+            self.head_size += len(text[:room])
+            text = text[room:]
+        if not text:
+            return
+        self.tail.append(text)
+        self.tail_size += len(text)
+        while self.tail_size > self.tail_bytes:
+            extra = self.tail_size - self.tail_bytes
+            first = self.tail[0]
+            if len(first) <= extra:
+                self.tail.popleft()
+                self.tail_size -= len(first)
+                self.dropped += len(first)
+            else:
+                self.tail[0] = first[extra:]
+                self.tail_size -= extra
+                self.dropped += extra
+
+    def getvalue(self):
+        head = "".join(self.head)
+        tail = "".join(self.tail)
+        if self.dropped:
+            return f"{head}\n... [{self.dropped} characters truncated] ...\n{tail}"
+        return head + tail
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Keep the head and tail of text within about max_tokens (see estimate_tokens)."""
+    if not max_tokens or estimate_tokens(text) <= max_tokens:
+        return text
+    buffer = HeadTailBuffer(max_tokens * 4)
+    buffer.write(text)
+    return buffer.getvalue()
+
+
+_running = {}
+_running_lock = threading.Lock()
+
+def cancel_shell(key):
+    """Cancel the command running under key (see run_shell), returns False if there is none."""
+    with _running_lock:
+        cancel = _running.get(key)
+    if cancel is None:
+        return False
+    cancel.set()
+    return True
+
+
+def _pump(stream, name, lines):
+    for line in iter(lambda: stream.readline(8192), b''):
+        lines.put((name, line.decode(errors='replace')))
+    lines.put((name, None))
+
+def _kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError, AttributeError):
+        process.kill()
+
+
+def run_shell(command, timeout=60.0, max_bytes=64 * 1024, on_line=None, key=None):
+    """
+    Run a shell command, streaming its output.
+
+    Args:
+    - command (str): Shell command line.
+    - timeout (float): Seconds before the command is killed, None for no limit.
+    - max_bytes (int): Output kept, as its head and tail.
+    - on_line (callable): Called as on_line(stream_name, line) for each line of stdout/stderr.
+      If it raises (e.g. streamlit stopping the script run) the command is killed.
+    - key: Registers the run so cancel_shell(key) can stop it, e.g. the chat session id.
+
+    Returns:
+    - ShellResult: With the combined output in arrival order.
+    """
+    start = time.perf_counter()
+    cancel = threading.Event()
+    if key is not None:
+        with _running_lock:
+            _running[key] = cancel
+
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               stdin=subprocess.DEVNULL, start_new_session=True)
+    lines = queue.Queue()
+    for stream, name in ((process.stdout, 'stdout'), (process.stderr, 'stderr')):
+        threading.Thread(target=_pump, args=(stream, name, lines), daemon=True).start()
+
+    output = HeadTailBuffer(max_bytes)
+    open_streams = 2
+    timed_out = False
+    try:
+        while open_streams:
+            if timeout is not None and time.perf_counter() - start > timeout:
+                timed_out = True
+                break
+            if cancel.is_set():
+                break
+            try:
+                name, line = lines.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if line is None:
+                open_streams -= 1
+                continue
+            output.write(line)
+            if on_line:
+                on_line(name, line)
+        # The command may close its pipes and keep running (e.g. exec >/dev/null), so its exit
+        # is waited for within the deadline too.
+        while not (timed_out or cancel.is_set()):
+            try:
+                process.wait(timeout=0.1 if timeout is None else
+                             min(0.1, max(0.0, timeout - (time.perf_counter() - start))))
+                break
+            except subprocess.TimeoutExpired:
+                timed_out = timeout is not None and time.perf_counter() - start > timeout
+    finally:
+        if process.poll() is None and (open_streams or timed_out or cancel.is_set()):
+            _kill(process)
+        if key is not None:
+            with _running_lock:
+                if _running.get(key) is cancel:
+                    del _running[key]
+
+    returncode = process.wait()
+    return ShellResult(returncode, output.getvalue(), output.dropped > 0, timed_out, cancel.is_set(),
+                       time.perf_counter() - start)
@@ -0,0 +1,80 @@
+import streamlit as st
+
+
+class ChatView:
+    """
+    The newest messages of a chat history loaded for display, maintained incrementally.
+
+    Messages are fetched from the history a page at a time with get_recent(), so a long history
+    is never loaded whole: new messages as they are appended, older ones as they are paged in.
+    Each is classified once as it is loaded: tool calls (JSON blobs), "Execution Attempt"
+    errors and the hidden texts (e.g. the agent's follow up prompt) are only shown with
+    display_tools_calls.
+    """
+    def __init__(self, hidden=()):
+        self.hidden = set(hidden)
+        self.total = 0        # messages in the history at the last sync
+        self.messages = []    # the newest messages loaded, oldest first
+        self.shown = []       # per loaded message, shown without display_tools_calls
+
+    def _classify(self, messages):
+        for message in messages:
+            content = str(message.content).strip()
+            yield not content.startswith("Execution Attempt") and not content.startswith('{') \
+                and content not in self.hidden
+
+    def sync(self, history):
+        """Load the messages appended to history since the last sync."""
+        total = len(history)
+        if total < self.total:
+            # The history was cleared or replaced, start over.
+            self.__init__(self.hidden)
+        if total > self.total:
+            # On the first sync nothing is loaded yet, render_chat_view() pages in the newest.
+            messages = history.get_recent(total - self.total) if self.total else []
+            self.messages.extend(messages)
+            self.shown.extend(self._classify(messages))
+        self.total = total
+
+    def older(self):
+        """Messages in the history older than the loaded ones."""
+        return self.total - len(self.messages)
+
+    def load_older(self, history, count):
+        """Load up to count messages older than the loaded ones."""
+        messages = history.get_recent(min(count, self.older()), offset=len(self.messages))
+        self.messages[:0] = messages
+        self.shown[:0] = self._classify(messages)
+
+    def visible(self, display_tools_calls):
+        """The loaded messages to show, oldest first."""
+        if display_tools_calls:
+            return self.messages
+        return [message for message, shown in zip(self.messages, self.shown) if shown]
+
+
+def render_chat_view(st_container, history, view, display_tools_calls, page_size, page_key, render_message):
+    """
+    Render the newest page_size visible messages of history, with a button to load older ones a
+    page at a time. render_message(message) draws one message.
+
+    Args:
+    - history: A chat history paging with get_recent(limit, offset), see llm_chat_history.
+    - page_key (str): Session state key for the number of pages shown, e.g. per chat session.
+    """
+    view.sync(history)
+    if page_key not in st.session_state:
+        st.session_state[page_key] = 1
+    shown = st.session_state[page_key] * page_size
+    # Only the pages shown are fetched, the rest of the history stays in the store.
+    while len(view.visible(display_tools_calls)) < shown and view.older():
+        view.load_older(history, page_size)
+    messages = view.visible(display_tools_calls)
+
+    if len(messages) > shown or view.older():
+        def on_load_older():
+            st.session_state[page_key] += 1
+        st_container.button("Load older messages", key=f"{page_key}_older", on_click=on_load_older)
+
+    for message in messages[-shown:]:
+        render_message(message)
@@ -1,27 +1,29 @@
-from llm_model_cache import ModelCache
+import logging
 import streamlit as st
 
-def load_options(model_cache, keys):
+logger = logging.getLogger(__name__)
+
+def load_options(settings_cache, config, keys):
     for key in keys:
         if key[0] not in st.session_state:
-            value = model_cache.config.get_boolean_by_key('my_tools', key[0], False)
+            value = config.get_boolean_by_key('my_tools', key[0], False)
             st.session_state[key[0]] = value
-        model_cache.settings_cache.set({key[0]: st.session_state[key[0]]})
+        settings_cache.set({key[0]: st.session_state[key[0]]})
 
 
-def render_options(model_cache, st, st_settings_container, keys):
+def render_options(settings_cache, config, st, st_settings_container, keys):
     # Expose options to streamlit settings
 
     def create_checkbox(key):
         def on_checkbox_change():
             value = st.session_state[key[0]]
-            print(f"Checkbox '{key}' now {value}")
-            model_cache.settings_cache.set({key[0]: value})
+            logger.debug("Checkbox %s now %s", key, value)
+            settings_cache.set({key[0]: value})
 
         if key[0] not in st.session_state:
-            value = model_cache.config.get_boolean_by_key('my_tools', key[0], False)
+            value = config.get_boolean_by_key('my_tools', key[0], False)
             st.session_state[key[0]] = value
-        model_cache.settings_cache.set({key[0]: st.session_state[key[0]]})
+        settings_cache.set({key[0]: st.session_state[key[0]]})
         st_settings_container.checkbox(key[1], key=key[0], on_change=on_checkbox_change)
 
     for key in keys:
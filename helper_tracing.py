@@ -0,0 +1,198 @@
+# Tracing spans, latency histograms and their sinks.
+#
+# tracer.span() times a stage of a chat turn: prompt build, generation, parsing, a tool call,
+# a model load. Spans nest through a context variable, so all spans of a turn share its trace
+# id. Each finished span is observed by the latency histogram of its stage, labelled by model
+# or tool, and handed to the sinks, e.g. a JsonLinesSink. metrics_text() renders the
+# histograms in the Prometheus text format, which serve_metrics() serves over HTTP.
+#
+# tracing_setup(config) configures logging, the trace file and the metrics port from [chat].
+
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Span attributes that become histogram labels, next to the stage.
+HISTOGRAM_LABELS = ('model', 'tool')
+METRIC_NAME = 'cake_stage_seconds'
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    def __init__(self, name, attributes, parent=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.span_id = uuid.uuid4().hex[:16]
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id,
+                'parent_id': self.parent_id, 'start_time': self.start_time, 'seconds': self.seconds,
+                'error': self.error, 'attributes': self.attributes}
+
+
+def current_span():
+    """The innermost open span of this context, or None."""
+    return _current_span.get()
+
+
+class Histogram:
+    """Cumulative bucket counts, count and sum per label set, as in Prometheus."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.series = {}   # labels tuple: [bucket counts, count, sum]
+
+    def observe(self, value, labels=()):
+        series = self.series.setdefault(labels, [[0] * len(self.buckets), 0, 0.0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += 1
+        series[2] += value
+
+    def prometheus_lines(self, name):
+        lines = []
+        for labels, (counts, count, total) in sorted(self.series.items()):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            separator = "," if label_text else ""
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{name}_bucket{{{label_text}{separator}le="{bound}"}} {bucket_count}')
+            lines.append(f'{name}_bucket{{{label_text}{separator}le="+Inf"}} {count}')
+            lines.append(f'{name}_count{{{label_text}}} {count}')
+            lines.append(f'{name}_sum{{{label_text}}} {total:.6f}')
+        return lines
+
+
+class JsonLinesSink:
+    """Appends each finished span as a JSON line to path."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def emit(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+
+class Tracer:
+    def __init__(self):
+        self.sinks = []
+        self.histogram = Histogram()
+        self.lock = threading.Lock()
+
+    def add_sink(self, sink):
+        """sink.emit(span) is called with every finished span."""
+        self.sinks.append(sink)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time the enclosed code as a span named name, the span is yielded for set()."""
+        span = Span(name, attributes, parent=_current_span.get())
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as err:
+            span.error = f"{type(err).__name__}: {err}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.seconds = time.perf_counter() - span.start
+            self._finish(span)
+
+    def record(self, name, seconds, error=None, **attributes):
+        """Record a span of a stage that already took seconds, e.g. timed by a callback."""
+        span = Span(name, attributes, parent=_current_span.get())
+        span.start_time -= seconds
+        span.seconds = seconds
+        span.error = error
+        self._finish(span)
+        return span
+
+    def _finish(self, span):
+        labels = (('stage', span.name),) + tuple(
+            (key, span.attributes[key]) for key in HISTOGRAM_LABELS if span.attributes.get(key) is not None)
+        with self.lock:
+            self.histogram.observe(span.seconds, labels)
+        logger.debug("Span %s %.1f ms %s", span.name, span.seconds * 1000, span.attributes)
+        for sink in self.sinks:
+            try:
+                sink.emit(span)
+            except Exception as err:
+                logger.warning("Trace sink %s failed: %s", type(sink).__name__, err)
+
+    def metrics_text(self):
+        """The stage latency histograms in the Prometheus text format."""
+        with self.lock:
+            lines = self.histogram.prometheus_lines(METRIC_NAME)
+        return "\n".join([f"# HELP {METRIC_NAME} Latency of the chat stages by model and tool.",
+                          f"# TYPE {METRIC_NAME} histogram"] + lines) + "\n"
+
+
+tracer = Tracer()
+
+
+def serve_metrics(port, host='127.0.0.1', tracer=tracer):
+    """Serve tracer.metrics_text() at http://host:port/metrics from a background thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = tracer.metrics_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving metrics at http://%s:%d/metrics", host, server.server_address[1])
+    return server
+
+
+_setup_done = False
+
+def tracing_setup(config):
+    """
+    Configure logging ([chat] log_level), the JSON lines trace file ([chat] trace_file) and the
+    metrics endpoint ([chat] metrics_port), once per process.
+    """
+    global _setup_done
+    if _setup_done:
+        return
+    _setup_done = True
+    logging.basicConfig(level=config.get_value_by_key('chat', 'log_level', 'INFO').upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    trace_file = config.get_value_by_key('chat', 'trace_file', '')
+    if trace_file:
+        tracer.add_sink(JsonLinesSink(trace_file))
+    metrics_port = int(config.get_value_by_key('chat', 'metrics_port', 0))
+    if metrics_port:
+        try:
+            serve_metrics(metrics_port)
+        except OSError as err:
+            logger.warning("Metrics endpoint on port %d failed: %s", metrics_port, err)
@@ -0,0 +1,190 @@
+# Bounded agent loop.
+#
+# A chat turn runs model step -> tool call -> observation (the tool result in the history) ->
+# next model step within one ChatEngine.invoke()/chat() call, rather than one streamlit rerun
+# per step. AgentLoop decides after each step whether another one is needed, and limits how
+# long the model may take generating each step.
+
+import json
+import time
+import queue
+import asyncio
+import logging
+import threading
+import contextvars
+
+from helper_ollama_http import track_streams, abort_stream
+
+logger = logging.getLogger(__name__)
+
+# Tools that can't finish without the user (e.g. the exec dialog) return messages starting with this.
+AWAITING_USER_PREFIX = "Execution Attempt: Waiting"
+
+
+class StepTimeout(TimeoutError):
+    pass
+
+_DONE = object()
+
+
+class AgentLoop:
+    """
+    Stop rules, checked after each step:
+    - 'final': The model answered with a final tool (the default tool, converse).
+    - 'awaiting_user': A tool is waiting for the user, see AWAITING_USER_PREFIX.
+    - 'routed': The step was answered by the pre-router, whose tool result is the answer.
+    - 'repeated': The model repeated the tool calls of an earlier step.
+    - 'max_steps': The step budget is used up.
+    - 'turn_timeout': The turn took longer than turn_timeout.
+    A step whose generation exceeds step_timeout raises StepTimeout, see limit().
+    """
+    def __init__(self, tool_manager, max_steps=4, step_timeout=None, turn_timeout=None):
+        """
+        Args:
+        - tool_manager (ToolManager): Matches the called tool names, its default_tool setting is final.
+        - max_steps (int): Model steps per turn, 1 for a single step.
+        - step_timeout (float): Seconds the model may take generating one step, None for no limit.
+        - turn_timeout (float): Seconds after which no further step is started, None for no limit.
+        """
+        self.tool_manager = tool_manager
+        self.max_steps = max(1, max_steps)
+        self.step_timeout = step_timeout
+        self.turn_timeout = turn_timeout
+        self.final_tools = {tool_manager.get_tool_setting('default_tool') or 'converse'}
+        self.start = time.perf_counter()
+        self.steps = []   # (tool names, calls key, seconds) per step
+        self.step_start = self.start
+        self.stop_reason = None
+
+    def _timeout(self):
+        timeouts = [self.step_timeout] if self.step_timeout else []
+        if self.turn_timeout:
+            timeouts.append(max(0.0, self.turn_timeout - (time.perf_counter() - self.start)))
+        return min(timeouts) if timeouts else None
+
+    def _step_timeout(self, timeout):
+        return StepTimeout(f"Step {len(self.steps) + 1} took longer than {timeout:.0f} s")
+
+    def limit(self, chunks):
+        """
+        Wrap the step's model chunks, raising StepTimeout once the step takes too long, also while
+        no chunk arrives (e.g. a stalled prompt evaluation). The chunks are then read by a thread.
+        Once the step is given up, the Ollama responses it opened are aborted, which wakes up the
+        thread if it is blocked reading, and it closes the chunks.
+        """
+        self.step_start = time.perf_counter()
+        timeout = self._timeout()
+        if timeout is None:
+            yield from chunks
+            return
+        deadline = self.step_start + timeout
+        items = queue.Queue()
+        abandoned = threading.Event()
+
+        def read():
+            try:
+                for chunk in chunks:
+                    if abandoned.is_set():
+                        break
+                    items.put((chunk, None))
+                else:
+                    items.put((_DONE, None))
+            except BaseException as err:
+                items.put((None, err))
+            finally:
+                if abandoned.is_set() and hasattr(chunks, 'close'):
+                    chunks.close()
+
+        # The chain runs with this context's settings and spans.
+        context = contextvars.copy_context()
+        streams = context.run(track_streams)
+        threading.Thread(target=context.run, args=(read,), daemon=True).start()
+        try:
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise self._step_timeout(timeout)
+                try:
+                    chunk, error = items.get(timeout=remaining)
+                except queue.Empty:
+                    raise self._step_timeout(timeout)
+                if error is not None:
+                    raise error
+                if chunk is _DONE:
+                    return
+                yield chunk
+        except StepTimeout:
+            abandoned.set()
+            for response in list(streams):
+                abort_stream(response)
+            raise
+        finally:
+            abandoned.set()
+
+    async def alimit(self, chunks):
+        """Async version of limit(), waiting for each chunk no longer than the step has left."""
+        self.step_start = time.perf_counter()
+        timeout = self._timeout()
+        deadline = None if timeout is None else self.step_start + timeout
+        try:
+            while True:
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    raise self._step_timeout(timeout)
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), remaining)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    raise self._step_timeout(timeout)
+                yield chunk
+        finally:
+            if hasattr(chunks, 'aclose'):
+                await chunks.aclose()
+
+    def calls(self, model_output):
+        """The (tool name, args) of each invocation in a parsed model output."""
+        calls = self.tool_manager.tool_calls(model_output)
+        if calls is None:
+            calls = [model_output] if isinstance(model_output, dict) else []
+        default = self.tool_manager.get_tool_setting('default_tool')
+        return [(self.tool_manager.match_tool(call.get('tool', default)) or call.get('tool', default),
+                 call.get('args')) for call in calls if isinstance(call, dict)]
+
+    def next_step(self, model_output, response, routed=False):
+        """
+        Record a finished step, returns True if the model should take another one, otherwise
+        stop_reason says why not. routed is True for a step answered by the pre-router.
+        """
+        calls = self.calls(model_output)
+        names = [name for name, _ in calls]
+        key = json.dumps(calls, sort_keys=True, default=str)
+        repeated = any(key == step_key for _, step_key, _ in self.steps)
+        self.steps.append((names, key, time.perf_counter() - self.step_start))
+
+        message = response.message if hasattr(response, 'message') else response
+        if not names or all(name in self.final_tools for name in names):
+            self.stop_reason = 'final'
+        elif any(line.startswith(AWAITING_USER_PREFIX) or f"): {AWAITING_USER_PREFIX}" in line
+                 for line in str(message).splitlines()):
+            # Several calls are merged as "tool({args}): result" lines, see ToolManager.merge_results().
+            self.stop_reason = 'awaiting_user'
+        elif routed:
+            self.stop_reason = 'routed'
+        elif repeated:
+            self.stop_reason = 'repeated'
+        elif len(self.steps) >= self.max_steps:
+            self.stop_reason = 'max_steps'
+        elif self.turn_timeout and time.perf_counter() - self.start > self.turn_timeout:
+            self.stop_reason = 'turn_timeout'
+        logger.info("Agent step %d: %s -> %s", len(self.steps), names, self.stop_reason or 'continue')
+        return self.stop_reason is None
+
+    def timed_out(self, error):
+        """Record a step that failed with StepTimeout, the loop stops."""
+        self.stop_reason = 'step_timeout'
+        logger.warning("Agent step %d: %s", len(self.steps) + 1, error)
+
+    def summary(self):
+        return (f"{len(self.steps)} steps ({', '.join('+'.join(names) for names, _, _ in self.steps)}) "
+                f"in {time.perf_counter() - self.start:.1f} s, stopped: {self.stop_reason}")
@@ -0,0 +1,360 @@
+# UI independent chat engine.
+#
+# Owns the ModelCache, ToolManagers, chains and per-session histories, so the chat can be
+# driven from streamlit (see cake_chat.py), or headless with many sessions on one event loop:
+#
+#   engine = ChatEngine(Config('resources/cake_tool_bot/config.ini'), tools_init=my_tools_init)
+#   responses = await asyncio.gather(*[engine.chat(sid, "What is 1 + 1?") for sid in sessions])
+
+import asyncio
+import logging
+
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import MessagesPlaceholder
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda
+from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.output_parsers import JsonOutputParser
+from langchain.schema import AIMessage, SystemMessage
+
+from config import Config
+from llm_model_cache import ModelCache
+from llm_chat_history import chat_history_store_load
+from llm_history_window import HistoryWindow
+from llm_ollama_stats import OllamaEvalStats, TraceCallbackHandler
+from llm_agent_loop import AgentLoop, StepTimeout
+from llm_prompt_compiler import PromptCompiler, prompt_report, format_report
+from llm_response_cache import response_cache_load, response_cache_turn
+from llm_pre_router import pre_router_load, pre_router_turn
+from llm_tools_manager import ToolReturn, use_settings
+from helper_artifact_store import ArtifactStore
+from helper_tracing import tracer, tracing_setup
+
+logger = logging.getLogger(__name__)
+
+
+prompt_about_environment = """Our runtime is using streamlit on python, so use streamlit for rendering. Mathplotlib is available. If software is missing, stop and ask me to install it using pip."""
+
+def chat_prompt_compiler(tool_manager, purpose_prompt, compact=False):
+    """The PromptCompiler of our system blocks: tools, format, environment and purpose."""
+    parser = JsonOutputParser(return_exceptions=True)
+    return PromptCompiler(tool_manager,
+                          [('format', parser.get_format_instructions()),
+                           ('environment', prompt_about_environment),
+                           ('purpose', purpose_prompt)],
+                          compact=compact)
+
+def chat_chain_load(model, tool_manager, get_session_history, prompt_compiler,
+                    history_window=None, on_prompt=None, response_cache=None, pre_router=None):
+    """
+    Build the chat chain for a model and its tools.
+    The chain stops at the raw model tokens, which ToolManager.tool_stream() parses and invokes.
+    A HistoryWindow trims the history to its token budget before it reaches the prompt,
+    loading only the messages it needs.
+    on_prompt(prompt_value, config) is called with each compiled prompt, e.g. to report its tokens.
+    A ResponseCache answers repeated prompts without calling the model, and a PreRouter the
+    messages its matchers route to a tool.
+    """
+
+    # The system blocks are compiled per set of enabled tools (see PromptCompiler), so every turn
+    # with the same settings starts with the same bytes and Ollama can reuse its evaluation of that prefix.
+    prompt = ChatPromptTemplate.from_messages(
+        [MessagesPlaceholder(variable_name="system"),
+         MessagesPlaceholder(variable_name="history"),
+         # Per-turn tool state (e.g. python_exec variables) goes after the history, to keep
+         # the cached prefix intact.
+         MessagesPlaceholder(variable_name="session_notes", optional=True),
+         ("user",   "{input}"),
+         ])
+    model_step = response_cache.wrap(model, tool_manager) if response_cache else model
+    if pre_router:
+        model_step = pre_router.wrap(model_step, tool_manager)
+    chain_front = (RunnablePassthrough.assign(system=lambda _: prompt_compiler.system_messages())
+                   | prompt
+                   | (RunnableLambda(on_prompt) if on_prompt else RunnablePassthrough())
+                   | model_step)
+
+    def get_windowed_history(session_id):
+        return history_window.view(get_session_history(session_id), session_id)
+
+    # Docs: https://api.python.langchain.com/en/latest/runnables/langchain_core.runnables.history.RunnableWithMessageHistory.html
+    return RunnableWithMessageHistory(
+        chain_front,
+        get_windowed_history if history_window else get_session_history,
+        input_messages_key="input",
+        history_messages_key="history",
+        )
+
+
+class ChatEngine:
+    def __init__(self, config: Config, tools_init=None, history_store=None, max_attempts=3):
+        """
+        Args:
+        - config (Config): Chat configuration, see config.ini.
+        - tools_init (callable): Called as tools_init(tool_manager, model_cache) to register tools
+          for each newly loaded model, e.g. my_tools_init.
+        - history_store: Hands out a BaseChatMessageHistory per session id, see llm_chat_history.
+          Defaults to the store configured by [chat] history_db.
+        - max_attempts (int): Chain attempts per message before giving up.
+        """
+        self.config = config
+        tracing_setup(config)
+        self.model_cache = ModelCache(config)
+        self.model_cache.on_evict.append(lambda model_name: self.chains.pop(model_name, None))
+        self.tools_init = tools_init
+        self.history_store = history_store or chat_history_store_load(config)
+        # Objects returned by tools are kept on disk, messages only reference them.
+        self.artifact_store = ArtifactStore(
+            config.get_value_by_key('chat', 'artifact_dir', 'artifacts'),
+            cache_items=int(config.get_value_by_key('chat', 'artifact_cache_items', 32)))
+        self.max_attempts = max_attempts
+        self.purpose_prompt = config.get_value_by_key('chat', 'purpose_prompt', '')
+        self.agent_max_steps = int(config.get_value_by_key('chat', 'agent_max_steps', 1))
+        self.agent_step_timeout = float(config.get_value_by_key('chat', 'agent_step_timeout', 0)) or None
+        self.agent_turn_timeout = float(config.get_value_by_key('chat', 'agent_turn_timeout', 0)) or None
+        self.agent_continue_prompt = config.get_value_by_key('chat', 'agent_continue_prompt', '')
+        self.compact_tools = config.get_boolean_by_key('chat', 'compact_tool_descriptions', False)
+        self.history_window = HistoryWindow(
+            token_budget=int(config.get_value_by_key('chat', 'history_token_budget', 2000)),
+            summary_tokens=int(config.get_value_by_key('chat', 'history_summary_tokens', 400)),
+            sticky=config.get_boolean_by_key('chat', 'prefix_cache', True))
+        # Responses to repeated prompts, None when [chat] response_cache is off.
+        self.response_cache = response_cache_load(config)
+        # Messages routed to tools without the model, None when [chat] pre_router is off.
+        self.pre_router = pre_router_load(config, ignore_inputs=[self.agent_continue_prompt])
+        self.chains = {}
+        self.session_locks = {}
+        self.stream_stats = {}
+        self.eval_stats = {}
+        self.prompt_reports = {}
+        self.agent_summaries = {}
+
+    def get_history(self, session_id):
+        return self.history_store.get_history(session_id)
+
+    def load_chain(self, model_name=None):
+        """
+        Returns:
+            tuple: The chain and the ToolManager for the model. Turns stream the chain whether
+            or not they render its tokens as they arrive, see _step().
+        """
+        model_name = model_name or self.model_cache.current_model_name
+        if model_name not in self.chains:
+            model, tool_manager = self.model_cache.load_model(model_name)
+            if self.tools_init:
+                self.tools_init(tool_manager, self.model_cache)
+            # Constrain the output to invocations of our tools, on Ollama versions supporting it.
+            if self.config.get_boolean_by_key('chat', 'model_json_schema', False):
+                model.format = tool_manager.get_json_schema()
+            prompt_compiler = chat_prompt_compiler(tool_manager, self.purpose_prompt, self.compact_tools)
+            self.chains[model_name] = (
+                chat_chain_load(model, tool_manager, self.get_history, prompt_compiler,
+                                history_window=self.history_window, on_prompt=self._prompt_report,
+                                response_cache=self.response_cache, pre_router=self.pre_router),
+                tool_manager)
+        return self.chains[model_name]
+
+    def add_response(self, session_id, response):
+        """
+        Save a chain response (str or ToolReturn) to the session history. Objects in the
+        ToolReturn data are stored in the artifact store and referenced from the message.
+
+        Returns:
+            tuple: The message and its additional_kwargs (artifact references), for display.
+        """
+        msgs = self.get_history(session_id)
+        additional_kwargs: dict = {}
+
+        # response is of type str, or a ToolReturn
+        if isinstance(response, ToolReturn):
+            message = response.message
+            if response.data != None:
+                additional_kwargs = self.artifact_store.put_all(response.data)
+        else:
+            message = response
+
+        # Write the assistant a note about tools execution if it was (probably) successful but unknown to it.
+        if str(message).strip() == "" and len(additional_kwargs) != 0:
+            msgs.add_message(AIMessage(content="{'private assistant note': tool executed successfully and return an object to user.'}"))
+        msgs.add_message(AIMessage(content=message, additional_kwargs=additional_kwargs))
+        return message, additional_kwargs
+
+    def _inputs(self, session_id, text, tool_manager):
+        inputs = {'input': text}
+        notes = tool_manager.get_session_notes(session_id)
+        if notes:
+            inputs['session_notes'] = [SystemMessage(content=note, name='session_notes') for note in notes]
+        return inputs
+
+    def _chain_config(self, session_id, model_name):
+        # Ollama's prompt_eval/eval counts for the turn are collected into eval_stats, and the
+        # prompt build and generation of each step are traced.
+        eval_stats = OllamaEvalStats()
+        self.eval_stats[session_id] = eval_stats
+        return {"configurable": {"session_id": session_id},
+                "callbacks": [eval_stats, TraceCallbackHandler(tracer, model_name)]}
+
+    def _prompt_report(self, prompt_value, config):
+        session_id = config.get('configurable', {}).get('session_id')
+        self.prompt_reports[session_id] = prompt_report(prompt_value.to_messages())
+        return prompt_value
+
+    def _turn_done(self, session_id, loop, span):
+        self.agent_summaries[session_id] = loop.summary()
+        span.set(steps=len(loop.steps), stop_reason=loop.stop_reason, **self.eval_stats[session_id].stats)
+        logger.info("Turn %s: %s, %s", session_id, loop.summary(), self.eval_stats[session_id].summary())
+        if session_id in self.prompt_reports:
+            logger.info("Turn %s prompt tokens: %s", session_id, format_report(self.prompt_reports[session_id]))
+
+    def _respond(self, session_id, response, on_response, rendered=False):
+        message, additional_kwargs = self.add_response(session_id, response)
+        if on_response:
+            on_response(message, additional_kwargs, rendered)
+
+    def _stream_done(self, session_id, stream):
+        self.stream_stats[session_id] = stream.stats
+        return stream.streamed != ""
+
+    def _step_routed(self):
+        return self.pre_router is not None and self.pre_router.step_routed()
+
+    def _agent_loop(self, tool_manager, max_steps):
+        return AgentLoop(tool_manager, max_steps=max_steps or self.agent_max_steps,
+                         step_timeout=self.agent_step_timeout, turn_timeout=self.agent_turn_timeout)
+
+    def _step(self, session_id, text, chain_stream, tool_manager, chain_config, loop,
+              streaming, on_text, on_tool):
+        """One model step and its tool calls, returns the response and the ToolStream."""
+        stream = tool_manager.tool_stream(
+            loop.limit(chain_stream.stream(self._inputs(session_id, text, tool_manager), chain_config)),
+            on_tool=on_tool)
+        for _ in stream.text():
+            if streaming and on_text:
+                on_text(stream.streamed)
+        return stream.invoke(), stream
+
+    async def _astep(self, session_id, text, chain_stream, tool_manager, chain_config, loop,
+                     streaming, on_text, on_tool):
+        """Async version of _step()."""
+        stream = tool_manager.tool_stream(
+            loop.alimit(chain_stream.astream(self._inputs(session_id, text, tool_manager), chain_config)),
+            on_tool=on_tool)
+        async for _ in stream.atext():
+            if streaming and on_text:
+                on_text(stream.streamed)
+        return await stream.ainvoke(), stream
+
+    def _turn(self, session_id, text, model_name, tool_manager, on_response, streaming, settings,
+              max_steps, on_step):
+        """
+        The agent loop of a chat turn, shared by invoke() and chat(). A generator yielding
+        (text, loop) for each step attempt, which the caller runs with _step() or _astep() and
+        sends back the (response, ToolStream) of, or throws its error into. Returns the final
+        response. Generators run in their caller's context, so the turn's settings and spans
+        apply to the steps.
+        """
+        with use_settings(settings or self.model_cache.settings_cache, session_id), \
+                response_cache_turn(), pre_router_turn(), \
+                tracer.span('turn', session_id=session_id, model=model_name) as turn_span:
+            loop = self._agent_loop(tool_manager, max_steps)
+            step_text = text
+            while True:
+                for attempt in range(self.max_attempts):
+                    try:
+                        with tracer.span('step', step=len(loop.steps) + 1, attempt=attempt + 1):
+                            response, stream = yield step_text, loop
+                        self._respond(session_id, response, on_response,
+                                      streaming and self._stream_done(session_id, stream))
+                        break
+                    except StepTimeout as e:
+                        response = f"Execution Attempt {attempt +1} failed, error: {e}"
+                        self._respond(session_id, response, on_response)
+                        loop.timed_out(e)
+                        break
+                    except Exception as e:
+                        error_str = f"Execution Attempt {attempt +1} failed, error: {e}"
+                        self._respond(session_id, error_str, on_response)
+                        if attempt == self.max_attempts - 1:
+                            raise
+                if loop.stop_reason or not loop.next_step(stream.model_output, response, self._step_routed()):
+                    break
+                if on_step:
+                    on_step(len(loop.steps), loop.steps[-1][0])
+                step_text = self.agent_continue_prompt
+            self._turn_done(session_id, loop, turn_span)
+            return response
+
+    def invoke(self, session_id, text, model_name=None, on_response=None,
+               streaming=False, on_text=None, on_tool=None, settings=None, max_steps=None, on_step=None):
+        """
+        Run one chat turn synchronously: an agent loop of model steps, each calling tools whose
+        results the next step sees, see AgentLoop. Failed attempts of a step are retried with
+        the error fed back into the history so the LLM can see it.
+
+        Args:
+        - on_response (callable): Called as on_response(message, additional_kwargs, rendered) for
+          every response and error, rendered is True when the text was already streamed.
+        - streaming (bool): Stream tokens, calling on_text(text_so_far) as visible text arrives
+          and on_tool(tool_name) as soon as the tool is chosen.
+        - settings (SettingsCache): Tool settings for this session, defaults to the ModelCache ones.
+        - max_steps (int): Model steps for the turn, defaults to [chat] agent_max_steps.
+        - on_step (callable): Called as on_step(step, tool_names) before each follow up step.
+
+        Returns:
+        - The final response (str or ToolReturn).
+        """
+        model_name = model_name or self.model_cache.current_model_name
+        chain_stream, tool_manager = self.load_chain(model_name)
+        chain_config = self._chain_config(session_id, model_name)
+        turn = self._turn(session_id, text, model_name, tool_manager, on_response, streaming, settings,
+                          max_steps, on_step)
+        try:
+            step_text, loop = next(turn)
+            while True:
+                try:
+                    result = self._step(session_id, step_text, chain_stream, tool_manager, chain_config,
+                                        loop, streaming, on_text, on_tool)
+                except Exception as e:
+                    step_text, loop = turn.throw(e)
+                else:
+                    step_text, loop = turn.send(result)
+        except StopIteration as done:
+            return done.value
+        finally:
+            turn.close()
+
+    async def chat(self, session_id, text, model_name=None, on_response=None,
+                   streaming=False, on_text=None, on_tool=None, settings=None, max_steps=None, on_step=None):
+        """
+        Async version of invoke() using the chain's async paths. Turns for the same session are
+        serialised, while different sessions run concurrently on the event loop.
+        """
+        model_name = model_name or self.model_cache.current_model_name
+        chain_stream, tool_manager = self.load_chain(model_name)
+        lock = self.session_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            # Within the lock, so a queued turn doesn't replace the eval_stats of the running one.
+            chain_config = self._chain_config(session_id, model_name)
+            turn = self._turn(session_id, text, model_name, tool_manager, on_response, streaming, settings,
+                              max_steps, on_step)
+            try:
+                step_text, loop = next(turn)
+                while True:
+                    try:
+                        result = await self._astep(session_id, step_text, chain_stream, tool_manager,
+                                                   chain_config, loop, streaming, on_text, on_tool)
+                    except Exception as e:
+                        step_text, loop = turn.throw(e)
+                    else:
+                        step_text, loop = turn.send(result)
+            except StopIteration as done:
+                return done.value
+            finally:
+                turn.close()
+
+    def close(self):
+        """
+        Release the engine's background threads and connections, see ModelCache.close(). The
+        python_exec pool is shared by engines and closed by process_cached() when replaced.
+        """
+        self.chains.clear()
+        self.model_cache.close()
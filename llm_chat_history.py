@@ -0,0 +1,225 @@
+# Chat history stores.
+#
+# A store hands out one BaseChatMessageHistory per session id, can list sessions, and evicts
+# idle sessions from memory. SQLiteChatHistoryStore persists histories in a SQLite database in
+# WAL mode, so they survive restarts and can be shared by several worker processes.
+#
+# Histories page through their messages with get_recent(limit, offset), so the history window
+# (see HistoryWindow.view()) and the chat view only load the newest ones they need.
+#
+# Messages are stored as LangChain message dicts (JSON), which stay readable across library
+# upgrades. Only a message holding an object JSON can't represent is pickled.
+
+import json
+import time
+import pickle
+import sqlite3
+import threading
+
+from langchain_core.chat_history import BaseChatMessageHistory, InMemoryChatMessageHistory
+from langchain_core.messages import message_to_dict, messages_from_dict
+
+
+def dump_message(message):
+    try:
+        return json.dumps(message_to_dict(message))
+    except (TypeError, ValueError):
+        return pickle.dumps(message)
+
+def load_message(data):
+    if isinstance(data, bytes):
+        return pickle.loads(data)
+    return messages_from_dict([json.loads(data)])[0]
+
+
+class MemoryChatMessageHistory(InMemoryChatMessageHistory):
+    """InMemoryChatMessageHistory with the paging of SQLiteChatMessageHistory."""
+    def __len__(self):
+        return len(self.messages)
+
+    def get_recent(self, limit, offset=0):
+        """Page of messages in chronological order, ending offset messages before the newest."""
+        end = max(0, len(self.messages) - offset)
+        return self.messages[max(0, end - limit):end]
+
+
+class MemoryChatHistoryStore:
+    """Process memory only, used when no history database is configured."""
+    def __init__(self):
+        self.histories = {}
+        self.updated = {}
+        self.lock = threading.Lock()
+
+    def get_history(self, session_id):
+        session_id = str(session_id)
+        with self.lock:
+            if session_id not in self.histories:
+                self.histories[session_id] = MemoryChatMessageHistory()
+            self.updated[session_id] = time.time()
+            return self.histories[session_id]
+
+    def list_sessions(self, limit=50, offset=0):
+        with self.lock:
+            sessions = sorted(self.updated, key=self.updated.get, reverse=True)
+        return sessions[offset:offset + limit]
+
+    def evict_idle(self):
+        return 0
+
+
+class SQLiteChatMessageHistory(BaseChatMessageHistory):
+    """
+    History of one session in a SQLiteChatHistoryStore.
+
+    get_recent() pages through the messages without loading the whole history. The messages
+    property loads them all, lazily on first access, and afterwards only fetches rows newer than
+    the last one seen, so appends from other processes are picked up cheaply.
+    """
+    def __init__(self, store, session_id: str):
+        self.store = store
+        self.session_id = session_id
+        self.lock = threading.Lock()
+        self.unload()
+
+    def unload(self):
+        """Drop the in-memory copy of the messages."""
+        with self.lock:
+            self._messages = None
+            self._last_id = 0
+
+    @property
+    def loaded(self):
+        return self._messages is not None
+
+    @property
+    def messages(self):
+        with self.lock:
+            rows = self.store.fetch(
+                "SELECT id, message FROM messages WHERE session_id = ? AND id > ? ORDER BY id",
+                (self.session_id, self._last_id))
+            if self._messages is None:
+                self._messages = []
+            for row_id, message in rows:
+                self._messages.append(load_message(message))
+                self._last_id = row_id
+            return list(self._messages)
+
+    def add_messages(self, messages):
+        now = time.time()
+        with self.store.transaction() as conn:
+            for message in messages:
+                conn.execute(
+                    "INSERT INTO messages (session_id, message, created) VALUES (?, ?, ?)",
+                    (self.session_id, dump_message(message), now))
+            conn.execute(
+                "INSERT INTO sessions (session_id, created, updated, message_count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET updated = excluded.updated, "
+                "message_count = message_count + excluded.message_count",
+                (self.session_id, now, now, len(messages)))
+
+    def clear(self):
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (self.session_id,))
+            conn.execute("UPDATE sessions SET message_count = 0, updated = ? WHERE session_id = ?",
+                         (time.time(), self.session_id))
+        self.unload()
+
+    def __len__(self):
+        rows = self.store.fetch("SELECT message_count FROM sessions WHERE session_id = ?",
+                                (self.session_id,))
+        return rows[0][0] if rows else 0
+
+    def get_recent(self, limit, offset=0):
+        """
+        Page of messages in chronological order, ending offset messages before the newest.
+        """
+        rows = self.store.fetch(
+            "SELECT message FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+            (self.session_id, limit, offset))
+        return [load_message(row[0]) for row in reversed(rows)]
+
+
+class SQLiteChatHistoryStore:
+    def __init__(self, db_file, idle_seconds=1800):
+        """
+        Args:
+        - db_file (str): Path of the SQLite database, created if missing.
+        - idle_seconds (int): Sessions not accessed for this long are unloaded from memory.
+        """
+        self.db_file = db_file
+        self.idle_seconds = idle_seconds
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.histories = {}
+        self.last_access = {}
+        self.last_eviction = time.time()
+
+        with self.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS messages ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, "
+                         "message BLOB NOT NULL, created REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                         "session_id TEXT PRIMARY KEY, created REAL NOT NULL, updated REAL NOT NULL, "
+                         "message_count INTEGER NOT NULL DEFAULT 0)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread.
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def transaction(self):
+        """Context manager committing on success, rolling back on error."""
+        return self.connection()
+
+    def fetch(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def get_history(self, session_id):
+        session_id = str(session_id)
+        now = time.time()
+        with self.lock:
+            history = self.histories.get(session_id)
+            if history is None:
+                history = SQLiteChatMessageHistory(self, session_id)
+                self.histories[session_id] = history
+            self.last_access[session_id] = now
+        if now - self.last_eviction > self.idle_seconds / 10:
+            self.evict_idle()
+        return history
+
+    def list_sessions(self, limit=50, offset=0):
+        """Session ids, most recently updated first."""
+        rows = self.fetch("SELECT session_id FROM sessions ORDER BY updated DESC LIMIT ? OFFSET ?",
+                          (limit, offset))
+        return [row[0] for row in rows]
+
+    def evict_idle(self):
+        """Unload messages of sessions idle for longer than idle_seconds. Returns the number unloaded."""
+        now = time.time()
+        evicted = 0
+        with self.lock:
+            self.last_eviction = now
+            for session_id, last_access in list(self.last_access.items()):
+                if now - last_access > self.idle_seconds:
+                    history = self.histories.pop(session_id)
+                    del self.last_access[session_id]
+                    if history.loaded:
+                        history.unload()
+                        evicted += 1
+        return evicted
+
+
+def chat_history_store_load(config):
+    """SQLite store if [chat] history_db is configured, otherwise process memory."""
+    history_db = config.get_value_by_key('chat', 'history_db', '')
+    if not history_db:
+        return MemoryChatHistoryStore()
+    return SQLiteChatHistoryStore(history_db,
+                                  int(config.get_value_by_key('chat', 'history_idle_seconds', 1800)))
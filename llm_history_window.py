@@ -0,0 +1,166 @@
+# Token budgeted history window.
+#
+# HistoryWindow.view() wraps the session history handed to RunnableWithMessageHistory, so the
+# model only sees the newest turns that fit the budget. Older turns are folded into a summary
+# message that is maintained incrementally per session, rather than re-sending (or
+# re-summarising) the whole history. Messages once folded are never needed again, so the view
+# pages in only the messages from there on (see get_recent() in llm_chat_history).
+#
+# With sticky set the window start only moves when the budget is exceeded, and then drops to half
+# the budget, so the prompt prefix stays byte-identical for several turns and Ollama can reuse its
+# cached evaluation of it.
+
+import threading
+
+from langchain.schema import SystemMessage, HumanMessage
+from langchain_core.chat_history import BaseChatMessageHistory
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (about 4 characters per token for English and code)."""
+    return len(text) // 4 + 1
+
+
+def message_tokens(message, token_counter=estimate_tokens) -> int:
+    """Token count of a message, cached in its response_metadata so it is only counted once."""
+    count = message.response_metadata.get('token_count')
+    if count is None:
+        # Small allowance for the role and message framing in the prompt.
+        count = token_counter(str(message.content)) + 4
+        message.response_metadata['token_count'] = count
+    return count
+
+
+def summarize_extractive(summary: str, messages, max_tokens: int, token_counter=estimate_tokens) -> str:
+    """
+    Fold messages into summary without an LLM call.
+
+    Tool call JSON, errors and private notes are dropped, each remaining message is cut down to
+    a line, and the oldest lines are dropped when the summary exceeds max_tokens.
+    """
+    lines = summary.splitlines() if summary else []
+    for message in messages:
+        content = str(message.content).strip()
+        if content == "" or content.startswith('{') or content.startswith("Execution Attempt"):
+            continue
+        content = " ".join(content.split())
+        if len(content) > 200:
+            content = content[:200] + "..."
+        lines.append(f"{message.type}: {content}")
+
+    while len(lines) > 1 and token_counter("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+class HistoryWindow:
+    def __init__(self, token_budget=2000, summary_tokens=400, summarizer=summarize_extractive,
+                 token_counter=estimate_tokens, sticky=False, cold_start_messages=200):
+        """
+        Args:
+        - token_budget (int): Tokens of history sent to the model per turn, 0 disables the window.
+        - summary_tokens (int): Token cap of the summary of older turns, 0 disables the summary.
+        - summarizer (callable): summarizer(summary, messages, max_tokens, token_counter) returns
+          the summary with messages folded in.
+        - token_counter (callable): Counts the tokens in a str.
+        - sticky (bool): Keep the window start stable between turns, see above.
+        - cold_start_messages (int): Messages loaded for a session the window hasn't seen yet
+          (e.g. after a restart), older ones are left out of the summary.
+        """
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.summarizer = summarizer
+        self.token_counter = token_counter
+        self.sticky = sticky
+        self.cold_start_messages = cold_start_messages
+        self.summaries = {}   # session id: (summary, index of the first message not folded into it)
+        self.lock = threading.Lock()
+
+    def tokens(self, messages):
+        return sum(message_tokens(message, self.token_counter) for message in messages)
+
+    def window_start(self, messages, token_budget):
+        """Index of the oldest message kept, aligned to the start of a human turn."""
+        used = 0
+        start = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            used += message_tokens(messages[i], self.token_counter)
+            if used > token_budget:
+                break
+            start = i
+        # Don't start mid turn, unless the newest turn alone is over budget.
+        for i in range(start, len(messages)):
+            if isinstance(messages[i], HumanMessage):
+                return i
+        return start
+
+    def needed_from(self, session_id, total):
+        """Index of the oldest of a session's total messages the window may still need."""
+        if not self.token_budget:
+            return 0
+        with self.lock:
+            summary, folded = self.summaries.get(session_id, (None, None))
+        if folded is None or folded > total:
+            return max(0, total - self.cold_start_messages)
+        return folded
+
+    def window(self, session_id, messages, offset=0):
+        """
+        The windowed history of a session. messages are its newest ones, from index offset of
+        the whole history on, and include those from needed_from() on.
+        """
+        if not self.token_budget:
+            return messages
+        with self.lock:
+            summary, folded = self.summaries.get(session_id, ("", 0))
+            if folded > offset + len(messages):
+                # History was cleared, start over.
+                summary, folded = "", 0
+            # Messages before offset weren't loaded, they are left out of the summary.
+            folded = max(folded, offset)
+            unfolded = messages[folded - offset:]
+            if self.sticky and self.tokens(unfolded) <= self.token_budget:
+                start = folded
+            else:
+                start = folded + self.window_start(
+                    unfolded, self.token_budget // 2 if self.sticky else self.token_budget)
+            if start > folded and self.summary_tokens:
+                summary = self.summarizer(summary, messages[folded - offset:start - offset],
+                                          self.summary_tokens, self.token_counter)
+            self.summaries[session_id] = (summary, start)
+
+        window = messages[start - offset:]
+        if summary == "":
+            return window
+        return [SystemMessage(content=f"Summary of the earlier conversation:\n{summary}")] + window
+
+    def view(self, history, session_id):
+        """The session history as the chain sees it, see WindowedChatMessageHistory."""
+        return WindowedChatMessageHistory(self, history, session_id)
+
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+    """
+    A session history whose messages are the windowed ones. Only the messages the window still
+    needs are loaded, when the history pages with get_recent(). Added messages go to the history.
+    """
+    def __init__(self, history_window, history, session_id):
+        self.history_window = history_window
+        self.history = history
+        self.session_id = session_id
+
+    @property
+    def messages(self):
+        if hasattr(self.history, 'get_recent'):
+            total = len(self.history)
+            offset = self.history_window.needed_from(self.session_id, total)
+            messages = self.history.get_recent(total - offset) if total > offset else []
+        else:
+            offset, messages = 0, self.history.messages
+        return self.history_window.window(self.session_id, messages, offset)
+
+    def add_messages(self, messages):
+        self.history.add_messages(messages)
+
+    def clear(self):
+        self.history.clear()
@@ -1,54 +1,133 @@
+import logging
+import re
+import time
+import threading
+from collections import OrderedDict
+
 from config import Config
-from helper_ollama_http import get_ollama_model_names
+from helper_ollama_pool import OllamaServerPool
+from helper_ollama_cassette import cassette_transport
+from llm_ollama import CakeOllama
 from llm_tools_manager import ToolManager
 from llm_tools_manager import SettingsCache
+from llm_tool_cache import ToolResultCache
+from helper_tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+def parse_size(value):
+    """Size in bytes from a config value like 8GB, 512MB or 1000000, 0 if empty."""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', str(value or '0'), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    scale = 1024 ** ' KMGT'.index(match.group(2).upper() or ' ')
+    return int(float(match.group(1)) * scale)
 
-from langchain_community.llms import Ollama
 
 class ModelCache:
+    """
+    Models (with their ToolManager) in least recently used order, and their residency on the
+    Ollama servers.
+
+    The default model and the most recently used ones are loaded on the servers in the
+    background (prewarmed), so switching models doesn't wait for a cold load. When the models
+    in the cache need more than model_memory_budget, the least recently used ones are dropped
+    and unloaded from the servers.
+    """
     def __init__(self, config: Config):
-        self.model_cache = {}
+        self.model_cache = OrderedDict()
         self.config = config
         self.settings_cache = SettingsCache()
-        self.model_server_url   = config.get_value_by_key('chat', 'model_server_url',
-                                                          'http://localhost:11434')
+        # One or more servers, separated by commas or spaces.
+        self.model_server_urls  = config.get_value_by_key('chat', 'model_server_url',
+                                                          'http://localhost:11434').replace(',', ' ').split()
+        self.model_server_url   = self.model_server_urls[0]
         self.current_model_name = config.get_value_by_key('chat', 'model_name_default',
                                                           'mistral:instruct')
         self.current_model_temperature = config.get_value_by_key('chat', 'model_temperature',
                                                           0.9)
         self.current_model_num_predict = config.get_value_by_key('chat', 'model_num_predict',
                                                           128)
+        # Keep models loaded between turns so their cached prompt prefix can be reused.
+        self.model_keep_alive = config.get_value_by_key('chat', 'model_keep_alive', None)
+        # Per model keep_alive overrides, e.g. "codestral:latest=1h, mistral:instruct=5m".
+        self.model_keep_alives = dict(item.rsplit('=', 1) for item in config.get_value_by_key(
+            'chat', 'model_keep_alive_per_model', '').replace(',', ' ').split())
+        self.memory_budget = parse_size(config.get_value_by_key('chat', 'model_memory_budget', 0))
+        self.prewarm_count = int(config.get_value_by_key('chat', 'model_prewarm_count', 2))
+        # Tool results are shared by the ToolManagers of all models.
+        self.tool_result_cache = ToolResultCache(
+            max_items=int(config.get_value_by_key('chat', 'tool_cache_items', 1024)),
+            max_bytes=parse_size(config.get_value_by_key('chat', 'tool_cache_bytes', '16MB')),
+            db_file=config.get_value_by_key('chat', 'tool_cache_db', '') or None)
         self.current_model = None
         self.current_tools = None
-        self.available_models = get_ollama_model_names(self.model_server_url)
+        self.lock = threading.RLock()
+        self.on_evict = []
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'prewarms': 0,
+                      'cold_loads': 0, 'cold_load_seconds': 0.0, 'last_cold_load': None}
+
+        # All Ollama traffic is routed over the server pool. Health checks (and so the model
+        # list) run in the background, so page load doesn't wait on the servers.
+        self.server_pool = OllamaServerPool(
+            self.model_server_urls,
+            check_interval=float(config.get_value_by_key('chat', 'model_server_check_interval', 10)),
+            max_in_flight=int(config.get_value_by_key('chat', 'model_server_max_in_flight', 4)),
+            hedge=config.get_boolean_by_key('chat', 'hedge_requests', False),
+            hedge_percentile=float(config.get_value_by_key('chat', 'hedge_percentile', 95)),
+            hedge_min_delay=float(config.get_value_by_key('chat', 'hedge_min_delay', 1.0)),
+            connect_timeout=float(config.get_value_by_key('chat', 'model_server_connect_timeout', 3)),
+            read_timeout=float(config.get_value_by_key('chat', 'model_server_read_timeout', 300)),
+            retries=int(config.get_value_by_key('chat', 'model_server_retries', 2)),
+            tags_ttl=float(config.get_value_by_key('chat', 'model_list_ttl', 60)))
+        self.server_pool.start()
+        # Model requests may be recorded to or replayed from a cassette, see helper_ollama_cassette.
+        self.model_transport = cassette_transport(config, self.server_pool)
+        self.prewarm()
+
+    @property
+    def available_models(self):
+        """Model names on the healthy servers, empty until the first health check completes."""
+        return self.server_pool.model_names()
+
+    def keep_alive(self, model_name):
+        return self.model_keep_alives.get(model_name, self.model_keep_alive)
 
     def load_model(self, model_name: str):
         """
         Returns:
             tuple: A tuple containing the model and its tools.
         """
+        with self.lock:
+            if model_name in self.model_cache:
+                self.stats['hits'] += 1
+                self.model_cache.move_to_end(model_name)
+                self.current_model_name = model_name
+                self.current_model, self.current_tools = self.model_cache[model_name]
+                return self.current_model, self.current_tools
 
-        if model_name in self.model_cache:
-            print(f"Found in cache {model_name}")
-            self.current_model_name = model_name
-            self.current_model, self.current_tools = self.model_cache[model_name]
-        else:
-            print(f"Model NOT found {model_name}")
-            model = Ollama(model=model_name, format='json',
-                           temperature=self.current_model_temperature,
-                           num_predict=self.current_model_num_predict)
-            tools = ToolManager(self.config, self.settings_cache)
+            logger.info("Model %s not cached, creating it", model_name)
+            self.stats['misses'] += 1
+            model = CakeOllama(base_url=self.model_server_url, server_pool=self.model_transport,
+                               model=model_name, format='json',
+                               temperature=self.current_model_temperature,
+                               num_predict=self.current_model_num_predict,
+                               keep_alive=self.keep_alive(model_name))
+            tools = ToolManager(self.config, self.settings_cache, self.tool_result_cache)
 
             self.set_model(model_name, model, tools)
-
+            self.evict(keep=model_name)
+        self.prewarm([model_name])
         return self.current_model, self.current_tools
 
 
     def set_model(self, model_name: str, model, tools):
-        self.current_model_name = model_name
-        self.model_cache[model_name] = (model, tools)
-        self.current_model = model
-        self.current_tools = tools
+        with self.lock:
+            self.current_model_name = model_name
+            self.model_cache[model_name] = (model, tools)
+            self.model_cache.move_to_end(model_name)
+            self.current_model = model
+            self.current_tools = tools
 
     def get_model(self):
         """
@@ -58,3 +137,88 @@ class ModelCache:
             tuple: A tuple containing the model and its tools.
         """
         return self.current_model, self.current_tools
+
+    def memory_used(self):
+        """Bytes the cached models need on the servers, as far as the servers reported."""
+        with self.lock:
+            names = list(self.model_cache)
+        return sum(self.server_pool.model_size(name) for name in names)
+
+    def evict(self, keep=None):
+        """
+        Drop least recently used models until the cache fits the memory budget, and unload them
+        from the servers in the background. The keep model is never evicted.
+        """
+        if not self.memory_budget:
+            return
+        evicted = []
+        with self.lock:
+            for name in list(self.model_cache):
+                if self.memory_used() <= self.memory_budget:
+                    break
+                if name == keep:
+                    continue
+                del self.model_cache[name]
+                evicted.append(name)
+                self.stats['evictions'] += 1
+        for name in evicted:
+            logger.info("Evicting model %s", name)
+            for callback in self.on_evict:
+                callback(name)
+            threading.Thread(target=self.server_pool.unload_model, args=(name,), daemon=True).start()
+
+    def prewarm(self, model_names=None):
+        """
+        Load models on the servers in a background thread: model_names, or by default the
+        default model and the prewarm_count most recently used ones.
+        """
+        if model_names is None:
+            with self.lock:
+                recent = list(reversed(self.model_cache))[:self.prewarm_count]
+            model_names = list(dict.fromkeys([self.current_model_name] + recent))
+        threading.Thread(target=self._prewarm, args=(model_names,), daemon=True).start()
+
+    def _prewarm(self, model_names):
+        self.server_pool.wait_checked(timeout=30)
+        for name in model_names:
+            if self.server_pool.closed.is_set():
+                return
+            if self.server_pool.is_loaded(name) or name not in self.server_pool.model_names():
+                continue
+            start = time.perf_counter()
+            try:
+                with tracer.span('model_load', model=name):
+                    load_seconds = self.server_pool.load_model(name, self.keep_alive(name))
+            except Exception as err:
+                logger.warning("Prewarming %s failed: %s", name, err)
+                continue
+            seconds = time.perf_counter() - start
+            logger.info("Prewarmed %s in %.1f s", name, seconds)
+            with self.lock:
+                self.stats['prewarms'] += 1
+                if load_seconds:
+                    self.stats['cold_loads'] += 1
+                    self.stats['cold_load_seconds'] += seconds
+                    self.stats['last_cold_load'] = (name, seconds)
+        self.evict(keep=self.current_model_name)
+
+    def close(self):
+        """Stop the server pool's health checks and prewarming, and close the clients and caches."""
+        with self.lock:
+            tool_managers = [tools for _, tools in self.model_cache.values()]
+        for tool_manager in tool_managers:
+            tool_manager.close()
+        self.server_pool.close()
+        self.tool_result_cache.close()
+
+    def get_stats(self):
+        """
+        Returns:
+        - dict: Cache hits, misses and evictions, server loads by prewarm, cold loads with their
+          total and last (model, seconds) time, and memory used against the budget in bytes.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        stats['memory_used'] = self.memory_used()
+        stats['memory_budget'] = self.memory_budget
+        return stats
@@ -0,0 +1,95 @@
+# Ollama LLM routed through helper_ollama_http.
+#
+# langchain's Ollama makes a fresh requests.post (and an aiohttp session for async) per call,
+# without pooling, retries or a connect timeout. CakeOllama builds the same request payload but
+# sends it through the shared OllamaClient for its base_url, or through an OllamaServerPool
+# which picks the endpoint per request and may hedge slow ones.
+
+from typing import Any, AsyncIterator, Iterator, List, Optional, Union
+
+from langchain_community.llms import Ollama
+from langchain_community.llms.ollama import OllamaEndpointNotFoundError
+
+from helper_ollama_http import get_ollama_client
+
+
+class CakeOllama(Ollama):
+    server_pool: Optional[Any] = None
+    """OllamaServerPool to route requests over, instead of base_url."""
+
+    format: Optional[Union[str, dict]] = None
+    """'json', or a JSON schema the output must follow (Ollama 0.5 and later)."""
+
+    def _request_payload(self, payload: Any, stop: Optional[List[str]] = None, **kwargs: Any) -> dict:
+        # Same parameter handling as langchain's _OllamaCommon._create_stream().
+        if self.stop is not None and stop is not None:
+            raise ValueError("`stop` found in both the input and default params.")
+        elif self.stop is not None:
+            stop = self.stop
+
+        params = self._default_params
+        for key in self._default_params:
+            if key in kwargs:
+                params[key] = kwargs[key]
+
+        if "options" in kwargs:
+            params["options"] = kwargs["options"]
+        else:
+            params["options"] = {
+                **params["options"],
+                "stop": stop,
+                **{k: v for k, v in kwargs.items() if k not in self._default_params},
+            }
+
+        if payload.get("messages"):
+            return {"messages": payload.get("messages", []), **params}
+        return {"prompt": payload.get("prompt"), "images": payload.get("images", []), **params}
+
+    def _headers(self) -> dict:
+        return {"Content-Type": "application/json",
+                **(self.headers if isinstance(self.headers, dict) else {})}
+
+    def _api_path(self, api_url: str) -> str:
+        return api_url[len(self.base_url.rstrip('/')):]
+
+    def _check_status(self, response):
+        if response.status_code == 200:
+            return
+        if response.status_code == 404:
+            raise OllamaEndpointNotFoundError(
+                "Ollama call failed with status code 404. "
+                "Maybe your model is not found "
+                f"and you should pull the model with `ollama pull {self.model}`.")
+        raise ValueError(f"Ollama call failed with status code {response.status_code}."
+                         f" Details: {response.text}")
+
+    def _create_stream(self, api_url: str, payload: Any, stop: Optional[List[str]] = None,
+                       **kwargs: Any) -> Iterator[str]:
+        request_payload = self._request_payload(payload, stop, **kwargs)
+        if self.server_pool is not None:
+            return self.server_pool.stream_lines(
+                self._api_path(api_url), request_payload, headers=self._headers(), auth=self.auth,
+                check_status=self._check_status)
+
+        client = get_ollama_client(self.base_url)
+        response = client.post_stream(self._api_path(api_url), request_payload,
+                                      headers=self._headers(), auth=self.auth)
+        self._check_status(response)
+        return response.iter_lines(decode_unicode=True)
+
+    async def _acreate_stream(self, api_url: str, payload: Any, stop: Optional[List[str]] = None,
+                              **kwargs: Any) -> AsyncIterator[str]:
+        request_payload = self._request_payload(payload, stop, **kwargs)
+        if self.server_pool is not None:
+            async for line in self.server_pool.astream_lines(
+                    self._api_path(api_url), request_payload, headers=self._headers(), auth=self.auth,
+                    check_status=self._check_status):
+                yield line
+            return
+
+        client = get_ollama_client(self.base_url)
+        response = await client.apost_stream(self._api_path(api_url), request_payload,
+                                             headers=self._headers(), auth=self.auth)
+        self._check_status(response)
+        async for line in client.aiter_lines(response):
+            yield line
@@ -0,0 +1,84 @@
+# Ollama evaluation statistics.
+#
+# Ollama reports token counts and timings with the final chunk of each response, which langchain
+# keeps in the generation_info of the LLMResult. Pass an OllamaEvalStats in the chain config
+# callbacks to collect them for a turn.
+
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+OLLAMA_STATS_KEYS = ['prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration',
+                     'load_duration', 'total_duration']
+
+
+class OllamaEvalStats(BaseCallbackHandler):
+    """
+    Sums Ollama's stats over the LLM calls of a turn. Durations are reported in nanoseconds.
+
+    prompt_eval_count only includes prompt tokens Ollama had to evaluate, so it drops when the
+    prompt prefix is served from the model's cache.
+    """
+    def __init__(self):
+        self.stats = {key: 0 for key in OLLAMA_STATS_KEYS}
+        self.calls = 0
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                for key in OLLAMA_STATS_KEYS:
+                    self.stats[key] += info.get(key, 0) or 0
+                self.calls += 1
+
+    def summary(self):
+        return (f"prompt_eval {self.stats['prompt_eval_count']} tokens "
+                f"in {self.stats['prompt_eval_duration'] / 1e6:.0f} ms, "
+                f"eval {self.stats['eval_count']} tokens in {self.stats['eval_duration'] / 1e6:.0f} ms")
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """
+    Records tracing spans (see helper_tracing) for the LLM calls of chain runs: 'prompt_build'
+    from the start of a run to its LLM call (history load and window, prompt compile), and
+    'generate' for the call, with Ollama's stats and the time to first token attached.
+    """
+    def __init__(self, tracer, model_name=None):
+        self.tracer = tracer
+        self.model_name = model_name
+        self.run_start = None
+        self.llm_start = None
+        self.first_token = None
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        if parent_run_id is None:
+            self.run_start = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.llm_start = time.perf_counter()
+        self.first_token = None
+        if self.run_start is not None:
+            self.tracer.record('prompt_build', self.llm_start - self.run_start, model=self.model_name)
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+
+    def on_llm_end(self, response, **kwargs):
+        if self.llm_start is None:
+            return
+        info = {}
+        for generations in response.generations:
+            for generation in generations:
+                info.update({key: value for key, value in (generation.generation_info or {}).items()
+                             if key in OLLAMA_STATS_KEYS})
+        time_to_first_token = self.first_token - self.llm_start if self.first_token else None
+        self.tracer.record('generate', time.perf_counter() - self.llm_start, model=self.model_name,
+                           time_to_first_token=time_to_first_token, **info)
+        self.llm_start = None
+
+    def on_llm_error(self, error, **kwargs):
+        if self.llm_start is not None:
+            self.tracer.record('generate', time.perf_counter() - self.llm_start, error=str(error),
+                               model=self.model_name)
+            self.llm_start = None
@@ -0,0 +1,233 @@
+# Deterministic routing of messages to tools, without the model.
+#
+# PreRouter.wrap(model, tool_manager) puts a router in front of the model call of the chat chain
+# (see chat_chain_load). Each matcher is called as matcher(text, history) with the user input
+# and the user and assistant messages before it, and returns a (tool name, args) invocation or
+# None to decline. The first invocation of an enabled tool is answered as if the model had
+# written it, so it's parsed, cached and invoked through the ToolManager as usual. When every
+# matcher declines the message falls through to the model.
+#
+# arithmetic_route() answers "What is 1 + 1?" or "Multiply that by 101" with add or multiply,
+# where "that", "it" or "the result" is the previous numeric result.
+
+import re
+import ast
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from langchain_core.runnables import RunnableGenerator
+
+from helper_tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Whether the model steps of the current turn were routed.
+_turn_routed = contextvars.ContextVar('pre_router_turn_routed', default=None)
+
+
+@contextmanager
+def pre_router_turn():
+    """Scope of a chat turn, see PreRouter.step_routed()."""
+    token = _turn_routed.set([])
+    try:
+        yield
+    finally:
+        _turn_routed.reset(token)
+
+
+PREVIOUS = '_previous_'
+LEAD_PATTERN = re.compile(r"^(?:(?:ok|okay|now|then|and|so|please|cake|hey),?\s+)*"
+                          r"(?:what is|what's|whats|how much is|calculate|compute|evaluate)?\s*")
+REFERENCE_PATTERN = re.compile(r"\b(?:that|it|this|the result|the answer|the previous result|ans)\b")
+WORD_OPERATORS = ((r"\bmultiplied by\b", "*"), (r"\btimes\b", "*"), (r"\bplus\b", "+"),
+                  (r"(?<=\d|_)\s*[x×]\s*(?=\d|_)", "*"))
+VERB_PATTERNS = ((re.compile(r"^multiply (\S+) (?:by|and|with) (\S+)$"), 'multiply'),
+                 (re.compile(r"^(?:the )?product of (\S+) and (\S+)$"), 'multiply'),
+                 (re.compile(r"^add (\S+) (?:to|and) (\S+)$"), 'add'),
+                 (re.compile(r"^(?:the )?sum of (\S+) and (\S+)$"), 'add'))
+NUMBER_PATTERN = re.compile(r"^`*\s*(-?\d+)\s*`*$")
+
+
+def previous_number(history):
+    """The last assistant message that is an integer, e.g. the result of add, looking back to the previous user message."""
+    for message in reversed(history):
+        if message.type == 'human':
+            break
+        if message.type == 'ai':
+            match = NUMBER_PATTERN.match(str(message.content).strip())
+            if match:
+                return int(match[1])
+    return None
+
+def _operand(token, previous):
+    if token == PREVIOUS:
+        return previous
+    if re.fullmatch(r"-?\d+", token):
+        return int(token)
+    return None
+
+def _expression_call(text, previous):
+    """The (tool, args) of a single integer addition or multiplication expression, else None."""
+    if not re.fullmatch(r"[\d\s+*()_a-z-]+", text):
+        return None
+    try:
+        node = ast.parse(text, mode='eval').body
+    except SyntaxError:
+        return None
+    if not isinstance(node, ast.BinOp) or type(node.op) not in (ast.Add, ast.Mult):
+        return None
+    operands = []
+    for operand in (node.left, node.right):
+        sign = 1
+        if isinstance(operand, ast.UnaryOp) and isinstance(operand.op, ast.USub):
+            sign, operand = -1, operand.operand
+        if isinstance(operand, ast.Constant) and type(operand.value) is int:
+            operands.append(sign * operand.value)
+        elif isinstance(operand, ast.Name) and operand.id == PREVIOUS and previous is not None:
+            operands.append(sign * previous)
+        else:
+            return None
+    return ('add' if isinstance(node.op, ast.Add) else 'multiply'), operands
+
+def arithmetic_route(text, history):
+    """
+    Route an integer addition or multiplication to add or multiply, e.g. "What is 1 + 1?",
+    "12 times 3", "Multiply that by 101" or "add 5 to the result".
+
+    Returns:
+    - tuple: (tool name, args), or None to decline.
+    """
+    text = " ".join(str(text).lower().split()).rstrip("?!. ")
+    text = LEAD_PATTERN.sub("", text, count=1)
+    text = REFERENCE_PATTERN.sub(PREVIOUS, text)
+    previous = previous_number(history) if PREVIOUS in text else None
+    if PREVIOUS in text and previous is None:
+        return None
+    for pattern, operator in WORD_OPERATORS:
+        text = re.sub(pattern, operator, text)
+    call = _expression_call(text, previous)
+    if call is None:
+        for pattern, tool_name in VERB_PATTERNS:
+            match = pattern.match(text)
+            if match:
+                operands = [_operand(token, previous) for token in match.groups()]
+                if None not in operands:
+                    call = tool_name, operands
+                break
+    if call is None:
+        return None
+    tool_name, (first, second) = call
+    return tool_name, {'first': first, 'second': second}
+
+
+class PreRouter:
+    def __init__(self, matchers=(arithmetic_route,), ignore_inputs=()):
+        """
+        Args:
+        - matchers (iterable): Called as matcher(text, history), returning (tool name, args) or None.
+        - ignore_inputs (iterable): User messages never routed and left out of the history, e.g.
+          the agent's continue prompt.
+        """
+        self.matchers = list(matchers)
+        self.ignore_inputs = set(ignore_inputs)
+        self.lock = threading.Lock()
+        self.stats = {'routed': 0, 'declined': 0, 'routed_seconds': 0.0,
+                      'model_steps': 0, 'model_seconds': 0.0}
+
+    def route(self, text, history, tool_manager):
+        """The model output invoking a tool for text, or None when the matchers decline."""
+        if text in self.ignore_inputs:
+            return None
+        enabled = {tool.name for tool in tool_manager.get_enabled_tools()}
+        for matcher in self.matchers:
+            try:
+                call = matcher(text, history)
+            except Exception as err:
+                logger.warning("Pre-router %s failed: %s", getattr(matcher, '__name__', matcher), err)
+                call = None
+            if call is not None and call[0] in enabled:
+                return {'tool': call[0], 'args': call[1]}
+        return None
+
+    def step_routed(self):
+        """True if the last model step of the current turn was routed."""
+        routed = _turn_routed.get()
+        return bool(routed) and routed[-1]
+
+    def _route(self, prompt_value, tool_manager):
+        messages = prompt_value.to_messages()
+        history = [message for message in messages[:-1] if message.type in ('human', 'ai')
+                   and not (message.type == 'human' and message.content in self.ignore_inputs)]
+        start = time.perf_counter()
+        with tracer.span('pre_router') as span:
+            model_output = self.route(str(messages[-1].content), history, tool_manager)
+            span.set(route=model_output['tool'] if model_output else None)
+        with self.lock:
+            if model_output is not None:
+                self.stats['routed'] += 1
+                self.stats['routed_seconds'] += time.perf_counter() - start
+            elif messages[-1].content not in self.ignore_inputs:
+                self.stats['declined'] += 1
+        routed = _turn_routed.get()
+        if routed is not None:
+            routed.append(model_output is not None)
+        if model_output is not None:
+            logger.info("Pre-routed to %s", model_output['tool'])
+            return json.dumps(model_output)
+        return None
+
+    def _model_step(self, seconds):
+        with self.lock:
+            self.stats['model_steps'] += 1
+            self.stats['model_seconds'] += seconds
+
+    def wrap(self, model, tool_manager):
+        """The model as a runnable answering routed messages itself, as a single chunk."""
+        def transform(prompt_values, config):
+            for prompt_value in prompt_values:
+                routed = self._route(prompt_value, tool_manager)
+                if routed is not None:
+                    yield routed
+                    continue
+                start = time.perf_counter()
+                yield from model.stream(prompt_value, config)
+                self._model_step(time.perf_counter() - start)
+
+        async def atransform(prompt_values, config):
+            async for prompt_value in prompt_values:
+                routed = self._route(prompt_value, tool_manager)
+                if routed is not None:
+                    yield routed
+                    continue
+                start = time.perf_counter()
+                async for chunk in model.astream(prompt_value, config):
+                    yield chunk
+                self._model_step(time.perf_counter() - start)
+
+        return RunnableGenerator(transform, atransform)
+
+    def get_stats(self):
+        """
+        Returns:
+        - dict: Messages routed and declined, the bypass_rate of routed messages, and the
+          estimated seconds_saved: the mean model step time for each routed message, less the
+          routing time.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        messages = stats['routed'] + stats['declined']
+        stats['bypass_rate'] = stats['routed'] / messages if messages else 0.0
+        mean_model_seconds = stats['model_seconds'] / stats['model_steps'] if stats['model_steps'] else 0.0
+        stats['seconds_saved'] = max(0.0, stats['routed'] * mean_model_seconds - stats['routed_seconds'])
+        return stats
+
+
+def pre_router_load(config, ignore_inputs=()):
+    """The PreRouter with arithmetic_route when [chat] pre_router is on, else None."""
+    if not config.get_boolean_by_key('chat', 'pre_router', False):
+        return None
+    return PreRouter([arithmetic_route], ignore_inputs=ignore_inputs)
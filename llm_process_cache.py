@@ -0,0 +1,75 @@
+# Process wide cache for compiled artifacts (config, engines, chains, tools).
+#
+# Streamlit re-executes the app script on every interaction, but imported modules stay loaded,
+# so anything cached here is built once per process and only rebuilt when its key changes.
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_cache = {}
+_lock = threading.RLock()
+_stats = {'hits': 0, 'misses': 0, 'build_seconds': 0.0}
+
+
+def config_mtime(config_file):
+    """Modification time of a config file, or 0 if it does not exist."""
+    try:
+        return os.path.getmtime(config_file)
+    except OSError:
+        return 0
+
+
+def process_cached(name, key, builder):
+    """
+    Return the artifact cached under name, calling builder() only if it is missing or
+    was built for a different key. The artifact it replaces is closed first (if it has a
+    close(), e.g. ChatEngine), so its threads, processes and connections don't linger and
+    the new one can take over shared resources such as the Ollama clients.
+
+    Args:
+    - name: Cache slot, e.g. ('chat_engine', config_file).
+    - key: Anything hashable and comparable that invalidates the slot when it changes,
+      e.g. (model name, tool set, config file mtime).
+    - builder (callable): Builds the artifact.
+    """
+    with _lock:
+        entry = _cache.get(name)
+        if entry is not None and entry[0] == key:
+            _stats['hits'] += 1
+            return entry[1]
+
+        _stats['misses'] += 1
+        if entry is not None:
+            del _cache[name]
+            _close(entry[1])
+        start = time.perf_counter()
+        value = builder()
+        _stats['build_seconds'] += time.perf_counter() - start
+        _cache[name] = (key, value)
+        return value
+
+
+def _close(value):
+    close = getattr(value, 'close', None)
+    if callable(close):
+        try:
+            close()
+        except Exception as err:
+            logger.warning("Closing replaced %s failed: %s", type(value).__name__, err)
+
+
+def process_cache_clear():
+    with _lock:
+        for _, value in _cache.values():
+            _close(value)
+        _cache.clear()
+
+
+def process_cache_stats():
+    """Hits, misses and total seconds spent building artifacts."""
+    with _lock:
+        return dict(_stats)
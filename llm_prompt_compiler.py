@@ -0,0 +1,79 @@
+# System prompt compiler with token accounting.
+#
+# The system prompt is a list of named blocks: the tool instructions, the parser's format
+# instructions, the environment and the purpose prompt. Only the tools enabled by the session's
+# settings are described, optionally as compact one line signatures, and each distinct set of
+# enabled tools compiles to the same messages every time, so the prompt prefix stays
+# byte-identical between turns and Ollama can reuse its evaluation of it.
+#
+# prompt_report() breaks a compiled prompt down into the token counts of its blocks, the history,
+# the session notes and the user input.
+
+import threading
+
+from langchain.schema import SystemMessage
+
+from llm_history_window import estimate_tokens, message_tokens
+
+
+class PromptCompiler:
+    def __init__(self, tool_manager, blocks, compact=False, token_counter=estimate_tokens):
+        """
+        Args:
+        - tool_manager (ToolManager): Describes the enabled tools in the 'tools' block.
+        - blocks (list): (name, text) system blocks following the tools block, empty ones are left out.
+        - compact (bool): Describe tools by their signatures instead of their docstrings.
+        - token_counter (callable): Token count of a text.
+        """
+        self.tool_manager = tool_manager
+        self.blocks = [(name, text) for name, text in blocks if text]
+        self.compact = compact
+        self.token_counter = token_counter
+        self.compiled = {}   # enabled tool names: list of SystemMessage
+        self.lock = threading.Lock()
+
+    def system_messages(self):
+        """The system messages for the tools enabled by the current settings."""
+        tools = self.tool_manager.get_enabled_tools()
+        key = tuple(tool.name for tool in tools)
+        with self.lock:
+            messages = self.compiled.get(key)
+            if messages is None:
+                blocks = [('tools', self.tool_manager.get_format_instructions(tools, self.compact))] + self.blocks
+                messages = [SystemMessage(content=text, name=name) for name, text in blocks]
+                self.compiled[key] = messages
+        return messages
+
+    def block_tokens(self):
+        """
+        Returns:
+        - dict: Block name: token count, for the tools enabled by the current settings.
+        """
+        return {message.name: self.token_counter(message.content) for message in self.system_messages()}
+
+
+def prompt_report(messages, token_counter=estimate_tokens):
+    """
+    Token breakdown of a compiled prompt: one entry per named system block, plus 'history'
+    (including its summary), 'session_notes' and 'input' (the last message).
+
+    Returns:
+    - dict: Part name: token count, in prompt order, with the 'total'.
+    """
+    report = {}
+    for index, message in enumerate(messages):
+        if index == len(messages) - 1:
+            part = 'input'
+        elif message.type == 'system' and message.name:
+            part = message.name
+        else:
+            part = 'history'
+        tokens = token_counter(message.content) if message.name else message_tokens(message, token_counter)
+        report[part] = report.get(part, 0) + tokens
+    report['total'] = sum(report.values())
+    return report
+
+
+def format_report(report):
+    """A prompt_report() as one line, e.g. "tools 120, format 45, history 300, input 12, total 477"."""
+    return ", ".join(f"{part} {tokens}" for part, tokens in report.items())
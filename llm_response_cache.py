@@ -0,0 +1,263 @@
+# Cache of model responses.
+#
+# ResponseCache.wrap(model, tool_manager) puts the cache in front of the model call of the chat
+# chain (see chat_chain_load). A response is looked up by the model, the system prefix, the last
+# few history messages and the user input:
+# - exact hits match a hash of all four, with whitespace and case of the input normalized;
+# - near hits match the same model, system prefix and history, and an input whose hashed
+#   character n-gram vector has a cosine similarity of at least similarity with the cached one,
+#   and the same numbers ("what is 1 + 2" never answers "what is 1 + 3").
+# Entries are evicted least recently used beyond max_items, and after ttl seconds.
+#
+# Responses calling a side-effecting tool (exclude_tools, e.g. python_exec) are never cached, and
+# once a response of a turn did, the rest of the turn bypasses the cache, see response_cache_turn().
+
+import re
+import json
+import math
+import time
+import hashlib
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from langchain_core.runnables import RunnableGenerator
+
+from helper_tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+NGRAM = 3
+VECTOR_DIMENSIONS = 1024
+
+# Names of the tools called by the responses of the current turn.
+_turn_tools = contextvars.ContextVar('response_cache_turn_tools', default=None)
+
+
+@contextmanager
+def response_cache_turn():
+    """Scope of a chat turn, see ResponseCache.bypassed()."""
+    token = _turn_tools.set(set())
+    try:
+        yield
+    finally:
+        _turn_tools.reset(token)
+
+
+def normalize_input(text):
+    return " ".join(str(text).lower().split())
+
+def ngram_vector(text, n=NGRAM, dimensions=VECTOR_DIMENSIONS):
+    """
+    Hashed character n-gram counts of text as a sparse unit vector {index: weight}. Words and
+    operators are separated by single spaces and punctuation is dropped first, so "1+1?" and
+    "1 + 1" are the same.
+    """
+    text = " ".join(token for token in re.findall(r'\w+|[^\w\s]', str(text).lower()) if token not in '.,;:!?"\'')
+    text = f" {text} "
+    vector = {}
+    for i in range(max(1, len(text) - n + 1)):
+        index = int.from_bytes(hashlib.blake2b(text[i:i + n].encode(), digest_size=4).digest(), 'big') % dimensions
+        vector[index] = vector.get(index, 0.0) + 1.0
+    norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+    return {index: weight / norm for index, weight in vector.items()}
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(index, 0.0) for index, weight in a.items())
+
+def _hash(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_items=256, ttl=None, similarity=0.0, history_messages=4,
+                 exclude_tools=('python_exec', 'python_reset', 'shell_exec')):
+        """
+        Args:
+        - max_items (int): Responses kept, the least recently used are evicted.
+        - ttl (float): Seconds a response is kept, None to keep it until evicted.
+        - similarity (float): Cosine similarity of a near hit, 0 for exact hits only.
+        - history_messages (int): History messages before the input in the key.
+        - exclude_tools (iterable): Tools whose calls are never cached.
+        """
+        self.max_items = max_items
+        self.ttl = ttl
+        self.similarity = similarity
+        self.history_messages = history_messages
+        self.exclude_tools = set(exclude_tools)
+        self.entries = OrderedDict()   # exact key: (context key, input vector, numbers, text, seconds, expires)
+        self.lock = threading.Lock()
+        self.stats = {'exact_hits': 0, 'near_hits': 0, 'misses': 0, 'bypassed': 0, 'stored': 0,
+                      'not_stored': 0, 'evictions': 0, 'seconds_saved': 0.0}
+
+    def keys(self, model_name, messages):
+        """
+        The context key (model, system prefix, recent history) and exact key (context and input)
+        of a compiled prompt's messages.
+        """
+        prefix = 0
+        while prefix < len(messages) - 1 and messages[prefix].type == 'system' and messages[prefix].name:
+            prefix += 1
+        system = [message.content for message in messages[:prefix]]
+        # History (with its summary) and session notes.
+        history = [(message.type, message.content) for message in messages[prefix:-1]]
+        history = history[-self.history_messages:] if self.history_messages else []
+        context_key = _hash(model_name, system, history)
+        return context_key, _hash(context_key, normalize_input(messages[-1].content))
+
+    def bypassed(self):
+        """True once a response of the current turn called one of exclude_tools."""
+        return bool((_turn_tools.get() or set()) & self.exclude_tools)
+
+    def get(self, context_key, exact_key, text):
+        """
+        Returns:
+        - tuple: ('exact' or 'near', cached entry) on a hit, (None, None) on a miss.
+        """
+        now = time.time()
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[5] is not None and entry[5] < now]:
+                del self.entries[key]
+                self.stats['evictions'] += 1
+            entry = self.entries.get(exact_key)
+            if entry is not None:
+                kind = 'exact'
+            elif self.similarity > 0:
+                kind = 'near'
+                vector, numbers = ngram_vector(text), re.findall(r'\d+(?:\.\d+)?', text)
+                best = max(((cosine(vector, candidate[1]), key) for key, candidate in self.entries.items()
+                            if candidate[0] == context_key and candidate[2] == numbers),
+                           default=(0.0, None))
+                if best[0] >= self.similarity:
+                    exact_key = best[1]
+                    entry = self.entries[exact_key]
+            if entry is None:
+                self.stats['misses'] += 1
+                return None, None
+            self.entries.move_to_end(exact_key)
+            self.stats[f'{kind}_hits'] += 1
+            self.stats['seconds_saved'] += entry[4]
+            return kind, entry
+
+    def put(self, context_key, exact_key, text, response, seconds):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries[exact_key] = (context_key, ngram_vector(text), re.findall(r'\d+(?:\.\d+)?', text),
+                                       response, seconds, expires)
+            self.entries.move_to_end(exact_key)
+            self.stats['stored'] += 1
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def called_tools(self, tool_manager, response):
+        """Names of the tools a raw response calls, None if it isn't valid JSON."""
+        try:
+            model_output = json.loads(response)
+        except ValueError:
+            return None
+        calls = tool_manager.tool_calls(model_output)
+        if calls is None:
+            calls = [model_output]
+        default = tool_manager.get_tool_setting('default_tool')
+        names = set()
+        for call in calls:
+            name = call.get('tool', default) if isinstance(call, dict) else None
+            names.add(tool_manager.match_tool(name) or name)
+        return names
+
+    def _lookup(self, model_name, prompt_value):
+        """The (context key, exact key, text, cached entry) of a prompt, entry None on a miss or bypass."""
+        messages = prompt_value.to_messages()
+        text = str(messages[-1].content)
+        context_key, exact_key = self.keys(model_name, messages)
+        with tracer.span('response_cache', model=model_name) as span:
+            if self.bypassed():
+                with self.lock:
+                    self.stats['bypassed'] += 1
+                span.set(hit='bypassed')
+                return context_key, exact_key, text, None
+            kind, entry = self.get(context_key, exact_key, text)
+            span.set(hit=kind or 'miss')
+        return context_key, exact_key, text, entry
+
+    def _store(self, tool_manager, lookup, response, seconds):
+        context_key, exact_key, text, _ = lookup
+        names = self.called_tools(tool_manager, response)
+        turn_tools = _turn_tools.get()
+        if turn_tools is not None and names:
+            turn_tools.update(names)
+        if names is None or names & self.exclude_tools or self.bypassed():
+            with self.lock:
+                self.stats['not_stored'] += 1
+            return
+        self.put(context_key, exact_key, text, response, seconds)
+
+    def _hit(self, tool_manager, entry):
+        turn_tools = _turn_tools.get()
+        if turn_tools is not None:
+            turn_tools.update(self.called_tools(tool_manager, entry[3]) or ())
+        return entry[3]
+
+    def wrap(self, model, tool_manager):
+        """The model as a runnable answering from the cache, streaming a hit as a single chunk."""
+        model_name = getattr(model, 'model', None)
+
+        def transform(prompt_values, config):
+            for prompt_value in prompt_values:
+                lookup = self._lookup(model_name, prompt_value)
+                if lookup[3] is not None:
+                    yield self._hit(tool_manager, lookup[3])
+                    continue
+                start = time.perf_counter()
+                chunks = []
+                for chunk in model.stream(prompt_value, config):
+                    chunks.append(chunk)
+                    yield chunk
+                # Only responses streamed to the end are stored, not cancelled ones.
+                self._store(tool_manager, lookup, "".join(chunks), time.perf_counter() - start)
+
+        async def atransform(prompt_values, config):
+            async for prompt_value in prompt_values:
+                lookup = self._lookup(model_name, prompt_value)
+                if lookup[3] is not None:
+                    yield self._hit(tool_manager, lookup[3])
+                    continue
+                start = time.perf_counter()
+                chunks = []
+                async for chunk in model.astream(prompt_value, config):
+                    chunks.append(chunk)
+                    yield chunk
+                self._store(tool_manager, lookup, "".join(chunks), time.perf_counter() - start)
+
+        return RunnableGenerator(transform, atransform)
+
+    def get_stats(self):
+        """
+        Returns:
+        - dict: Exact and near hits, misses, lookups bypassed in turns calling exclude_tools,
+          responses stored and not stored, evictions, the generation seconds saved by hits and
+          the hit_rate.
+        """
+        with self.lock:
+            stats = dict(self.stats, items=len(self.entries))
+        lookups = stats['exact_hits'] + stats['near_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['exact_hits'] + stats['near_hits']) / lookups if lookups else 0.0
+        return stats
+
+
+def response_cache_load(config):
+    """The ResponseCache configured by [chat] response_cache*, None when disabled."""
+    if not config.get_boolean_by_key('chat', 'response_cache', False):
+        return None
+    return ResponseCache(
+        max_items=int(config.get_value_by_key('chat', 'response_cache_items', 256)),
+        ttl=float(config.get_value_by_key('chat', 'response_cache_ttl', 0)) or None,
+        similarity=float(config.get_value_by_key('chat', 'response_cache_similarity', 0)),
+        history_messages=int(config.get_value_by_key('chat', 'response_cache_history_messages', 4)),
+        exclude_tools=config.get_value_by_key('chat', 'response_cache_exclude_tools',
+                                              'python_exec, python_reset, shell_exec').replace(',', ' ').split())
@@ -0,0 +1,163 @@
+# Memoization of tool results.
+#
+# Tools declare a CachePolicy when registered with ToolManager: CACHE_PURE results depend only
+# on the arguments and are kept until evicted, cache_ttl(seconds) results expire, and
+# CACHE_NEVER tools (the default, e.g. anything with side effects) always run.
+
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+
+class CachePolicy(NamedTuple):
+    kind: str                     # 'pure', 'ttl' or 'never'
+    ttl: Optional[float] = None   # seconds, for 'ttl'
+
+CACHE_PURE = CachePolicy('pure')
+CACHE_NEVER = CachePolicy('never')
+
+def cache_ttl(seconds):
+    return CachePolicy('ttl', float(seconds))
+
+
+def canonical_args(tool, args):
+    """
+    Arguments in canonical form: validated by the tool's schema when it has one, so e.g.
+    {"first": "1"} and {"first": 1} are the same call.
+    """
+    schema = getattr(tool, 'args_schema', None)
+    if schema is not None and isinstance(args, dict):
+        try:
+            return schema(**args).model_dump() if hasattr(schema, 'model_dump') else schema(**args).dict()
+        except Exception:
+            pass
+    return args
+
+def args_key(tool_name, args):
+    """Hash of the tool name and arguments, independent of key order and whitespace."""
+    blob = json.dumps({'tool': tool_name, 'args': args}, sort_keys=True, separators=(',', ':'),
+                      default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class ToolResultCache:
+    """
+    Bounded LRU cache of tool results, accounted by their pickled size, with optional
+    persistence to a SQLite file so results survive restarts.
+
+    Results that can't be pickled, or are larger than max_bytes, are not cached.
+    """
+    def __init__(self, max_items=1024, max_bytes=16 * 1024 * 1024, db_file=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()   # key: (tool_name, value blob, expires)
+        self.bytes = 0
+        self.lock = threading.RLock()
+        self.stats = {}                # tool name: {'hits', 'misses'}
+        self.db = None
+        if db_file:
+            self.db = sqlite3.connect(db_file, check_same_thread=False)
+            with self.db:
+                self.db.execute("CREATE TABLE IF NOT EXISTS tool_cache ("
+                                "key TEXT PRIMARY KEY, tool TEXT, value BLOB, expires REAL)")
+                self.db.execute("DELETE FROM tool_cache WHERE expires IS NOT NULL AND expires < ?",
+                                (time.time(),))
+
+    def _count(self, tool_name, kind):
+        counts = self.stats.setdefault(tool_name, {'hits': 0, 'misses': 0})
+        counts[kind] += 1
+
+    def get(self, tool_name, key):
+        """
+        Returns:
+        - tuple: (True, result) on a hit, (False, None) on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.db is not None:
+                row = self.db.execute("SELECT tool, value, expires FROM tool_cache WHERE key = ?",
+                                      (key,)).fetchone()
+                if row is not None:
+                    entry = row
+                    self._insert(key, entry)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._count(tool_name, 'misses')
+                return False, None
+            self.entries.move_to_end(key)
+            self._count(tool_name, 'hits')
+            return True, pickle.loads(entry[1])
+
+    def put(self, tool_name, key, result, policy):
+        if policy.kind == 'never':
+            return
+        try:
+            blob = pickle.dumps(result)
+        except Exception:
+            return
+        if len(blob) > self.max_bytes:
+            return
+        expires = time.time() + policy.ttl if policy.kind == 'ttl' else None
+        entry = (tool_name, blob, expires)
+        with self.lock:
+            self._insert(key, entry)
+            if self.db is not None:
+                with self.db:
+                    self.db.execute("INSERT OR REPLACE INTO tool_cache VALUES (?, ?, ?, ?)",
+                                    (key, tool_name, blob, expires))
+
+    def _insert(self, key, entry):
+        if key in self.entries:
+            self.bytes -= len(self.entries.pop(key)[1])
+        self.entries[key] = entry
+        self.bytes += len(entry[1])
+        while len(self.entries) > self.max_items or self.bytes > self.max_bytes:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.bytes -= len(old_entry[1])
+            if self.db is not None:
+                with self.db:
+                    self.db.execute("DELETE FROM tool_cache WHERE key = ?", (old_key,))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[1])
+        if self.db is not None:
+            with self.db:
+                self.db.execute("DELETE FROM tool_cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            if self.db is not None:
+                with self.db:
+                    self.db.execute("DELETE FROM tool_cache")
+
+    def close(self):
+        """Close the database, the cache keeps working in memory."""
+        with self.lock:
+            db, self.db = self.db, None
+        if db is not None:
+            db.close()
+
+    def get_stats(self):
+        """
+        Returns:
+        - dict: Per tool hits, misses and hit_rate, plus the number of entries and their bytes
+          under the '_cache' key.
+        """
+        with self.lock:
+            stats = {name: dict(counts, hit_rate=counts['hits'] / (counts['hits'] + counts['misses']))
+                     for name, counts in self.stats.items()}
+            stats['_cache'] = {'entries': len(self.entries), 'bytes': self.bytes,
+                               'max_items': self.max_items, 'max_bytes': self.max_bytes}
+        return stats
+
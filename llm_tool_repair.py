@@ -0,0 +1,204 @@
+# Local recovery of malformed tool invocations.
+#
+# Small models often produce almost valid output: JSON in a fenced code block, single quoted
+# strings, text after the blob, a missing closing brace, a misspelled tool name or "1" where
+# an int is expected. Repairing that here is much cheaper than another generation, so only
+# output that can't be recovered goes back to the model as an error.
+#
+# Output cut off mid-generation (e.g. by num_predict) is only closed when the caller allows it:
+# code or a command missing its end must not be run, see TruncatedOutput.
+
+import re
+import ast
+import json
+import difflib
+
+from langchain_core.utils.json import parse_json_markdown
+
+FENCE_PATTERN = re.compile(r'```(?:json|JSON)?\s*(.*?)(?:```|$)', re.DOTALL)
+PY_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+
+
+class TruncatedOutput(ValueError):
+    """The output ends inside a string, object or array. value is the output with those closed."""
+    def __init__(self, message, value):
+        super().__init__(message)
+        self.value = value
+
+
+def _balance(text):
+    """
+    Rewrite the first JSON value in text: single quoted strings become double quoted, Python
+    literals become JSON ones, text after the value is dropped and unclosed strings, objects
+    and arrays are closed.
+
+    Returns:
+    - tuple: The rewritten text, and True if anything had to be closed.
+    """
+    start = min([i for i in (text.find('{'), text.find('[')) if i >= 0], default=-1)
+    if start < 0:
+        raise ValueError("No JSON object found")
+    out = []
+    stack = []
+    quote = None
+    i = start
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if ch == '\\' and i + 1 < len(text):
+                out.append(ch + text[i + 1])
+                i += 2
+                continue
+            if ch == quote:
+                out.append('"')
+                quote = None
+            elif ch == '"':
+                out.append('\\"')   # a double quote inside a single quoted string
+            else:
+                out.append(ch)
+            i += 1
+            continue
+        if ch in '"\'':
+            quote = ch
+            out.append('"')
+        elif ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+            out.append(ch)
+        elif ch in '}]':
+            if stack:
+                out.append(stack.pop())
+            if not stack:
+                break
+        else:
+            word = re.match(r'(True|False|None)\b', text[i:])
+            if word:
+                out.append(PY_LITERALS[word.group(0)])
+                i += len(word.group(0))
+                continue
+            out.append(ch)
+        i += 1
+    truncated = bool(quote or stack)
+    if quote:
+        out.append('"')
+    fixed = "".join(out)
+    fixed = re.sub(r',\s*$', '', fixed)
+    fixed += "".join(reversed(stack))
+    return re.sub(r',(\s*[}\]])', r'\1', fixed), truncated
+
+
+def _parse_complete(text):
+    return json.loads(text, strict=False)
+
+def repair_json(text, complete=False):
+    """
+    Parse model output into a JSON value, repairing it if needed.
+
+    Args:
+    - complete (bool): Raise TruncatedOutput rather than close a cut off output.
+
+    Raises:
+    - ValueError: If nothing can be recovered.
+    """
+    if not isinstance(text, str):
+        return text
+    try:
+        # parse_partial_json (the default parser) closes cut off output without telling.
+        return parse_json_markdown(text, parser=_parse_complete) if complete else parse_json_markdown(text)
+    except Exception:
+        pass
+    fenced = FENCE_PATTERN.search(text)
+    candidate = fenced.group(1) if fenced else text
+    try:
+        fixed, truncated = _balance(candidate)
+        value = json.loads(fixed)
+    except ValueError:
+        pass
+    else:
+        if truncated and complete:
+            raise TruncatedOutput(f"The output was cut off: {text[-100:]}", value)
+        return value
+    try:
+        value = ast.literal_eval(candidate.strip())
+        if isinstance(value, (dict, list)):
+            return value
+    except (ValueError, SyntaxError):
+        pass
+    raise ValueError(f"Could not parse a tool invocation from: {text[:200]}")
+
+
+def _normalize_name(name):
+    return re.sub(r'[\s\-]+', '_', str(name).strip()).lower()
+
+def match_tool_name(name, names, cutoff=0.75):
+    """The registered tool name closest to name, or None if none is close enough."""
+    if name in names:
+        return name
+    normalized = {_normalize_name(n): n for n in names}
+    if _normalize_name(name) in normalized:
+        return normalized[_normalize_name(name)]
+    close = difflib.get_close_matches(_normalize_name(name), list(normalized), n=1, cutoff=cutoff)
+    return normalized[close[0]] if close else None
+
+
+def coerce_args(tool, args, call=None):
+    """
+    Fit args to the tool's schema: JSON strings are parsed, a bare value or list fills the
+    parameters in order, parameters given next to 'args' in the call are picked up, unknown
+    keys are dropped and values are converted to the declared types.
+    """
+    fields = list(getattr(tool, 'args', {}) or {})
+    if isinstance(args, str) and fields:
+        try:
+            args = repair_json(args) if args.strip()[:1] in '{[' else args
+        except ValueError:
+            pass
+    if args is None:
+        args = {}
+    if not isinstance(args, dict):
+        values = args if isinstance(args, list) else [args]
+        args = dict(zip(fields, values))
+    if call is not None:
+        for field in fields:
+            if field not in args and field in call:
+                args[field] = call[field]
+    if fields:
+        args = {key: value for key, value in args.items() if key in fields}
+    schema = getattr(tool, 'args_schema', None)
+    if schema is not None:
+        try:
+            validated = schema(**args)
+            return {key: value for key, value in
+                    (validated.model_dump() if hasattr(validated, 'model_dump') else validated.dict()).items()
+                    if key in args}
+        except Exception:
+            pass
+    return args
+
+
+def _args_json_schema(schema):
+    # Pydantic v2 models have model_json_schema(), schema() is deprecated there. The args schemas
+    # langchain_core 0.2 builds for @tool are pydantic.v1 models, which only have schema().
+    if hasattr(schema, 'model_json_schema'):
+        return schema.model_json_schema()
+    return schema.schema()
+
+
+def tool_json_schema(tools):
+    """
+    JSON schema of a tool invocation, or a 'tool_calls' list of them, for Ollama's format
+    parameter. Each tool's args follow its args schema.
+    """
+    calls = []
+    for tool in tools:
+        args_schema = {'type': 'object', 'properties': dict(getattr(tool, 'args', {}) or {})}
+        schema = getattr(tool, 'args_schema', None)
+        required = _args_json_schema(schema).get('required', []) if schema is not None else []
+        if required:
+            args_schema['required'] = required
+        calls.append({'type': 'object',
+                      'properties': {'tool': {'type': 'string', 'enum': [tool.name]}, 'args': args_schema},
+                      'required': ['tool', 'args']})
+    call = {'anyOf': calls}
+    return {'anyOf': calls + [{'type': 'object',
+                               'properties': {'tool_calls': {'type': 'array', 'items': call}},
+                               'required': ['tool_calls']}]}
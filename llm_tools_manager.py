@@ -1,7 +1,22 @@
 # Generic manager for tools
 
-from operator import itemgetter
+import logging
+import re
+import json
+import time
+import asyncio
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, NamedTuple, Optional
 from langchain.tools.render import render_text_description
+from langchain_core.runnables import RunnableLambda
+
+from llm_tool_cache import CACHE_NEVER, canonical_args, args_key
+from llm_tool_repair import repair_json, match_tool_name, coerce_args, tool_json_schema, TruncatedOutput
+from helper_tracing import tracer, current_span
+
+logger = logging.getLogger(__name__)
 
 class SettingsCache:
     def __init__(self):
@@ -16,19 +31,92 @@ class SettingsCache:
     def get_all(self):
         return self.settings_cache
 
+# Settings for the session currently being served. ToolManagers are shared across sessions,
+# so per-session settings (options, UI callbacks) are bound here rather than stored on them.
+_session_settings = contextvars.ContextVar('session_settings', default=None)
+_session_id = contextvars.ContextVar('session_id', default=None)
+
+@contextmanager
+def use_settings(settings_cache, session_id=None):
+    """Bind a SettingsCache (and the chat session id) for the current session while in the with block."""
+    token = _session_settings.set(settings_cache)
+    id_token = _session_id.set(session_id)
+    try:
+        yield settings_cache
+    finally:
+        _session_id.reset(id_token)
+        _session_settings.reset(token)
+
+def set_session_settings(settings_cache):
+    """Bind a SettingsCache for the rest of the current context (e.g. a streamlit script run)."""
+    _session_settings.set(settings_cache)
+
+def get_session_id():
+    """The chat session id bound by use_settings(), e.g. to keep per-session tool state."""
+    return _session_id.get()
+
+def bind_settings(func):
+    """Wrap func so it runs with the currently bound settings, e.g. for deferred UI callbacks."""
+    settings_cache = _session_settings.get()
+    session_id = _session_id.get()
+
+    def bound(*args, **kwargs):
+        with use_settings(settings_cache, session_id):
+            return func(*args, **kwargs)
+    return bound
+
 class ToolManager:
-    def __init__(self, initial_config=None, settings_cache=SettingsCache()):
-        print(f"\n\n ** TOOL RESET ** \n\n")
+    def __init__(self, initial_config=None, settings_cache=SettingsCache(), result_cache=None):
+        """
+        Args:
+        - initial_config (Config): Chat configuration.
+        - settings_cache (SettingsCache): Tool settings, overridden by session bound ones.
+        - result_cache (ToolResultCache): Memoizes results of tools registered with a caching
+          policy, may be shared between ToolManagers.
+        """
+        logger.debug("ToolManager created")
         self.tools = {}
+        self.cache_policies = {}
+        self.required_settings = {}   # tool name: setting that must be true to offer the tool
+        self.summaries = {}           # tool name: description for compact rendering
+        self.side_effects = set()     # tools never run from a cut off output
+        self.session_note_providers = []
         self.config = initial_config
         self.settings_data = settings_cache
+        self.result_cache = result_cache
+        self.max_workers = int(initial_config.get_value_by_key('chat', 'tool_max_workers', 4)) \
+            if initial_config else 4
+        self.executor = None
 
-    def load_tools(self, tools):
+    def load_tools(self, tools, cache_policies=None, required_settings=None, summaries=None,
+                   side_effects=()):
+        """
+        Args:
+        - cache_policies (dict): Tool name: CachePolicy, tools not in it are never cached.
+        - required_settings (dict): Tool name: setting key, the tool is only described to the
+          model while that setting is true, see get_enabled_tools().
+        - summaries (dict): Tool name: short description used instead of the docstring by
+          compact rendering, see render_text_description().
+        - side_effects (iterable): Tools never run from a cut off output, see parse_output().
+        """
+        cache_policies = cache_policies or {}
+        required_settings = required_settings or {}
+        summaries = summaries or {}
         for tool_func in tools:
-            self.add_tool(tool_func.name, tool_func)
+            self.add_tool(tool_func.name, tool_func, cache_policies.get(tool_func.name, CACHE_NEVER),
+                          required_settings.get(tool_func.name), summaries.get(tool_func.name),
+                          tool_func.name in side_effects)
 
-    def add_tool(self, name: str, func):
+    def add_tool(self, name: str, func, cache_policy=CACHE_NEVER, required_setting=None, summary=None,
+                 side_effect=False):
         self.tools[name] = func
+        self.cache_policies[name] = cache_policy
+        self.required_settings[name] = required_setting
+        self.summaries[name] = summary
+        if side_effect:
+            self.side_effects.add(name)
+        else:
+            self.side_effects.discard(name)
 
     def get_tool(self, name: str):
         return self.tools.get(name, None)
@@ -36,29 +124,263 @@ class ToolManager:
     def get_tools(self):
         return list(self.tools.values())
 
+    def get_enabled_tools(self):
+        """The tools whose required setting (if any) is true in the current settings."""
+        return [tool for name, tool in self.tools.items()
+                if not self.required_settings.get(name) or self.get_tool_setting(self.required_settings[name])]
+
+    @staticmethod
+    def tool_calls(model_output):
+        """The list of invocations in model_output, or None for a single invocation."""
+        if isinstance(model_output, list):
+            return model_output
+        if isinstance(model_output, dict) and isinstance(model_output.get('tool_calls'), list):
+            return model_output['tool_calls']
+        return None
+
+    def match_tool(self, name):
+        """The registered tool name for name, allowing for case and small spelling differences."""
+        matched = match_tool_name(name, list(self.tools)) if name is not None else None
+        if matched is not None and matched != name:
+            logger.info("Tool %s matched to %s", name, matched)
+        return matched
+
     def tool_chain(self, model_output):
-        default = self.settings_data.get('default_tool')
-        chosen_tool_name = model_output.get('tool', default)
-        print(f"Tool_chain {model_output} type {type(model_output)}")
-        chosen_tool = self.get_tool(chosen_tool_name)
+        """
+        The runnable executing a model output: raw text (repaired if malformed, see
+        llm_tool_repair), a tool invocation dict or several of them in 'tool_calls'.
+        Tool names are matched and args fitted to the tool's schema, the runnable ignores its input.
+        """
+        if isinstance(model_output, str):
+            model_output = self.parse_output(model_output)
+        calls = self.tool_calls(model_output)
+        if calls is not None:
+            if len(calls) == 1:
+                return self.tool_chain(calls[0])
+            return RunnableLambda(lambda _: self.invoke_many(calls),
+                                  afunc=lambda _: self.ainvoke_many(calls))
+        if not isinstance(model_output, dict):
+            raise ValueError(f"Expected a JSON object with 'tool' and 'args', got: {model_output}")
+
+        default = self.get_tool_setting('default_tool')
+        chosen_tool_name = self.match_tool(model_output.get('tool', default))
+        logger.debug("Tool_chain %s", model_output)
+        chosen_tool = self.get_tool(chosen_tool_name) if chosen_tool_name else None
         if chosen_tool:
-            print(f"chosen tool {chosen_tool}")
-            return itemgetter("args") | chosen_tool
+            args = coerce_args(chosen_tool, model_output.get('args'), model_output)
+            return RunnableLambda(lambda _, config: self.invoke_tool(chosen_tool_name, args, config),
+                                  afunc=lambda _, config: self.ainvoke_tool(chosen_tool_name, args, config))
         else:
-            raise ValueError(f"Tool {chosen_tool_name} not found.")
+            raise ValueError(f"Tool {model_output.get('tool', default)} not found.")
+
+    def parse_output(self, text):
+        """
+        Parse raw model output into an invocation, repairing it if needed. Output cut off before
+        its end (e.g. by num_predict) is only completed when it calls no side_effects tool.
+
+        Raises:
+        - ValueError: If nothing can be recovered, or a side-effecting call was cut off.
+        """
+        try:
+            return repair_json(text, complete=True)
+        except TruncatedOutput as err:
+            calls = self.tool_calls(err.value)
+            default = self.get_tool_setting('default_tool')
+            for call in calls if calls is not None else [err.value]:
+                name = self.match_tool(call.get('tool', default)) if isinstance(call, dict) else None
+                if name in self.side_effects:
+                    raise ValueError(f"The {name} invocation was cut off before its end and was not run, "
+                                     f"respond with a shorter, complete one.") from err
+            return err.value
+
+    def _cache_key(self, name, args):
+        return args_key(name, canonical_args(self.get_tool(name), args))
+
+    def _cached(self, name):
+        return self.result_cache is not None and self.cache_policies.get(name, CACHE_NEVER) != CACHE_NEVER
+
+    def invoke_tool(self, name: str, args, config=None):
+        """Invoke a tool in a 'tool' tracing span, through the result cache if it has a caching policy."""
+        with tracer.span('tool', tool=name):
+            if self._cached(name):
+                return self.invoke_cached(name, args, config)
+            return self.get_tool(name).invoke(args, config)
+
+    async def ainvoke_tool(self, name: str, args, config=None):
+        """Async version of invoke_tool()."""
+        with tracer.span('tool', tool=name):
+            if self._cached(name):
+                return await self.ainvoke_cached(name, args, config)
+            return await self.get_tool(name).ainvoke(args, config)
+
+    def invoke_cached(self, name: str, args, config=None):
+        """Invoke a tool, returning its cached result for the same arguments if there is one."""
+        key = self._cache_key(name, args)
+        hit, result = self.result_cache.get(name, key)
+        self._trace_cache(hit)
+        if not hit:
+            result = self.get_tool(name).invoke(args, config)
+            self.result_cache.put(name, key, result, self.cache_policies[name])
+        return result
+
+    async def ainvoke_cached(self, name: str, args, config=None):
+        """Async version of invoke_cached()."""
+        key = self._cache_key(name, args)
+        hit, result = self.result_cache.get(name, key)
+        self._trace_cache(hit)
+        if not hit:
+            result = await self.get_tool(name).ainvoke(args, config)
+            self.result_cache.put(name, key, result, self.cache_policies[name])
+        return result
+
+    @staticmethod
+    def _trace_cache(hit):
+        span = current_span()
+        if span is not None:
+            span.set(cache_hit=hit)
+
+    def _invoke_call(self, call):
+        return self.tool_chain(call).invoke(call)
+
+    async def _ainvoke_call(self, call):
+        return await self.tool_chain(call).ainvoke(call)
+
+    def _side_effect(self, call):
+        name = call.get('tool', self.get_tool_setting('default_tool')) if isinstance(call, dict) else None
+        return (self.match_tool(name) if name is not None else None) in self.side_effects
+
+    def invoke_many(self, calls):
+        """
+        Run several independent tool invocations concurrently on a bounded thread pool.
+        Each runs with the caller's context (e.g. session settings), see merge_results().
+        side_effects tools run in call order on the calling thread instead: they depend on each
+        other's state and may use the UI (e.g. python_exec's dialog needs the streamlit script run).
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                               thread_name_prefix='tool')
+        futures = [None if self._side_effect(call) else
+                   self.executor.submit(contextvars.copy_context().run, self._invoke_call, call)
+                   for call in calls]
+        results = []
+        for call, future in zip(calls, futures):
+            try:
+                results.append(self._invoke_call(call) if future is None else future.result())
+            except Exception as e:
+                results.append(e)
+        return self.merge_results(calls, results)
+
+    async def ainvoke_many(self, calls):
+        """
+        Async version of invoke_many(), the invocations run as concurrent tasks while the
+        side_effects ones are awaited one by one in call order.
+        """
+        side_effects = [self._side_effect(call) for call in calls]
+        concurrent = asyncio.gather(*[self._ainvoke_call(call) for call, side_effect
+                                      in zip(calls, side_effects) if not side_effect],
+                                    return_exceptions=True)
+        sequential = []
+        try:
+            for call, side_effect in zip(calls, side_effects):
+                if side_effect:
+                    try:
+                        sequential.append(await self._ainvoke_call(call))
+                    except Exception as e:
+                        sequential.append(e)
+        except BaseException:
+            concurrent.cancel()
+            raise
+        concurrent, sequential = iter(await concurrent), iter(sequential)
+        results = [next(sequential) if side_effect else next(concurrent) for side_effect in side_effects]
+        return self.merge_results(calls, results)
+
+    def merge_results(self, calls, results):
+        """
+        Merge the results of several invocations into a single ToolReturn, in call order.
+        A failed call is reported in the message without affecting the others, and data keys
+        that several calls return are suffixed with the call number.
+        """
+        lines = []
+        data = {}
+        for i, (call, result) in enumerate(zip(calls, results), 1):
+            name = call.get('tool', self.get_tool_setting('default_tool')) if isinstance(call, dict) else None
+            if isinstance(result, Exception):
+                logger.warning("Tool call %d %s failed: %s", i, call, result)
+                lines.append(f"Execution Attempt of {name} failed, error: {result}")
+                continue
+            if isinstance(result, ToolReturn):
+                for key, value in (result.data or {}).items():
+                    data[key if key not in data else f"{key}_{i}"] = value
+                result = result.message
+            if name == self.get_tool_setting('default_tool'):
+                lines.append(str(result))
+            else:
+                lines.append(f"{name}({json.dumps(call.get('args', {}))}): {result}")
+        return ToolReturn("\n".join(lines), data or None)
+
+    def close(self):
+        """Shut down the thread pool of invoke_many()."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def get_cache_stats(self):
+        """Per tool hit rates of the result cache, see ToolResultCache.get_stats()."""
+        return self.result_cache.get_stats() if self.result_cache is not None else {}
+
+    def get_json_schema(self):
+        """JSON schema of the invocations of our tools, see tool_json_schema()."""
+        return tool_json_schema(self.get_tools())
+
+    def tool_stream(self, chunks, on_tool=None):
+        """Wrap a stream of raw model tokens in a ToolStream for early tool dispatch."""
+        return ToolStream(self, chunks, on_tool=on_tool)
+
+    def add_session_note(self, provider):
+        """
+        Register provider(session_id), returning a note about the session's tool state (or
+        None) for the model to see with the next user message.
+        """
+        self.session_note_providers.append(provider)
+
+    def get_session_notes(self, session_id):
+        notes = [provider(session_id) for provider in self.session_note_providers]
+        return [note for note in notes if note]
 
     def set_tool_settings(self, settings: dict):
         self.settings_data.set(settings)
 
     def get_tool_setting(self, key: str):
+        """Session bound settings (see use_settings) take priority over our own."""
+        session_settings = _session_settings.get()
+        if session_settings is not None and key in session_settings.get_all():
+            return session_settings.get(key)
         return self.settings_data.get(key, None)
 
-    def render_text_description(self):
-        return render_text_description(self.get_tools())
+    def render_compact_description(self, tool):
+        """
+        One line per tool: its signature and its summary, or the first paragraph of its
+        docstring, e.g. "add(first: integer, second: integer) - Add two integers."
+        """
+        args = ", ".join(f"{name}: {schema.get('type', 'any')}"
+                         for name, schema in (getattr(tool, 'args', {}) or {}).items())
+        description = self.summaries.get(tool.name) or (tool.description or "").strip().split("\n\n")[0]
+        return f"{tool.name}({args}) - {' '.join(description.split())}"
+
+    def render_text_description(self, tools=None, compact=False):
+        """
+        Args:
+        - tools (list): Tools to describe, defaults to all.
+        - compact (bool): Signatures with short descriptions instead of full docstrings.
+        """
+        tools = self.get_tools() if tools is None else tools
+        if compact:
+            return "\n".join(self.render_compact_description(tool) for tool in tools)
+        return render_text_description(tools)
 
-    def get_format_instructions(self):
+    def get_format_instructions(self, tools=None, compact=False):
+        """The tool use instructions for the tools (defaults to all), see render_text_description()."""
 
-        rendered_tools = self.render_text_description()
+        rendered_tools = self.render_text_description(tools, compact)
 
         DEFAULT_SYSTEM_PROMPT = f"""
         You are an assistant that must use the following set of tools.
@@ -70,14 +392,172 @@ class ToolManager:
         Respond only with a JSON blob and no extra text outside that.
         The JSON blob must contain a single tool invocation which has both a parameter
         called 'tool' for the tool name, and a second key called 'args' which contains a
-        dictonary of parameters matching the tool prototype. """
+        dictonary of parameters matching the tool prototype.
+        To make several independent tool invocations at once, respond with a JSON blob
+        with a single key called 'tool_calls' containing a list of tool invocations. """
 
+        if compact:
+            # The indentation alone costs dozens of tokens on every turn.
+            return "\n".join(line.strip() for line in DEFAULT_SYSTEM_PROMPT.strip().splitlines())
         return DEFAULT_SYSTEM_PROMPT
 
 
-from typing import Dict, Any, NamedTuple, Optional
-
 class ToolReturn(NamedTuple):
     message: str
     data: Optional[Dict[str, Any]]
 
+
+
+class ToolStreamParser:
+    """
+    Incrementally parse a JSON tool invocation as the model streams it.
+
+    The tool name is known as soon as the "tool" key is complete, and for tools listed in
+    stream_tools the value of stream_arg is decoded and handed back as it arrives.
+    """
+    TOOL_PATTERN = re.compile(r'"tool"\s*:\s*"((?:[^"\\]|\\.)*)"')
+    FIRST_KEY_PATTERN = re.compile(r'\s*(?:(\[)|\{\s*"((?:[^"\\]|\\.)*)")')
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, stream_tools=('converse',), stream_arg='response'):
+        self.buffer = ""
+        self.tool_name = None
+        self.multi = None   # several invocations, known once the output starts
+        self.stream_tools = stream_tools
+        self.stream_arg_pattern = re.compile(r'"' + re.escape(stream_arg) + r'"\s*:\s*"')
+        self.stream_pos = None
+        self.stream_done = False
+
+    def feed(self, chunk: str) -> str:
+        """Add a chunk of model output. Returns any newly visible text (may be empty)."""
+        self.buffer += chunk
+        if self.tool_name is None:
+            match = self.TOOL_PATTERN.search(self.buffer)
+            if match:
+                self.tool_name = json.loads(f'"{match.group(1)}"')
+        if self.multi is None:
+            match = self.FIRST_KEY_PATTERN.match(self.buffer)
+            if match:
+                self.multi = match.group(1) is not None or match.group(2) == 'tool_calls'
+        if self.multi is not False:
+            # Several invocations are merged once complete, so nothing is streamed.
+            return ""
+        if self.tool_name not in self.stream_tools or self.stream_done:
+            return ""
+        if self.stream_pos is None:
+            match = self.stream_arg_pattern.search(self.buffer)
+            if not match:
+                return ""
+            self.stream_pos = match.end()
+        return self._decode_string()
+
+    def _decode_string(self) -> str:
+        # Decode the JSON string value from stream_pos, stopping at an incomplete escape.
+        text = []
+        pos = self.stream_pos
+        while pos < len(self.buffer):
+            ch = self.buffer[pos]
+            if ch == '"':
+                self.stream_done = True
+                pos += 1
+                break
+            if ch != '\\':
+                text.append(ch)
+                pos += 1
+                continue
+            if pos + 1 >= len(self.buffer):
+                break
+            esc = self.buffer[pos + 1]
+            if esc == 'u':
+                if pos + 6 > len(self.buffer):
+                    break
+                text.append(chr(int(self.buffer[pos + 2:pos + 6], 16)))
+                pos += 6
+            else:
+                text.append(self.ESCAPES.get(esc, esc))
+                pos += 2
+        self.stream_pos = pos
+        return "".join(text)
+
+
+class ToolStream:
+    """
+    Consume raw model tokens, choose the tool as soon as it is named, stream the text of
+    conversational tools, then invoke the chosen tool once the output is complete.
+
+    chunks may be a sync or async iterable, use text()/invoke() or atext()/ainvoke() to match.
+    stats records latencies in seconds from construction: time_to_tool, time_to_first_token
+    (first text visible to the user) and total.
+    """
+    def __init__(self, tool_manager, chunks, on_tool=None):
+        self.tool_manager = tool_manager
+        self.chunks = chunks
+        self.on_tool = on_tool
+        self.parser = ToolStreamParser()
+        self.streamed = ""
+        self.model_output = None   # the parsed output, once invoked
+        self.consumed = False
+        self.start = time.perf_counter()
+        self.stats = {'time_to_tool': None, 'time_to_first_token': None, 'total': None}
+
+    def _elapsed(self):
+        return time.perf_counter() - self.start
+
+    def _feed(self, chunk):
+        text = self.parser.feed(chunk)
+        if self.parser.tool_name is not None and self.stats['time_to_tool'] is None:
+            self.stats['time_to_tool'] = self._elapsed()
+            tool_name = self.tool_manager.match_tool(self.parser.tool_name)
+            if not self.parser.multi and tool_name is None:
+                raise ValueError(f"Tool {self.parser.tool_name} not found.")
+            if self.on_tool:
+                self.on_tool(tool_name or self.parser.tool_name)
+        if text:
+            if self.stats['time_to_first_token'] is None:
+                self.stats['time_to_first_token'] = self._elapsed()
+            self.streamed += text
+        return text
+
+    def _done(self):
+        self.stats['total'] = self._elapsed()
+        if self.stats['time_to_first_token'] is None:
+            self.stats['time_to_first_token'] = self.stats['total']
+        logger.debug("Stream latency: %s", self.stats)
+
+    def text(self):
+        """Generator of visible text. Raises ValueError early if the model names an unknown tool."""
+        self.consumed = True
+        for chunk in self.chunks:
+            text = self._feed(chunk)
+            if text:
+                yield text
+
+    async def atext(self):
+        """Async generator version of text()."""
+        self.consumed = True
+        async for chunk in self.chunks:
+            text = self._feed(chunk)
+            if text:
+                yield text
+
+    def invoke(self):
+        """Drain the stream if needed and run the chosen tool on the parsed output."""
+        if not self.consumed:
+            for _ in self.text():
+                pass
+        with tracer.span('parse'):
+            model_output = self.model_output = self.tool_manager.parse_output(self.parser.buffer)
+        response = self.tool_manager.tool_chain(model_output).invoke(model_output)
+        self._done()
+        return response
+
+    async def ainvoke(self):
+        """Async version of invoke()."""
+        if not self.consumed:
+            async for _ in self.atext():
+                pass
+        with tracer.span('parse'):
+            model_output = self.model_output = self.tool_manager.parse_output(self.parser.buffer)
+        response = await self.tool_manager.tool_chain(model_output).ainvoke(model_output)
+        self._done()
+        return response
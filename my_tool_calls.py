@@ -1,13 +1,20 @@
 from langchain_core.tools import tool
 
-import subprocess
+import logging
 import traceback
 from io import StringIO
 from contextlib import redirect_stdout
 
-from llm_tools_manager import ToolManager, ToolReturn
+from llm_tools_manager import ToolManager, ToolReturn, bind_settings, get_session_id
+from llm_tool_cache import CACHE_PURE
+from llm_process_cache import process_cached
+from llm_agent_loop import AWAITING_USER_PREFIX
+from helper_exec_pool import ExecWorkerPool
+from helper_shell_exec import run_shell, truncate_to_tokens
 from helper_st_tool_options import helper_unsafe_user_dialog, auto_prompt_set
 
+logger = logging.getLogger(__name__)
+
 
 # Define tools available.
 @tool
@@ -18,7 +25,6 @@ def multiply(first: int, second: int) -> int:
 @tool
 def add(first: int, second: int) -> int:
     """Add two integers."""
-    print('adding')
     return first + second
 
 @tool
@@ -30,19 +36,40 @@ def converse(response: str) -> str:
 @tool
 def write_to_file(filename: str, data: str) -> bool:
     """Write data to a file."""
-    print(f"writing file {filename} : {data} \n\n")
+    logger.info("Writing file %s", filename)
     return True
 
 
 def shell_code_execute(command):
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
+    config = _tool_manager.config if _tool_manager else None
+    def option(key, fallback):
+        return float(config.get_value_by_key('my_tools', key, fallback)) if config else fallback
+
+    # Lines are streamed to the UI while the command runs, if it registered a callback.
+    result = run_shell(command,
+                       timeout=option('shell_exec_timeout', 60) or None,
+                       max_bytes=int(option('shell_exec_max_bytes', 64 * 1024)),
+                       on_line=_tool_manager.get_tool_setting('tool_output_callback') if _tool_manager else None,
+                       key=get_session_id())
+    # Only a token budget worth of output goes into the chat history (and the next prompt).
+    output = truncate_to_tokens(result.output, int(option('shell_exec_history_tokens', 1000)))
+    if result.timed_out:
+        return ToolReturn(f"Command timed out after {result.seconds:.0f} s! Output so far:\n{output}", None)
+    if result.cancelled:
+        return ToolReturn(f"Command cancelled! Output so far:\n{output}", None)
     if result.returncode == 0:
-        return ToolReturn(result.stdout, None)
+        return ToolReturn(output, None)
     else:
-        return ToolReturn(f"Command failed! (exit code: {result.returncode})\n{result.stderr}", None)
+        return ToolReturn(f"Command failed! (exit code: {result.returncode})\n{output}", None)
 
 def python_exec_execute(code) -> ToolReturn:
 
+    # Run in a warm worker process if configured, see my_tools_exec_pool().
+    # Within a chat session the code runs in the session's kernel, keeping its globals.
+    if _exec_pool is not None:
+        s, extras_dict = _exec_pool.run(code, session_id=get_session_id())
+        return ToolReturn(s, extras_dict)
+
     f = StringIO()
     with redirect_stdout(f):
         exec(code)
@@ -71,13 +98,13 @@ def execute_callback_return(execute_function, code, response):
             response = execute_function(code)
         except Exception as e:
             response = f"Execution Attempt failed, error: {e}"
-            print(traceback.format_exc())
+            logger.warning("Execution failed:\n%s", traceback.format_exc())
             auto_prompt_set(2)
 
     if chat_ai_callback:
         chat_ai_callback(response)
     else:
-        print("ERROR chat_ai_callback should be defined.")
+        logger.error("chat_ai_callback should be defined.")
 
 def exec_check(setting_key, execute_function, code):
     allow_unsafe = _tool_manager.get_tool_setting(setting_key)
@@ -87,9 +114,10 @@ def exec_check(setting_key, execute_function, code):
         return f"exec_check did not execute, you need to {setting_key} via settings"
 
     if present_exec_dialog == True:
-        helper_unsafe_user_dialog(code, execute_function, execute_callback_return)
+        # The dialog callback runs on a later streamlit rerun, so keep this session's settings.
+        helper_unsafe_user_dialog(code, execute_function, bind_settings(execute_callback_return))
 
-        return "Execution Attempt: Waiting for you to allow or deny code execution."
+        return f"{AWAITING_USER_PREFIX} for you to allow or deny code execution."
     else:
         return execute_function(code)
 
@@ -134,10 +162,20 @@ def python_exec(code: str) -> str:
 
        Put it in a local variable called return_object.
        Remember to return non-text objects in return_object.
+
+       Variables from earlier python_exec calls in this chat are kept, and listed in a note
+       before my message. Reuse them instead of recomputing, e.g. to change a plot.
        """
 
     return exec_check('allow_python_exec', python_exec_execute, code)
 
+@tool
+def python_reset() -> str:
+    """Clear all variables kept from earlier python_exec calls in this chat."""
+    if _exec_pool is not None:
+        _exec_pool.reset(get_session_id())
+    return "Python variables cleared."
+
 @tool
 def shell_exec(command: str) -> str:
     """Use this tool as a last resort. Run a system command. Captures stdout and returns it."""
@@ -148,17 +186,62 @@ def shell_exec(command: str) -> str:
 # Our custom tool management:
 
 _tool_manager : ToolManager = None
+_exec_pool : ExecWorkerPool = None
+
+def my_tools_exec_pool(config):
+    """
+    The process wide pool of python_exec workers configured in [my_tools], or None to exec
+    in process (python_exec_workers = 0).
+    """
+    workers = int(config.get_value_by_key('my_tools', 'python_exec_workers', 0)) if config else 0
+    if workers == 0:
+        return None
+    options = dict(
+        size=workers,
+        preload=tuple(config.get_value_by_key('my_tools', 'python_exec_preload', '').replace(',', ' ').split()),
+        timeout=float(config.get_value_by_key('my_tools', 'python_exec_timeout', 60)),
+        memory_limit_mb=int(config.get_value_by_key('my_tools', 'python_exec_memory_mb', 0)) or None,
+        max_runs=int(config.get_value_by_key('my_tools', 'python_exec_max_runs', 20)),
+        kernel_idle_seconds=float(config.get_value_by_key('my_tools', 'python_kernel_idle_seconds', 1800)),
+        max_kernels=int(config.get_value_by_key('my_tools', 'python_kernel_max', 8)))
+    return process_cached(('python_exec_pool',), tuple(options.items()), lambda: ExecWorkerPool(**options))
 
 def my_tools_init(tm, model_cache):
     global _tool_manager
+    global _exec_pool
     _tool_manager = tm
+    _exec_pool = my_tools_exec_pool(tm.config)
 
-    tools = [add, multiply, converse, python_exec, shell_exec]
+    tools = my_tools_get_tools()
 
     # set any state you want to pass into tools
     _tool_manager.set_tool_settings({'default_tool': 'converse'})
 
-    _tool_manager.load_tools(tools)
+    # Pure tools return the same result for the same arguments, so their results are cached.
+    # Exec tools are only described to the model while their setting allows them, and never run
+    # from a cut off output. Compact tool descriptions use the summaries instead of the full docstrings.
+    _tool_manager.load_tools(tools, cache_policies={'add': CACHE_PURE, 'multiply': CACHE_PURE},
+                             required_settings={'python_exec': 'allow_python_exec',
+                                                'python_reset': 'allow_python_exec',
+                                                'shell_exec': 'allow_shell_exec'},
+                             side_effects=('python_exec', 'python_reset', 'shell_exec'),
+                             summaries={'python_exec': "Last resort: run Python code, returns its stdout. "
+                                                       "Put figures and other objects to show in a variable "
+                                                       "called return_object, they are rendered with st.write(). "
+                                                       "Variables are kept between calls."})
+    _tool_manager.add_session_note(python_variables_note)
+
+def python_variables_note(session_id):
+    """Tell the model which python_exec variables its session's kernel holds."""
+    if _exec_pool is None or session_id is None:
+        return None
+    variables = _exec_pool.variables(session_id)
+    if not variables:
+        return None
+    return "python_exec variables from earlier calls: " + "; ".join(variables)
+
+def my_tools_get_tools():
+    return [add, multiply, converse, python_exec, python_reset, shell_exec]
 
 def my_tools_get_option_keys():
     # A list of setting option key bools we want to present to help us manage our tools
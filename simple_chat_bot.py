@@ -1,5 +1,6 @@
 import streamlit as st
 import uuid
+import logging
 
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_community.chat_message_histories import StreamlitChatMessageHistory
@@ -9,11 +10,14 @@ from langchain_core.output_parsers import JsonOutputParser
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 
 from langchain_core.tools import tool
-from langchain_community.llms import Ollama
 
 
 from llm_tools_manager import ToolManager, ToolReturn
 from helper_ollama_http import get_ollama_model_names
+from llm_ollama import CakeOllama
+from llm_process_cache import process_cached
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -27,7 +31,6 @@ def multiply(first: int, second: int) -> int:
 @tool
 def add(first: int, second: int) -> int:
     """Add two integers."""
-    print('adding')
     return first + second
 
 @tool
@@ -43,8 +46,12 @@ def converse(response: str) -> str:
 purpose_prompt = "You are a helpful AI agent that loves math."
 prompt_about_environment = """Our runtime is using streamlit on python, so use streamlit for rendering."""
 
-def chat_chain_load(model, tool_manager):
-    # We rely on global msgs for simplified debugging (needs cleanup imho)
+def chat_history(session_id):
+    return StreamlitChatMessageHistory(key=f"langchain_messages-{session_id}")
+
+def chat_chain_load(model, tool_manager, streaming=False):
+    # Chains are cached across reruns, so history is looked up by session rather than global msgs.
+    # With streaming the chain stops at the raw model tokens, see render_chat_ai_stream().
 
     parser =  JsonOutputParser(return_exceptions=True)
     prompt = ChatPromptTemplate.from_messages(
@@ -60,11 +67,13 @@ def chat_chain_load(model, tool_manager):
     # Docs: https://api.python.langchain.com/en/latest/runnables/langchain_core.runnables.history.RunnableWithMessageHistory.html
     chain_with_history = RunnableWithMessageHistory(
         chain_front,
-        lambda session_id: msgs,
+        chat_history,
         input_messages_key="input",
         history_messages_key="history",
-        ) | parser | tool_manager.tool_chain
-    return chain_with_history
+        )
+    if streaming:
+        return chain_with_history
+    return chain_with_history | parser | tool_manager.tool_chain
 
 
 def render_session_id(st, st_selector):
@@ -100,7 +109,23 @@ def render_chat_ai_private_note(response_str, additional_kwargs):
         msgs.add_message(AIMessage(content="{'private assistant note': tool executed successfully and return an object to user.'}"))
 
 
-def render_chat_ai_callback(st_chat, response):
+def render_chat_ai_stream(st_chat, inputs, chain_config):
+    """ Stream the model output, writing conversational text as it arrives.
+        Returns the tool response, and whether its message has already been rendered."""
+
+    placeholder = None
+    stream = tool_manager.tool_stream(chain_stream.stream(inputs, chain_config))
+    for _ in stream.text():
+        if placeholder is None:
+            placeholder = st_chat.chat_message("assistant").empty()
+        placeholder.write(stream.streamed)
+    response = stream.invoke()
+
+    st.session_state.last_stream_stats = stream.stats
+    return response, placeholder is not None
+
+
+def render_chat_ai_callback(st_chat, response, rendered=False):
     global msgs
 
     additional_kwargs: dict = {}
@@ -114,7 +139,8 @@ def render_chat_ai_callback(st_chat, response):
         message = response
 
     render_chat_ai_private_note(message, additional_kwargs)
-    render_chat_msg(st_chat, "assistant", message, additional_kwargs)
+    if not rendered:
+        render_chat_msg(st_chat, "assistant", message, additional_kwargs)
     msgs.add_message(AIMessage(content=message, additional_kwargs=additional_kwargs))
 
 
@@ -122,7 +148,7 @@ def render_chat(st_chat_entry, st_chat):
     global msgs
 
     # Set up message history.
-    msgs = StreamlitChatMessageHistory(key=f"langchain_messages-{session_id}")
+    msgs = chat_history(session_id)
     welcome_message = "How can I help you?"
 
     if len(msgs.messages) == 0:
@@ -132,7 +158,6 @@ def render_chat(st_chat_entry, st_chat):
     # We add our tool calls to history so the AI can see them, but we strip them for our chat here.
 
     for msg in msgs.messages:
-        print(f"MSG: {msg}")
         if msg.content.strip().startswith("Execution Attempt") and not display_tools_calls:
             continue
         # JSON Check if the message content begins with '{'
@@ -151,15 +176,18 @@ def render_chat(st_chat_entry, st_chat):
 
         # We do a few re-tries and warn - if it triggers it is worth debugging why
         response = None
+        inputs = {'input': input,
+                  'purpose_prompt': purpose_prompt }
         for attempt in range(3):
             try:
-                response = chain_with_history.invoke(
-                    {'input': input,
-                     'purpose_prompt': purpose_prompt },
-                    chain_config)
+                rendered = False
+                if stream_responses:
+                    response, rendered = render_chat_ai_stream(st_chat, inputs, chain_config)
+                else:
+                    response = chain_with_history.invoke(inputs, chain_config)
 
                 # Display AI assistant response and save to message history.
-                render_chat_ai_callback(st_chat, response)
+                render_chat_ai_callback(st_chat, response, rendered)
 
                 break
             except Exception as e:
@@ -175,20 +203,26 @@ def render_chat(st_chat_entry, st_chat):
 
 model_server_url = 'http://localhost:11434'
 display_tools_calls = True
+stream_responses = True
 
 # Check if 'model_cache' is in the session state, and if not, initialize it.
 if 'available_models' not in st.session_state:
     st.session_state.available_models =  get_ollama_model_names(model_server_url)
 model_name = st.sidebar.selectbox("Choose a model", st.session_state.available_models)
-print(f"Using model {model_name}")
-model = Ollama(model=model_name, format='json', temperature=0.9,  num_predict=128)
-tool_manager = ToolManager()
-
+logger.debug("Using model %s", model_name)
 tools = [add, multiply, converse]
-tool_manager.set_tool_settings({'default_tool': 'converse'})
-tool_manager.load_tools(tools)
 
-chain_with_history = chat_chain_load(model, tool_manager)
+def chat_load(model_name, tools):
+    model = CakeOllama(base_url=model_server_url, model=model_name, format='json', temperature=0.9,  num_predict=128)
+    tool_manager = ToolManager()
+    tool_manager.set_tool_settings({'default_tool': 'converse'})
+    tool_manager.load_tools(tools)
+    return (model, tool_manager,
+            chat_chain_load(model, tool_manager), chat_chain_load(model, tool_manager, streaming=True))
+
+# Built once per process for each model and tool set, not on every rerun.
+model, tool_manager, chain_with_history, chain_stream = process_cached(
+    ('simple_chat_bot', model_name), tuple(t.name for t in tools), lambda: chat_load(model_name, tools))
 
 st.title("Chatbot with tools")
 session_id = render_session_id(st, st.sidebar)
@@ -198,6 +232,9 @@ msgs = {}
 render_chat(st, st)
 
 
+if 'last_stream_stats' in st.session_state:
+    st.sidebar.caption(f"Time to first token: {st.session_state.last_stream_stats['time_to_first_token'] * 1000:.0f} ms")
+
 # Define the clear_cache function
 def clear_cache():
     global msgs
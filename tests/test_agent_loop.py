@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+from langchain_core.tools import tool
+
+from helper_ollama_fake import FakeOllamaServer
+from helper_ollama_http import OllamaClient
+from llm_agent_loop import AgentLoop, StepTimeout, AWAITING_USER_PREFIX
+from llm_tools_manager import ToolManager
+
+
+@tool
+def add(first: int, second: int) -> int:
+    """Add two integers."""
+    return first + second
+
+@tool
+def python_exec(code: str) -> str:
+    """Execute python code."""
+    return f"{AWAITING_USER_PREFIX} for you to allow or deny code execution."
+
+
+def make_loop():
+    tool_manager = ToolManager()
+    tool_manager.set_tool_settings({'default_tool': 'converse'})
+    tool_manager.load_tools([add, python_exec])
+    return tool_manager, AgentLoop(tool_manager, max_steps=4)
+
+
+def test_single_call_awaiting_user():
+    tool_manager, loop = make_loop()
+    call = {'tool': 'python_exec', 'args': {'code': 'print(1)'}}
+    assert not loop.next_step(call, tool_manager.invoke_many([call]))
+    assert loop.stop_reason == 'awaiting_user'
+
+
+def test_merged_calls_awaiting_user():
+    tool_manager, loop = make_loop()
+    calls = [{'tool': 'add', 'args': {'first': 1, 'second': 2}},
+             {'tool': 'python_exec', 'args': {'code': 'print(1)'}}]
+    result = tool_manager.invoke_many(calls)
+    assert str(result.message).splitlines()[1].startswith('python_exec({')
+    assert not loop.next_step({'tool_calls': calls}, result)
+    assert loop.stop_reason == 'awaiting_user'
+
+
+def test_tool_result_continues():
+    tool_manager, loop = make_loop()
+    call = {'tool': 'add', 'args': {'first': 1, 'second': 2}}
+    assert loop.next_step(call, tool_manager.invoke_many([call]))
+    assert loop.stop_reason is None
+
+
+def test_step_timeout_aborts_stalled_stream():
+    server = FakeOllamaServer(models=['m'], first_token_delay=30).start()
+    client = OllamaClient(server.url)
+    closed = threading.Event()
+
+    def chunks():
+        response = client.post_stream('/api/generate', {'model': 'm', 'prompt': 'hello'})
+        try:
+            yield from response.iter_lines(decode_unicode=True)
+        finally:
+            closed.set()
+
+    tool_manager, _ = make_loop()
+    loop = AgentLoop(tool_manager, step_timeout=0.5)
+    try:
+        with pytest.raises(StepTimeout):
+            list(loop.limit(chunks()))
+        # The reader isn't left blocked until the server answers or the read timeout.
+        assert closed.wait(5)
+    finally:
+        client.close()
+        server.stop()
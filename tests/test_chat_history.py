@@ -0,0 +1,53 @@
+import pickle
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from llm_chat_history import SQLiteChatHistoryStore, MemoryChatHistoryStore
+from llm_history_window import HistoryWindow
+
+
+def add_turns(history, turns, start=0):
+    for i in range(start, start + turns):
+        history.add_messages([HumanMessage(content=f"question {i} " + "x" * 40),
+                              AIMessage(content=f"answer {i} " + "y" * 40)])
+
+
+def test_sqlite_messages_round_trip(tmp_path):
+    store = SQLiteChatHistoryStore(str(tmp_path / 'history.db'))
+    history = store.get_history('s')
+    reference = {'return_object': {'artifact': 'ab12', 'kind': 'png', 'summary': 'figure'}}
+    history.add_messages([HumanMessage(content="draw y=x*x"),
+                          AIMessage(content="", additional_kwargs=reference)])
+    # Rows written as pickles by earlier versions still load.
+    store.transaction().execute("INSERT INTO messages (session_id, message, created) VALUES (?, ?, 0)",
+                                ('s', pickle.dumps(AIMessage(content="old"))))
+    store.transaction().commit()
+
+    messages = SQLiteChatHistoryStore(str(tmp_path / 'history.db')).get_history('s').messages
+    assert [message.content for message in messages] == ["draw y=x*x", "", "old"]
+    assert messages[1].additional_kwargs == reference
+    assert isinstance(store.fetch("SELECT message FROM messages LIMIT 1")[0][0], str)
+
+
+def test_get_recent_pages_from_the_newest():
+    history = MemoryChatHistoryStore().get_history('s')
+    add_turns(history, 5)
+    assert [m.content[:8] for m in history.get_recent(3)] == ["answer 3", "question", "answer 4"]
+    assert [m.content[:10] for m in history.get_recent(2, offset=8)] == ["question 0", "answer 0 y"]
+
+
+def test_window_view_loads_only_unfolded_messages(tmp_path):
+    store = SQLiteChatHistoryStore(str(tmp_path / 'history.db'))
+    history = store.get_history('s')
+    window = HistoryWindow(token_budget=100, summary_tokens=50, sticky=True)
+    reference = HistoryWindow(token_budget=100, summary_tokens=50, sticky=True)
+    limits = []
+    get_recent = history.get_recent
+    history.get_recent = lambda limit, offset=0: limits.append(limit) or get_recent(limit, offset)
+
+    view = window.view(history, 's')
+    for turn in range(10):
+        add_turns(history, 1, turn)
+        assert view.messages == reference.window('s', history.messages)
+    # Once older messages are folded into the summary they aren't loaded any more.
+    assert max(limits[-3:]) < len(history) / 2
@@ -0,0 +1,25 @@
+from langchain_core.messages import AIMessage, HumanMessage
+
+from llm_chat_history import MemoryChatHistoryStore
+from helper_st_chat_view import ChatView
+
+
+def test_chat_view_loads_pages_from_the_newest():
+    history = MemoryChatHistoryStore().get_history('s')
+    for i in range(20):
+        history.add_messages([HumanMessage(content=f"q{i}"), AIMessage(content='{"tool": "add"}')])
+    view = ChatView()
+    view.sync(history)
+    assert view.messages == [] and view.older() == 40
+
+    view.load_older(history, 10)
+    assert [m.content for m in view.visible(False)] == ["q15", "q16", "q17", "q18", "q19"]
+    assert len(view.visible(True)) == 10 and view.older() == 30
+
+    history.add_messages([HumanMessage(content="new")])
+    view.sync(history)
+    assert view.visible(False)[-1].content == "new" and view.older() == 30
+
+    history.clear()
+    view.sync(history)
+    assert view.messages == [] and view.older() == 0
@@ -0,0 +1,11 @@
+import pytest
+import requests
+
+from helper_ollama_pool import OllamaServerPool
+
+
+@pytest.mark.parametrize('hedge', [False, True])
+def test_no_endpoint_raises_connection_error(hedge):
+    pool = OllamaServerPool([], check_interval=0, hedge=hedge)
+    with pytest.raises(requests.exceptions.ConnectionError, match="No Ollama endpoint"):
+        list(pool.stream_lines('/api/generate', {'model': 'm'}))
@@ -0,0 +1,17 @@
+from llm_process_cache import process_cached
+
+
+class Closable:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_replaced_artifact_is_closed():
+    first = process_cached(('test_closable',), 1, Closable)
+    assert process_cached(('test_closable',), 1, Closable) is first
+    second = process_cached(('test_closable',), 2, Closable)
+    assert second is not first
+    assert first.closed and not second.closed
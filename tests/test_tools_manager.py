@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+from langchain_core.tools import tool
+
+from llm_tools_manager import ToolManager
+
+
+@tool
+def thread_name() -> str:
+    """The name of the thread running the tool."""
+    return threading.current_thread().name
+
+@tool
+def exec_thread_name() -> str:
+    """The name of the thread running the side-effecting tool."""
+    return threading.current_thread().name
+
+
+def test_invoke_many_runs_side_effects_on_calling_thread():
+    tool_manager = ToolManager()
+    tool_manager.set_tool_settings({'default_tool': 'converse'})
+    tool_manager.load_tools([thread_name, exec_thread_name], side_effects=('exec_thread_name',))
+    result = tool_manager.invoke_many([{'tool': 'thread_name', 'args': {}},
+                                       {'tool': 'exec_thread_name', 'args': {}}])
+    pooled, side_effect = str(result.message).splitlines()
+    assert pooled.startswith('thread_name({}): tool')
+    assert side_effect == f"exec_thread_name({{}}): {threading.current_thread().name}"
+
+
+running = []
+overlaps = []
+
+@tool
+async def slow_exec(name: str) -> str:
+    """Side-effecting tool that records whether another one ran at the same time."""
+    overlaps.append(bool(running))
+    running.append(name)
+    await asyncio.sleep(0.05)
+    running.remove(name)
+    return name
+
+
+def test_ainvoke_many_awaits_side_effects_in_call_order():
+    tool_manager = ToolManager()
+    tool_manager.set_tool_settings({'default_tool': 'converse'})
+    tool_manager.load_tools([thread_name, slow_exec], side_effects=('slow_exec',))
+    calls = [{'tool': 'slow_exec', 'args': {'name': 'first'}},
+             {'tool': 'thread_name', 'args': {}},
+             {'tool': 'slow_exec', 'args': {'name': 'second'}}]
+    result = asyncio.run(tool_manager.ainvoke_many(calls))
+    lines = str(result.message).splitlines()
+    assert overlaps == [False, False]
+    assert lines[0].endswith(': first') and lines[2].endswith(': second')
+    assert lines[1].startswith('thread_name({}): ')